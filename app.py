@@ -1,11 +1,10 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify, make_response, g
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify, g
 import pandas as pd
 import os
-import io
 
 from urllib.parse import quote_plus
 import requests, time, math
-from ortools.constraint_solver import routing_enums_pb2, pywrapcp
+from ortools.constraint_solver import pywrapcp
 from decimal import Decimal, InvalidOperation
 from collections import defaultdict
 from werkzeug.utils import secure_filename
@@ -14,6 +13,36 @@ from psycopg2.extras import RealDictCursor
 import psycopg2
 from datetime import datetime, date, timedelta
 
+import database
+import migrations
+import query_advisor
+import fleet_cache
+import financials
+import pnl_engine
+import lanes
+import reports
+import geocoding
+import gazetteer
+import geocode_queue
+import distances
+import site_matrix
+import road_engine
+import fleet_routing
+from database import get_db, indent_date_filters, indent_list_filters, INDENT_LIST_COLUMNS, order_list_filters
+from pagination import keyset_page, page_size, jsonable_row
+from streaming import csv_copy_response, frames_response, server_side_batches
+from ingest import validate_indents, bulk_insert_indents, upsert_orders, save_order, ORDER_CHUNK_ROWS, ORDER_COLUMNS
+from query_advisor import register_query
+from fleet_cache import get_fleet, invalidate_fleet
+from financials import (TRIP_LOAD_SQL, TRIP_REVENUE_SQL, TRIP_FUEL_COST_SQL, FIXED_COST_PER_TRIP, LANE_JOIN_SQL,
+                        refresh_days, refresh_vehicle)
+from pnl_engine import TRIP_INPUTS_SELECT_SQL, trip_frame
+from lanes import lane_matrix
+from fleet_routing import RouteBudget, int_matrix, search_parameters as route_search_parameters, solver_options
+from geocoding import geocode
+from geocode_queue import INDENT, enqueue as enqueue_geocode, split_drops
+from reports import register_report, normalize_filters, default_window, is_long_range, cached_report, enqueue_report, job_status
+
 # -------------------------- Configuration and Initialization --------------------------
 
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
@@ -33,62 +62,35 @@ db_config = {
 }
 
 
-def get_db_connection():
-    """Establishes and returns a connection to the PostgreSQL database."""
-    conn = psycopg2.connect(
-        host=db_config['host'],
-        user=db_config['user'],
-        password=db_config['password'],
-        dbname=db_config['database'],
-        port=db_config['port']
-    )
-    return conn
-
-# Database table creation function
-def create_tables():
-    """Creates the necessary tables if they do not already exist."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Create driver_master table (if it doesn't exist)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS driver_master (
-                driver_id VARCHAR(50) PRIMARY KEY,
-                driver_name VARCHAR(100) NOT NULL,
-                license_number VARCHAR(50) NOT NULL,
-                contact_number VARCHAR(20),
-                address TEXT,
-                availability VARCHAR(20),
-                shift_info VARCHAR(50),
-                aadhar_file VARCHAR(255),
-                license_file VARCHAR(255)
-            );
-        """)
-
-        # Create driver_financials table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS driver_financials (
-                financial_id SERIAL PRIMARY KEY,
-                driver_id VARCHAR(50) REFERENCES driver_master(driver_id) ON DELETE CASCADE,
-                salary NUMERIC(10, 2) NOT NULL,
-                bonus NUMERIC(10, 2) DEFAULT 0.00,
-                last_paid_date DATE
-            );
-        """)
-
-        conn.commit()
-        print("Tables created successfully.")
-    except psycopg2.Error as e:
-        print(f"Error creating tables: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-# Create tables when the application starts
-with app.app_context():
-    create_tables()
+# One pooled connection per request, checked out lazily via get_db()
+database.init_app(app, db_config)
+
+# Schema is migrated once per deploy (`flask db-upgrade`); workers only check the cached version
+migrations.init_app(app)
+query_advisor.init_app(app)
+# Fleet registry is served from a per-worker snapshot, reloaded after fleet writes
+fleet_cache.init_app(app)
+# `flask rollup-rebuild` backfills vehicle_daily_financials
+financials.init_app(app)
+pnl_engine.init_app(app)
+# Trip km come from the lanes table; `flask lanes-fill` geocodes lanes it is missing
+lanes.init_app(app)
+# Long /financial ranges are computed by `flask report-worker` and cached
+reports.init_app(app)
+# Geocodes are cached per worker and in geocode_cache
+geocoding.init_app(app)
+# Offline GeoNames gazetteer (`flask gazetteer-build`), tried before any remote lookup
+gazetteer.init_app(app)
+# Indent and order writes queue their rows for `flask geocode-worker`
+geocode_queue.init_app(app)
+# `flask distance-benchmark` times the vectorized distance matrix against the old loop
+distances.init_app(app)
+# Distances between known sites are precomputed (`flask site-matrix-build`) and mapped by every worker
+site_matrix.init_app(app)
+# SITE_MATRIX_METHOD=road measures along the OSM graph `flask road-build` contracts
+road_engine.init_app(app)
+# Solver time limits and `flask route-benchmark`
+fleet_routing.init_app(app)
 
 
 # -------------------------- Authentication Routes --------------------------
@@ -103,12 +105,11 @@ def auth():
             username = request.form['username']
             password = request.form['password']
 
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor(cursor_factory=RealDictCursor)
             cursor.execute('SELECT * FROM users_tms WHERE username = %s', (username,))
             user = cursor.fetchone()
             cursor.close()
-            conn.close()
 
             if user and (user['password'] == password or check_password_hash(user['password'], password)):
                 session['user'] = username
@@ -121,14 +122,13 @@ def auth():
             email = request.form['email']
             password = request.form['password']
 
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor(cursor_factory=RealDictCursor)
             cursor.execute('SELECT * FROM users_tms WHERE username = %s', (username,))
             existing_user = cursor.fetchone()
 
             if existing_user:
                 cursor.close()
-                conn.close()
                 return render_template('login.html', error='Username already exists', form_type='signup')
             else:
                 hashed_password = generate_password_hash(password)
@@ -138,7 +138,6 @@ def auth():
                 )
                 conn.commit()
                 cursor.close()
-                conn.close()
                 session['user'] = username
                 return redirect(url_for('dashboard'))
 
@@ -170,11 +169,7 @@ def fleet_master():
 
         session['user'] = 'Admin'
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM fleet ORDER BY vehicle_id")
-    rows = cursor.fetchall()
+    rows = get_fleet().records
 
     fleet_data = [{
         'vehicle_id': row[0],
@@ -195,9 +190,6 @@ def fleet_master():
         'avg': row[15] if row[15] is not None else 0
     } for row in rows]
 
-    cursor.close()
-    conn.close()
-
     return render_template('fleet_master.html', data=fleet_data, user=session['user'])
 
 
@@ -207,7 +199,7 @@ def add_vehicle():
     form = request.form
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute("""
@@ -226,8 +218,11 @@ def add_vehicle():
             datetime.strptime(form['date_of_join'], '%Y-%m-%d'),
             float(form.get('avg') or 0)
         ))
+        # The vehicle's avg feeds revenue in the daily rollup.
+        refresh_vehicle(cursor, form['vehicle_id'])
 
         conn.commit()
+        invalidate_fleet()
         flash('Vehicle added successfully!', 'success')
     except psycopg2.IntegrityError:
         conn.rollback()
@@ -237,7 +232,6 @@ def add_vehicle():
         flash(f'Error: {str(e)}', 'danger')
     finally:
         cursor.close()
-        conn.close()
 
     return redirect('/fleet_master')
 
@@ -245,7 +239,7 @@ def add_vehicle():
 @app.route('/fleet_master/edit/<vehicle_id>', methods=['GET', 'POST'])
 def edit_vehicle(vehicle_id):
     """Edits an existing vehicle's details."""
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     if request.method == 'POST':
@@ -270,8 +264,10 @@ def edit_vehicle(vehicle_id):
                 float(form.get('capacity_weight_kg') or 0), float(form.get('capacity_vol_cbm') or 0),
                 documents_expiry, date_of_join, float(form.get('avg') or 0), vehicle_id
             ))
+            refresh_vehicle(cursor, vehicle_id)
 
             conn.commit()
+            invalidate_fleet()
             flash('Vehicle updated successfully!', 'success')
             return redirect('/fleet_master')
 
@@ -281,13 +277,11 @@ def edit_vehicle(vehicle_id):
             return redirect('/fleet_master')
         finally:
             cursor.close()
-            conn.close()
 
     # GET method
     cursor.execute("SELECT * FROM fleet WHERE vehicle_id = %s", (vehicle_id,))
     row = cursor.fetchone()
     cursor.close()
-    conn.close()
 
     if not row:
         flash('Vehicle not found.', 'warning')
@@ -315,13 +309,11 @@ def driver_master():
     if 'user' not in session:
         return redirect('/')
 
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    # --- Fetch fleet vehicle_ids for dropdown ---
-    cur.execute("SELECT vehicle_id FROM fleet")
-    fleet_rows = cur.fetchall()
-    fleet_data = [row['vehicle_id'] for row in fleet_rows]
+    # --- Fleet vehicle_ids for dropdown ---
+    fleet_data = get_fleet().id_list
 
     if request.method == 'POST':
         form_data = request.form.to_dict()
@@ -391,7 +383,6 @@ def driver_master():
 
     data = cur.fetchall()
     cur.close()
-    conn.close()
 
     return render_template('driver_master.html', data=data, fleet_data=fleet_data)
 
@@ -400,15 +391,8 @@ def driver_master():
 # -------------------------- Indent Management Routes --------------------------
 
 def get_all_vehicle_numbers():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT vehicle_id FROM fleet")   # 🔹 vehicle_id fetch
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-
-    # सिर्फ vehicle_id की list बनाएं
-    return [row[0] for row in rows if row[0]]
+    """Valid vehicle_ids as a frozenset, served from the fleet snapshot."""
+    return get_fleet().ids
 
 
 
@@ -424,6 +408,26 @@ def clean_numeric(value):
 
 
 # 🔹 Update Vehicle Status
+# Status -> timestamp column stamped when a vehicle reaches it
+STATUS_TIME_COLUMNS = {'loading': 'loading_time', 'parking': 'parking_time', 'exit': 'exit_time'}
+
+UPDATE_STATUS_SQL = """
+    UPDATE indents
+    SET {column} = %s, status = %s
+    WHERE indent = %s AND vehicle_number = %s
+    RETURNING vehicle_number, indent_date
+"""
+register_query('update_status', UPDATE_STATUS_SQL.format(column='loading_time'),
+               ('2024-01-01 00:00:00', 'loading', 'IND1', 'HR55AB0002'))
+
+GET_STATUS_SQL = register_query('get_status', """
+    SELECT loading_time, parking_time, exit_time, status
+    FROM indents
+    WHERE indent = %s AND vehicle_number = %s
+    LIMIT 1
+""", ('IND1', 'HR55AB0002'))
+
+
 @app.route('/update_status', methods=['POST'])
 def update_status():
     data = request.get_json()
@@ -433,33 +437,16 @@ def update_status():
 
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
-    if status == 'loading':
-        cur.execute("""
-            UPDATE indents
-            SET loading_time = %s, status = %s
-            WHERE indent = %s AND vehicle_number = %s
-        """, (timestamp, 'loading', indent, vehicle))
-
-    elif status == 'parking':
-        cur.execute("""
-            UPDATE indents
-            SET parking_time = %s, status = %s
-            WHERE indent = %s AND vehicle_number = %s
-        """, (timestamp, 'parking', indent, vehicle))
-
-    elif status == 'exit':
-        cur.execute("""
-            UPDATE indents
-            SET exit_time = %s, status = %s
-            WHERE indent = %s AND vehicle_number = %s
-        """, (timestamp, 'exit', indent, vehicle))
+    column = STATUS_TIME_COLUMNS.get(status)
+    if column:
+        cur.execute(UPDATE_STATUS_SQL.format(column=column), (timestamp, status, indent, vehicle))
+        refresh_days(cur, cur.fetchall())
 
     conn.commit()
     cur.close()
-    conn.close()
 
     return jsonify({'success': True, 'timestamp': timestamp})
 
@@ -469,19 +456,13 @@ def get_status():
     indent = request.args.get('indent')
     vehicle = request.args.get('vehicle')
 
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
-    cur.execute("""
-        SELECT loading_time, parking_time, exit_time, status
-        FROM indents
-        WHERE indent = %s AND vehicle_number = %s
-        LIMIT 1
-    """, (indent, vehicle))
+    cur.execute(GET_STATUS_SQL, (indent, vehicle))
 
     row = cur.fetchone()
     cur.close()
-    conn.close()
 
     if row:
         return jsonify({
@@ -497,11 +478,19 @@ def get_status():
 
 
 # --- Main Route Modification: Fetch Status Data ---
+# id is selected last for the keyset tiebreak; zip(INDENT_LIST_COLUMNS, row) drops it.
+INDENT_LIST_SQL = "SELECT " + ", ".join(f'"{c}"' for c in INDENT_LIST_COLUMNS) + ", id FROM indents"
+register_query('def_indent_page', INDENT_LIST_SQL + """
+    WHERE (indent_date, id) < (%s, %s)
+    ORDER BY indent_date DESC, id DESC LIMIT 51
+""", ('2024-06-01', 1000))
+
+
 @app.route("/def", methods=["GET", "POST"])
 def def_page():
     """Main route for displaying and adding indents."""
     valid_vehicles = get_all_vehicle_numbers()
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     if request.method == "POST":
@@ -511,12 +500,12 @@ def def_page():
         if vehicle_no not in valid_vehicles:
             flash(f"Invalid Vehicle Number: {vehicle_no}", "danger")
             cursor.close()
-            conn.close()
             return redirect(url_for("def_page"))
 
         try:
             # Existing logic for separating customers — unchanged
             customers = []
+            new_ids = []
             for key, values in form_data.items():
                 if key.startswith("customers["):
                     parts = key.split("[")
@@ -566,6 +555,7 @@ def def_page():
                         loading_time, parking_time, exit_time
                     )
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
                 """, (
                     indent_date,
                     indent_number,
@@ -587,7 +577,11 @@ def def_page():
                     ft_month,
                     None, None, None  # Tracking fields initialized as NULL (which is correct)
                 ))
+                new_ids.append(cursor.fetchone()[0])
 
+            refresh_days(cursor, [(vehicle_no, request.form.get("indent_date", ""))])
+            # Coordinates are filled in by `flask geocode-worker`
+            enqueue_geocode(cursor, INDENT, new_ids)
             conn.commit()
             flash(f"Indent created successfully with {len(customers)} customer(s)!", "success")
 
@@ -597,99 +591,78 @@ def def_page():
             flash(f"Error creating indent: {str(e)}", "danger")
 
         cursor.close()
-        conn.close()
         return redirect(url_for("def_page"))
 
-    # --- Fetch all indents (showing new tracking fields) ---
-    cursor.execute("SELECT * FROM indents ORDER BY indent_date DESC")
-    rows = cursor.fetchall()
-    col_names = [desc[0] for desc in cursor.description]
-    indent_data = [dict(zip(col_names, row)) for row in rows]
-    indent_data = indent_data[:50]
+    # --- Fetch one page of indents (keyset on indent_date, id) ---
+    filters, params, active_filters = indent_list_filters(request.args)
+    rows, next_cursor, prev_cursor = keyset_page(
+        cursor, INDENT_LIST_SQL, filters, params, 'indent_date', 'id',
+        cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit'))
+    )
+    indent_data = [dict(zip(INDENT_LIST_COLUMNS, row)) for row in rows]
 
     cursor.close()
-    conn.close()
 
-    return render_template("def.html", indent_data=indent_data, fleet_data=valid_vehicles)
+    return render_template("def.html", indent_data=indent_data, fleet_data=get_fleet().id_list,
+                           filters=active_filters, next_cursor=next_cursor, prev_cursor=prev_cursor)
 # -------------------------- Upload Indents --------------------------
 
 @app.route("/upload_indent", methods=["POST"])
 def upload_indent():
+    """Bulk-loads an indent sheet via COPY; returns a per-row rejection report."""
+    want_json = request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json"
     valid_vehicles = get_all_vehicle_numbers()
     file = request.files.get("file")
 
-    if not file:
-        flash("No file selected.", "danger")
+    def fail(message, category="danger", status=400):
+        if want_json:
+            return jsonify({"success": False, "error": message}), status
+        flash(message, category)
         return redirect(url_for("def_page"))
 
+    if not file:
+        return fail("No file selected.")
+
     try:
         filename = file.filename
         if filename.endswith(".csv"):
-            df = pd.read_csv(file)
+            df = pd.read_csv(file, dtype=str, keep_default_na=False)
         elif filename.endswith((".xlsx", ".xls")):
-            df = pd.read_excel(file)
+            df = pd.read_excel(file, dtype=str)
         else:
-            flash("Unsupported file format.", "danger")
-            return redirect(url_for("def_page"))
-
-        df = df.where(pd.notnull(df), None)
+            return fail("Unsupported file format.")
 
         if df.empty:
-            flash("Uploaded file is empty.", "warning")
-            return redirect(url_for("def_page"))
+            return fail("Uploaded file is empty.", "warning")
 
         if 'vehicle_number' not in df.columns:
-            flash("Missing 'vehicle_number' column.", "danger")
-            return redirect(url_for("def_page"))
+            return fail("Missing 'vehicle_number' column.")
 
-        valid_df = df[df["vehicle_number"].isin(valid_vehicles)]
-        invalid_df = df[~df["vehicle_number"].isin(valid_vehicles)]
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        valid_df, rejections = validate_indents(df, valid_vehicles)
 
+        inserted = 0
         if not valid_df.empty:
-            sql = """
-                INSERT INTO indents (
-                    indent_date, indent, allocation_date, customer_name, "range",
-                    pickup_location, location, vehicle_number, vehicle_model,
-                    vehicle_based, lr_no, material, load_per_bucket, no_of_buckets,
-                    t_load, pod_received, freight_tiger_number, freight_tiger_month
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            for _, row in valid_df.iterrows():
-                cursor.execute(sql, (
-                    row.get("indent_date"),
-                    row.get("indent"),
-                    row.get("allocation_date"),
-                    row.get("customer_name"),
-                    row.get("range"),
-                    row.get("pickup_location"),
-                    row.get("location"),
-                    row.get("vehicle_number"),
-                    row.get("vehicle_model"),
-                    row.get("vehicle_based"),
-                    row.get("lr_no"),
-                    row.get("material"),
-                    clean_numeric(row.get("load_per_bucket")),
-                    clean_numeric(row.get("no_of_buckets")),
-                    clean_numeric(row.get("t_load")),
-                    row.get("pod_received"),
-                    row.get("freight_tiger_number"),
-                    row.get("freight_tiger_month"),
-                ))
-
-            conn.commit()
-            flash(f"{len(valid_df)} valid indent(s) uploaded successfully!", "success")
+            inserted = bulk_insert_indents(get_db(), valid_df)
 
-        if not invalid_df.empty:
-            flash(f"{len(invalid_df)} row(s) skipped due to invalid vehicle numbers.", "warning")
+    except Exception as e:
+        get_db().rollback()
+        return fail(f"Error processing file: {str(e)}", status=500)
 
-        cursor.close()
-        conn.close()
+    rejected_rows = len(df) - len(valid_df)
+    if want_json:
+        return jsonify({
+            "success": True,
+            "inserted": inserted,
+            "rejected_rows": rejected_rows,
+            "rejections": rejections,
+        })
 
-    except Exception as e:
-        flash(f"Error processing file: {str(e)}", "danger")
+    if inserted:
+        flash(f"{inserted} valid indent(s) uploaded successfully!", "success")
+    if rejections:
+        details = "; ".join(f"row {r['row']} {r['column']}: {r['reason']} ({r['value']})" for r in rejections[:10])
+        more = f" (+{len(rejections) - 10} more)" if len(rejections) > 10 else ""
+        flash(f"{rejected_rows} row(s) skipped: {details}{more}", "warning")
 
     return redirect(url_for("def_page"))
 
@@ -698,19 +671,23 @@ def upload_indent():
 
 @app.route("/export_indents")
 def export_indents():
-    """Exports all indents to a downloadable CSV file."""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM indents", conn)
-    conn.close()
-
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
+    """Streams indents as CSV (optionally filtered and gzipped) via COPY TO STDOUT."""
+    start_date = request.args.get("start_date", "").strip()
+    end_date = request.args.get("end_date", "").strip()
+    vehicle = request.args.get("vehicle", "").strip()
+    compress = request.args.get("gzip", "") in ("1", "true", "yes")
+
+    filters, params = indent_date_filters(start_date, end_date)
+    if vehicle:
+        filters.append("vehicle_number = %s")
+        params.append(vehicle)
+
+    query = "SELECT * FROM indents"
+    if filters:
+        query += " WHERE " + " AND ".join(filters)
+    query += " ORDER BY id"
 
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=indents.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    return csv_copy_response(get_db(), query, params, "indents.csv", compress=compress)
 
 
 # -------------------------- Master Model Routes --------------------------
@@ -718,14 +695,13 @@ def export_indents():
 @app.route("/master_model")
 def master_model():
     """Displays the master model data."""
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM master_model")
     rows = cursor.fetchall()
     col_names = [desc[0] for desc in cursor.description]
     master_data = [dict(zip(col_names, row)) for row in rows]
     cursor.close()
-    conn.close()
     return render_template("master_model.html", rows=master_data)
 
 
@@ -741,7 +717,7 @@ def add_row():
         "modified_by": session.get('user', 'Admin')
     }
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO master_model (range, product, transport_rate, loading_rate, unloading_rate, modified_by)
@@ -752,7 +728,6 @@ def add_row():
     ))
     conn.commit()
     cursor.close()
-    conn.close()
 
     flash("New business plan added successfully!", "success")
     return redirect(url_for("master_model"))
@@ -760,12 +735,6 @@ def add_row():
 
 # -------------------------- Financial Dashboard Routes --------------------------
 
-def calculate_distance(pickup, drop):
-    """A placeholder function to calculate distance."""
-    if (pickup == 'Sonipat' and drop == 'Delhi') or (pickup == 'Delhi' and drop == 'Sonipat'):
-        return 80
-    return 150
-
 # ─────────────────────────────── Safe Decimal Helper ─────────────────────────────── #
 # ─────────────── Helper: Safe Decimal ─────────────── #
 def safe_decimal(value, default=0):
@@ -778,183 +747,199 @@ def safe_decimal(value, default=0):
         return Decimal(default)
 
 
-@app.route('/financial')
-def financial():
-    """Generates and displays the financial dashboard with filters, CSV export, and top 5 revenue vehicles."""
-    vehicle_filter = request.args.get('vehicle_id', '').strip()
-    driver_filter = request.args.get('driver_name', '').strip()
-    export_csv = request.args.get('export', '').strip()
-    start_date = request.args.get('start_date', '').strip()
-    end_date = request.args.get('end_date', '').strip()
-
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    # ─────────────── Constants ─────────────── #
-    fuel_price_per_liter = safe_decimal('96.0')
-    fuel_efficiency_kmpl = safe_decimal('12.0')
-    toll_tax_per_trip = safe_decimal('100.0')
-    misc_cost_per_trip = safe_decimal('50.0')
-    cost_per_km_fuel = fuel_price_per_liter / fuel_efficiency_kmpl
+# Trips shown on the dashboard; CSV export is not limited.
+FINANCIAL_TRIP_ROWS = 500
+TOP_VEHICLES = 5
 
-    # ─────────────── Fetch all indents ─────────────── #
-    query = """
+# Per-vehicle totals come from the daily rollup, ranked by revenue; only the
+# top rows leave the database. all_trips counts every vehicle before the cut.
+FINANCIAL_TOP_VEHICLES_SQL = """
+    SELECT * FROM (
+        SELECT
+            r.vehicle_id,
+            MAX(f.vehicle_name) AS vehicle_name,
+            SUM(r.trips) AS trips,
+            SUM(r.revenue) AS revenue,
+            SUM(r.fuel_cost) AS fuel_cost,
+            SUM(r.fuel_cost + r.fixed_cost) AS total_cost,
+            SUM(r.revenue - r.fuel_cost - r.fixed_cost) AS pnl,
+            SUM(r.range_distance) AS total_distance,
+            SUM(SUM(r.trips)) OVER () AS all_trips,
+            ROW_NUMBER() OVER (ORDER BY SUM(r.revenue) DESC, r.vehicle_id) AS revenue_rank,
+            100 * SUM(r.revenue) / NULLIF(MAX(SUM(r.revenue)) OVER (), 0) AS revenue_percent
+        FROM vehicle_daily_financials r
+        JOIN fleet f ON f.vehicle_id = r.vehicle_id
+        LEFT JOIN driver_master dm ON f.driver_id = dm.driver_id
+        {filters}
+        GROUP BY r.vehicle_id
+    ) ranked
+    WHERE revenue_rank <= %s
+    ORDER BY revenue_rank
+"""
+
+# Filters: {distance_filters} narrows the rollup, {trip_filters} the indents.
+FINANCIAL_TRIPS_FROM = f"""
+    FROM fleet f
+    LEFT JOIN driver_master dm ON f.driver_id = dm.driver_id
+    JOIN indents i ON f.vehicle_id = i.vehicle_number
+    {LANE_JOIN_SQL}
+    LEFT JOIN (
+        SELECT vehicle_id, SUM(range_distance) AS total_distance
+        FROM vehicle_daily_financials
+        {{distance_filters}}
+        GROUP BY vehicle_id
+    ) d ON d.vehicle_id = f.vehicle_id
+    WHERE i.indent_date IS NOT NULL {{trip_filters}}
+    ORDER BY i.indent_date DESC, i.id DESC
+"""
+
+# Newest trips for the dashboard table, P&L computed per row in SQL.
+FINANCIAL_TRIP_PNL_SQL = f"""
     SELECT
         f.vehicle_id,
         f.vehicle_name,
-        f.make,
-        f.model,
-        f.vin,
-        f.avg AS vehicle_avg,
         f.status,
         f.type,
         f."group",
         dm.driver_name,
-        i.indent_date,
-        i.pickup_location,
-        i.location AS drop_location,
-        i.no_of_buckets,
-        i.load_per_bucket,
+        i.customer_name,
         i.material,
         i.lr_no,
-        i.customer_name,
-        i.range
-    FROM fleet f
-    LEFT JOIN driver_master dm ON f.driver_id = dm.driver_id
-    LEFT JOIN indents i ON f.vehicle_id::text = i.vehicle_number
-    WHERE i.indent_date IS NOT NULL
-    """
-
-    # ─────────────── Dynamic filters ─────────────── #
-    filters = []
+        i.pickup_location,
+        i.location AS drop_location,
+        COALESCE(i.no_of_buckets, 0) AS no_of_buckets,
+        COALESCE(i.load_per_bucket, 0) AS load_per_bucket,
+        {TRIP_LOAD_SQL} AS total_load,
+        {TRIP_REVENUE_SQL} AS revenue,
+        {TRIP_FUEL_COST_SQL} AS fuel_cost,
+        {TRIP_FUEL_COST_SQL} + {FIXED_COST_PER_TRIP} AS total_cost,
+        {TRIP_REVENUE_SQL} - {TRIP_FUEL_COST_SQL} - {FIXED_COST_PER_TRIP} AS pnl,
+        COALESCE(d.total_distance, 0) AS total_distance
+""" + FINANCIAL_TRIPS_FROM + """
+    LIMIT %s
+"""
+
+# Every trip's raw inputs for the CSV export; pnl_engine does the arithmetic.
+FINANCIAL_TRIP_INPUTS_SQL = TRIP_INPUTS_SELECT_SQL + FINANCIAL_TRIPS_FROM
+
+register_query('financial_top_vehicles',
+               FINANCIAL_TOP_VEHICLES_SQL.format(filters="WHERE r.day BETWEEN %s AND %s"),
+               ('2024-01-01', '2024-12-31', TOP_VEHICLES))
+register_query('financial_trips',
+               FINANCIAL_TRIP_PNL_SQL.format(distance_filters="WHERE day BETWEEN %s AND %s",
+                                             trip_filters="AND i.indent_date BETWEEN %s AND %s"),
+               ('2024-01-01', '2024-12-31', '2024-01-01', '2024-12-31', FINANCIAL_TRIP_ROWS))
+
+
+def financial_filters(vehicle_filter, driver_filter, start_date, end_date,
+                      date_column, vehicle_column='f.vehicle_id', driver_column='dm.driver_name'):
+    """Dashboard filters as (clauses, params) for the given column names."""
+    # Plain column comparisons (no casts or function wrappers) so the
+    # rollup / indents indexes stay usable.
+    clauses, params = indent_date_filters(start_date, end_date, column=date_column)
     if vehicle_filter:
-        filters.append(f"f.vehicle_id::text = '{vehicle_filter}'")
-    if driver_filter:
-        filters.append(f"dm.driver_name ILIKE '%{driver_filter}%'")
-    if start_date and end_date:
-        filters.append(f"i.indent_date BETWEEN '{start_date}' AND '{end_date}'")
-    elif start_date:
-        filters.append(f"i.indent_date >= '{start_date}'")
-    elif end_date:
-        filters.append(f"i.indent_date <= '{end_date}'")
-
-    if filters:
-        query += " AND " + " AND ".join(filters)
+        clauses.append(f"{vehicle_column} = %s")
+        params.append(vehicle_filter)
+    if driver_filter and driver_column:
+        clauses.append(f"{driver_column} ILIKE %s")
+        params.append(f"%{driver_filter}%")
+    return clauses, params
+
+
+def financial_trips_query(sql, vehicle_filter, driver_filter, start_date, end_date):
+    """Fills the FINANCIAL_TRIPS_FROM filter slots of sql; returns (sql, params) without any LIMIT param."""
+    distance_filters, distance_params = financial_filters(
+        vehicle_filter, None, start_date, end_date, 'day', vehicle_column='vehicle_id', driver_column=None)
+    trip_filters, trip_params = financial_filters(
+        vehicle_filter, driver_filter, start_date, end_date, 'i.indent_date')
+    sql = sql.format(
+        distance_filters=("WHERE " + " AND ".join(distance_filters)) if distance_filters else "",
+        trip_filters="".join(" AND " + f for f in trip_filters),
+    )
+    return sql, distance_params + trip_params
+
+
+def _trip_row(row):
+    return {
+        'Vehicle ID': row['vehicle_id'],
+        'Vehicle Name': row['vehicle_name'] or '',
+        'Driver Name': row['driver_name'] or '',
+        'Status': row['status'] or '',
+        'Type': row['type'] or '',
+        'Group': row['group'] or '',
+        'Customer': row['customer_name'] or '',
+        'Material': row['material'] or '',
+        'LR No.': row['lr_no'] or '',
+        'Pickup': row['pickup_location'] or '',
+        'Drop': row['drop_location'] or '',
+        'No. Buckets': row['no_of_buckets'],
+        'Load/Bucket': row['load_per_bucket'],
+        'Total Load': row['total_load'],
+        'Fuel Cost': row['fuel_cost'],
+        'Total Cost': row['total_cost'],
+        'Revenue': row['revenue'],
+        'PnL': row['pnl'],
+        'Total Distance Travelled': row['total_distance'],
+    }
 
-    cur.execute(query)
-    rows = cur.fetchall()
 
-    # ─────────────── SUM of End-of-Range Distance per Vehicle ─────────────── #
-    range_query = """
-        SELECT
-            vehicle_number::text AS vehicle_id,
-            SUM(
-                COALESCE(
-                    CASE
-                        WHEN range ~ '^[0-9]+(\\.[0-9]+)?$' THEN range::numeric
-                        WHEN range ~ '^[0-9]+(\\.[0-9]+)?-[0-9]+(\\.[0-9]+)?$' THEN
-                            (regexp_replace(range, '.*-(\\d+(?:\\.\\d+)?)', '\\1'))::numeric
-                        ELSE 0
-                    END,
-                    0
-                )
-            ) AS total_distance
-        FROM indents
-        WHERE range IS NOT NULL
-    """
+@app.route('/financial')
+def financial():
+    """Generates and displays the financial dashboard with filters, CSV export, and top 5 revenue vehicles."""
+    vehicle_filter = request.args.get('vehicle_id', '').strip()
+    driver_filter = request.args.get('driver_name', '').strip()
+    export_csv = request.args.get('export', '').strip()
+    start_date = request.args.get('start_date', '').strip()
+    end_date = request.args.get('end_date', '').strip()
 
-    # Apply same date filter for range aggregation
-    if start_date and end_date:
-        range_query += f" AND indent_date BETWEEN '{start_date}' AND '{end_date}'"
-    elif start_date:
-        range_query += f" AND indent_date >= '{start_date}'"
-    elif end_date:
-        range_query += f" AND indent_date <= '{end_date}'"
+    conn = get_db()
 
-    range_query += " GROUP BY vehicle_number"
+    # ─────────────── Export: every trip, streamed in batches ─────────────── #
+    export_format = export_csv.lower()
+    if export_format in ('csv', 'parquet'):
+        sql, params = financial_trips_query(FINANCIAL_TRIP_INPUTS_SQL, vehicle_filter, driver_filter,
+                                            start_date, end_date)
 
-    cur.execute(range_query)
-    range_data = {row['vehicle_id']: safe_decimal(row['total_distance']) for row in cur.fetchall()}
+        def frames():
+            produced = False
+            for batch in server_side_batches(conn, sql, params):
+                produced = True
+                yield trip_frame(batch)
+            if not produced:
+                yield trip_frame([])
 
-    cur.close()
-    conn.close()
-
-    # ─────────────── Calculations ─────────────── #
-    from collections import defaultdict
-    from decimal import Decimal
-
-    routes = []
-    summary = defaultdict(lambda: defaultdict(Decimal))
-
-    for data in rows:
-        no_of_buckets = safe_decimal(data.get('no_of_buckets'))
-        load_per_bucket = safe_decimal(data.get('load_per_bucket'))
-        vehicle_avg = safe_decimal(data.get('vehicle_avg'))
-        total_km = safe_decimal(calculate_distance(data.get('pickup_location'), data.get('drop_location')))
-
-        total_load = no_of_buckets * load_per_bucket
-        revenue = total_load * vehicle_avg
-        fuel_cost = total_km * cost_per_km_fuel
-        total_cost = fuel_cost + toll_tax_per_trip + misc_cost_per_trip
-        pnl = revenue - total_cost
-
-        vehicle_id = data['vehicle_id']
-        total_distance_travelled = range_data.get(str(vehicle_id), Decimal(0))
-
-        trip = {
-            'Vehicle ID': vehicle_id,
-            'Vehicle Name': data.get('vehicle_name', ''),
-            'Driver Name': data.get('driver_name', ''),
-            'Status': data.get('status', ''),
-            'Type': data.get('type', ''),
-            'Group': data.get('group', ''),
-            'Customer': data.get('customer_name', ''),
-            'Material': data.get('material', ''),
-            'LR No.': data.get('lr_no', ''),
-            'Pickup': data.get('pickup_location', ''),
-            'Drop': data.get('drop_location', ''),
-            'No. Buckets': no_of_buckets,
-            'Load/Bucket': load_per_bucket,
-            'Total Load': total_load,
-            'Fuel Cost': fuel_cost,
-            'Total Cost': total_cost,
-            'Revenue': revenue,
-            'PnL': pnl,
-            'Total Distance Travelled': total_distance_travelled
-        }
-        routes.append(trip)
-
-        # Aggregate totals per vehicle
-        summary[vehicle_id]['Vehicle ID'] = vehicle_id
-        summary[vehicle_id]['Vehicle Name'] = data.get('vehicle_name', '')
-        summary[vehicle_id]['Revenue'] += revenue
-        summary[vehicle_id]['Fuel_Cost'] += fuel_cost
-        summary[vehicle_id]['Total_Cost'] += total_cost
-        summary[vehicle_id]['PnL'] += pnl
-        summary[vehicle_id]['Trips'] += 1
-        summary[vehicle_id]['Total Distance Travelled'] = total_distance_travelled
-
-    # ─────────────── Top 5 Vehicles by Revenue ─────────────── #
-    top_vehicles = sorted(summary.values(), key=lambda x: x['Revenue'], reverse=True)[:5]
-
-    # ─────────────── CSV Export ─────────────── #
-    if export_csv.lower() == 'csv':
-        import pandas as pd, io
-        df = pd.DataFrame(routes)
-        output = io.StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        response = make_response(output.getvalue())
-        response.headers["Content-Disposition"] = "attachment; filename=financial_trips.csv"
-        response.headers["Content-type"] = "text/csv"
-        return response
+        try:
+            return frames_response(frames(), 'financial_trips', fmt=export_format,
+                                   compress=request.args.get('gzip') == '1')
+        except RuntimeError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('financial'))
+
+    # ─────────────── Long ranges: cached result or a background job ─────────────── #
+    start_date, end_date = default_window(start_date, end_date)
+    report_job = report_computed_at = None
+    if is_long_range(start_date, end_date):
+        params = normalize_filters(vehicle_filter, driver_filter, start_date, end_date)
+        cached = cached_report(conn, 'financial', params)
+        if cached:
+            report, report_computed_at = cached
+        else:
+            report_job = enqueue_report(conn, 'financial', params)
+            if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+                return jsonify({'job_id': report_job,
+                                'status_url': url_for('financial_job', job_id=report_job)}), 202
+            report = {'routes': [], 'total_trips': 0, 'top_vehicles': []}
+    else:
+        report = financial_report(conn, vehicle_filter, driver_filter, start_date, end_date)
 
     # ─────────────── Render Template ─────────────── #
     return render_template(
         "financial_dashboard.html",
-        routes=routes,
-        summary=summary,
-        top_vehicles=top_vehicles,
+        routes=report['routes'],
+        total_trips=report['total_trips'],
+        top_vehicles=report['top_vehicles'],
+        report_job=report_job,
+        report_computed_at=report_computed_at,
         vehicle_filter=vehicle_filter,
         driver_filter=driver_filter,
         start_date=start_date,
@@ -962,6 +947,49 @@ def financial():
     )
 
 
+def financial_report(conn, vehicle, driver, start_date, end_date):
+    """Top vehicles and newest trips for the dashboard; also run by report jobs."""
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    # ─────────────── Top 5 Vehicles by Revenue (daily rollup) ─────────────── #
+    filters, params = financial_filters(vehicle, driver, start_date, end_date, 'r.day')
+    sql = FINANCIAL_TOP_VEHICLES_SQL.format(filters=("WHERE " + " AND ".join(filters)) if filters else "")
+    cur.execute(sql, params + [TOP_VEHICLES])
+    rows = cur.fetchall()
+    top_vehicles = [{
+        'Vehicle ID': row['vehicle_id'],
+        'Vehicle Name': row['vehicle_name'] or '',
+        'Revenue': row['revenue'],
+        'Fuel_Cost': row['fuel_cost'],
+        'Total_Cost': row['total_cost'],
+        'PnL': row['pnl'],
+        'Trips': row['trips'],
+        'Total Distance Travelled': row['total_distance'],
+        'Revenue_Percent': round(row['revenue_percent'] or 0, 1),
+    } for row in rows]
+    total_trips = rows[0]['all_trips'] if rows else 0
+
+    # ─────────────── Newest trips for the table ─────────────── #
+    sql, params = financial_trips_query(FINANCIAL_TRIP_PNL_SQL, vehicle, driver, start_date, end_date)
+    cur.execute(sql, params + [FINANCIAL_TRIP_ROWS])
+    routes = [_trip_row(row) for row in cur.fetchall()]
+
+    cur.close()
+    return {'routes': routes, 'total_trips': total_trips, 'top_vehicles': top_vehicles}
+
+
+register_report('financial', financial_report)
+
+
+@app.route('/financial/jobs/<int:job_id>')
+def financial_job(job_id):
+    """Status of a queued dashboard report (polled by the dashboard)."""
+    job = job_status(get_db(), job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+
 # -------------------------- Unused/Placeholder Routes --------------------------
 # The following routes were in the original code but were incomplete or not
 # connected to a database. They are kept here to maintain the original file
@@ -1076,87 +1104,55 @@ def download_report():
 
 # --------- ORDER MANAGEMENT -----------
 orders_data = []
+ORDER_LIST_SQL = "SELECT " + ", ".join(ORDER_COLUMNS) + " FROM orders"
+register_query('orders_page', ORDER_LIST_SQL + """
+    WHERE status = %s AND (expected_delivery, order_id) > (%s, %s)
+    ORDER BY expected_delivery, order_id LIMIT 51
+""", ('Pending', '2024-06-01', 'ORD1'))
+
+
 @app.route('/orders', methods=['GET', 'POST'])
 def orders():
+    """Order list (one keyset page at a time) plus the add/update form."""
     if 'user' not in session:
         return redirect('/')
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    want_json = request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json"
+    conn = get_db()
 
     if request.method == 'POST':
-        data = request.form
-        order_id = data['order_id']
-
-        # Check if order exists
-        cur.execute("SELECT 1 FROM orders WHERE order_id = %s", (order_id,))
-        exists = cur.fetchone()
-
-        if exists:
-            # Update existing order
-            cur.execute("""
-                UPDATE orders SET
-                    customer_name = %s,
-                    created_date  = %s,
-                    order_type = %s,
-                    pickup_location_latlon = %s,
-                    drop_location_latlon = %s,
-                    volume_cbm = %s,
-                    weight_kg = %s,
-                    delivery_priority = %s,
-                    expected_delivery = %s,
-                    amount = %s,
-                    status = %s
-                WHERE order_id = %s
-            """, (
-                data['customer_name'],
-                data['created_date'],
-                data['order_type'],
-                data['pickup_location_latlon'],
-                data['drop_location_latlon'],
-                data['volume_cbm'],
-                data['weight_kg'],
-                data['delivery_priority'],
-                data['expected_delivery'],
-                data['amount'],
-                data['status'],
-                order_id
-            ))
-        else:
-            # Insert new order
-            cur.execute("""
-                INSERT INTO orders (
-                    order_id, customer_name, created_date, order_type, pickup_location_latlon,
-                    drop_location_latlon, volume_cbm, weight_kg,
-                    delivery_priority, expected_delivery, amount, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                data['order_id'],
-                data['customer_name'],
-                data['created_date'],
-                data['order_type'],
-                data['pickup_location_latlon'],
-                data['drop_location_latlon'],
-                data['volume_cbm'],
-                data['weight_kg'],
-                data['delivery_priority'],
-                data['expected_delivery'],
-                data['amount'],
-                data['status']
-            ))
-
-        conn.commit()
+        try:
+            order, inserted = save_order(conn, request.form)
+        except Exception as e:
+            conn.rollback()
+            if want_json:
+                return jsonify({'error': str(e)}), 400
+            flash(f"Error saving order: {e}", "danger")
+            return redirect(url_for('orders'))
 
-    # Fetch all orders
-    cur.execute("SELECT * FROM orders ORDER BY expected_delivery")
-    rows = cur.fetchall()
-    colnames = [desc[0] for desc in cur.description]
-    data = [dict(zip(colnames, row)) for row in rows]
+        if want_json:
+            return jsonify({'order': jsonable_row(order), 'inserted': inserted}), 201 if inserted else 200
+        flash(f"Order {order['order_id']} {'added' if inserted else 'updated'}.", "success")
+        return redirect(url_for('orders'))
 
+    filters, params, active_filters = order_list_filters(request.args)
+    cur = conn.cursor()
+    rows, next_cursor, prev_cursor = keyset_page(
+        cur, ORDER_LIST_SQL, filters, params, active_filters['sort'], 'order_id',
+        direction=active_filters['dir'].upper(), cursor=request.args.get('cursor'),
+        limit=page_size(request.args.get('limit'))
+    )
     cur.close()
-    conn.close()
+    data = [dict(zip(ORDER_COLUMNS, row)) for row in rows]
 
-    return render_template('orders.html', data=data)
+    if want_json:
+        return jsonify({
+            'orders': [jsonable_row(row) for row in data],
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+        })
+    return render_template('orders.html', data=data, filters=active_filters,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 
 @app.route('/delete_order/<order_id>', methods=['POST'])
@@ -1165,7 +1161,7 @@ def delete_order(order_id):
         return redirect('/')
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cur = conn.cursor()
         cur.execute("DELETE FROM orders WHERE order_id = %s", (order_id,))
         conn.commit()
@@ -1174,52 +1170,40 @@ def delete_order(order_id):
         print("Error deleting order:", e)
     finally:
         cur.close()
-        conn.close()
 
     return redirect('/orders')
 @app.route('/upload_orders', methods=['POST'])
 def upload_orders():
+    """Upserts an orders CSV in bounded chunks; reports inserted/updated/unchanged counts."""
     if 'user' not in session:
         return redirect('/')
 
-    file = request.files['orders_file']
-    if file and file.filename.endswith('.csv'):
-        import pandas as pd
-        df = pd.read_csv(file)
-        conn = get_db_connection()
-        cur = conn.cursor()
+    want_json = request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json'
+    file = request.files.get('orders_file')
+    if not file or not file.filename.endswith('.csv'):
+        if want_json:
+            return jsonify({'success': False, 'error': 'Please upload a .csv file.'}), 400
+        flash('Please upload a .csv file.', 'danger')
+        return redirect('/orders')
 
-        for _, row in df.iterrows():
-            cur.execute("""
-                INSERT INTO orders (
-                    order_id, customer_name, created_date, order_type, pickup_location_latlon,
-                    drop_location_latlon, volume_cbm, weight_kg,
-                    delivery_priority, expected_delivery, amount, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (order_id) DO UPDATE SET
-                    customer_name = EXCLUDED.customer_name,
-                    created_date = EXCLUDED.created_date,
-                    order_type = EXCLUDED.order_type,
-                    pickup_location_latlon = EXCLUDED.pickup_location_latlon,
-                    drop_location_latlon = EXCLUDED.drop_location_latlon,
-                    volume_cbm = EXCLUDED.volume_cbm,
-                    weight_kg = EXCLUDED.weight_kg,
-                    delivery_priority = EXCLUDED.delivery_priority,
-                    expected_delivery = EXCLUDED.expected_delivery,
-                    amount = EXCLUDED.amount,
-                    status = EXCLUDED.status
-            """, (
-                row['Order_ID'], row['Customer_Name'], row['created_date'], row['Order_Type'],
-                row['Pickup_Location_LatLon'], row['Drop_Location_LatLon'],
-                row['Volume_CBM'], row['Weight_KG'],
-                row['Delivery_Priority'], row['Expected_Delivery'], row['amount'],
-                row['Status']
-            ))
+    try:
+        chunks = pd.read_csv(file, dtype=str, keep_default_na=False, chunksize=ORDER_CHUNK_ROWS)
+        counts, rejections = upsert_orders(get_db(), chunks)
+    except Exception as e:
+        get_db().rollback()
+        if want_json:
+            return jsonify({'success': False, 'error': str(e)}), 500
+        flash(f'Error processing orders file: {str(e)}', 'danger')
+        return redirect('/orders')
 
-        conn.commit()
-        cur.close()
-        conn.close()
+    if want_json:
+        return jsonify({'success': True, **counts, 'rejected': len(rejections), 'rejections': rejections})
 
+    flash(f"Orders uploaded: {counts['inserted']} inserted, {counts['updated']} updated, "
+          f"{counts['unchanged']} unchanged.", 'success')
+    if rejections:
+        details = "; ".join(f"row {r['row']} {r['column']}: {r['reason']}" for r in rejections[:10])
+        flash(f"{len(rejections)} cell(s) rejected: {details}", 'warning')
     return redirect('/orders')
 
 # ---------------- EDIT (Pre-fill Form) ----------------
@@ -1240,37 +1224,23 @@ def edit_order(order_id):
 from flask import Flask, render_template, request, flash, redirect
 from urllib.parse import quote_plus
 import requests, time, math
-from ortools.constraint_solver import routing_enums_pb2, pywrapcp
+from ortools.constraint_solver import pywrapcp
 import pytz
 
 # ------------------ Utility Functions ------------------
 
 # -------- Utility Functions --------
 # -------- Utility Functions --------
-def geocode_address(address, retries=3, delay=1.0):
+def geocode_address(address):
     """
-    Geocode using Nominatim (OpenStreetMap) with retries.
+    Geocode through the shared cache (LRU, then geocode_cache, then Nominatim).
     Returns (lat, lon) or (None, None).
     """
-    url = "https://nominatim.openstreetmap.org/search"
-    params = {"q": address, "format": "json", "limit": 1}
-    headers = {"User-Agent": "MyApp/1.0 (your-email@example.com)"}
-    for attempt in range(1, retries + 1):
-        try:
-            resp = requests.get(url, params=params, headers=headers, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            if data and isinstance(data, list) and len(data) > 0:
-                lat = float(data[0].get("lat"))
-                lon = float(data[0].get("lon"))
-                if -90 <= lat <= 90 and -180 <= lon <= 180:
-                    return lat, lon
-            app.logger.debug(f"Geocode attempt {attempt} returned no data for '{address}'")
-        except Exception as e:
-            app.logger.debug(f"Geocode attempt {attempt} failed for '{address}': {e}")
-        time.sleep(delay)
-    app.logger.warning(f"Geocode failed for address: {address}")
-    return None, None
+    coords = geocode(address)
+    if coords is None:
+        app.logger.warning(f"Geocode failed for address: {address}")
+        return None, None
+    return coords
 
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371.0  # km
@@ -1281,37 +1251,7 @@ def haversine(lat1, lon1, lat2, lon2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     return R * c
 
-def create_distance_matrix(coords):
-    """
-    coords: list of (lat, lon) tuples; entries may be (None, None)
-    Returns n x n matrix of distances in km (float). If either coord invalid, distance is 0.0.
-    """
-    n = len(coords)
-    matrix = [[0.0] * n for _ in range(n)]
-    invalid_indices = [i for i, (lat, lon) in enumerate(coords) if lat is None or lon is None]
-    if invalid_indices:
-        app.logger.warning(f"create_distance_matrix: invalid coordinates at indices {invalid_indices}")
-    for i in range(n):
-        lat1, lon1 = coords[i]
-        for j in range(n):
-            if i == j:
-                matrix[i][j] = 0.0
-                continue
-            lat2, lon2 = coords[j]
-            if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
-                matrix[i][j] = 0.0
-            else:
-                try:
-                    matrix[i][j] = haversine(lat1, lon1, lat2, lon2)
-                except Exception as e:
-                    app.logger.error(f"haversine error for {i}->{j}: {e}")
-                    matrix[i][j] = 0.0
-    # Debug print
-    rows_str = "\n".join([", ".join(f"{v:.3f}" for v in row) for row in matrix])
-    app.logger.debug(f"Distance matrix:\n{rows_str}")
-    return matrix
-
-def solve_tsp(distance_matrix):
+def solve_tsp(distance_matrix, options=None):
     n = len(distance_matrix)
     if n < 2:
         app.logger.warning("solve_tsp called with less than 2 nodes")
@@ -1319,18 +1259,11 @@ def solve_tsp(distance_matrix):
     manager = pywrapcp.RoutingIndexManager(n, 1, 0)
     routing = pywrapcp.RoutingModel(manager)
 
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        val = distance_matrix[from_node][to_node]
-        # integer meters for OR-Tools
-        return int(val * 1000)
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    # km -> integer meters for OR-Tools, once, as a native matrix
+    transit_callback_index = routing.RegisterTransitMatrix(int_matrix(distance_matrix, scale=1000))
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    search_parameters = route_search_parameters(**(options or {}))
     try:
         solution = routing.SolveWithParameters(search_parameters)
     except Exception as e:
@@ -1369,13 +1302,15 @@ def create_google_maps_url(address_list):
     parts = [quote_plus(a) for a in address_list]
     return "https://www.google.com/maps/dir/" + "/".join(parts) + "/"
 
-def save_trip_to_db(indent_id, vehicle, pickup, drops, total_distance, est_arrival, exit_time):
+def save_trip_to_db(indent_id, vehicle, pickup, drops, total_distance, est_arrival, exit_time, duration_hours=None):
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
         drop_location = ", ".join(drops)
         total_drops = len(drops)
-        duration_hours = round(total_distance / 40, 2) if total_distance else 0.0
+        if duration_hours is None:
+            duration_hours = total_distance / 40 if total_distance else 0.0
+        duration_hours = round(duration_hours, 2)
         cursor.execute("""
             INSERT INTO trip_data (
                 indent_id, vehicle_no, driver_name, pickup, drop_location,
@@ -1400,36 +1335,44 @@ def save_trip_to_db(indent_id, vehicle, pickup, drops, total_distance, est_arriv
         ))
         conn.commit()
         cursor.close()
-        conn.close()
     except Exception as e:
+        get_db().rollback()
         app.logger.error(f"save_trip_to_db failed: {e}")
 
 # ---------------- Optimize route ----------------
 
+# Half-open range on the bare column instead of DATE(indent_date) so the
+# (indent_date DESC, id DESC) index serves both the filter and the sort.
+OPTIMIZE_INDENTS_SQL = register_query('optimize_indents', """
+    SELECT indent, vehicle_number, pickup_location, location, exit_time,
+           pickup_lat, pickup_lon, drop_lats, drop_lons
+    FROM indents
+    WHERE indent_date >= %s AND indent_date < %s
+    ORDER BY indent_date DESC
+    LIMIT 5
+""", ('2024-01-01', '2024-01-03'))
+
 @app.route('/optimize', methods=["GET", "POST"])
 def optimize():
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
+        # ?time_limit= is the search budget of the whole request, shared by the indents' TSPs;
+        # ?solution_limit= and ?guided=1 apply to each of them
+        budget = RouteBudget(solver_options(request.args))
 
-        today = datetime.now().strftime("%Y-%m-%d")
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
         yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
 
-        cursor.execute("""
-            SELECT indent, vehicle_number, pickup_location, location, exit_time
-            FROM indents
-            WHERE DATE(indent_date) BETWEEN %s AND %s
-            ORDER BY indent_date DESC
-            LIMIT 5
-        """, (yesterday, today))
+        cursor.execute(OPTIMIZE_INDENTS_SQL, (yesterday, tomorrow))
 
         rows = cursor.fetchall()
         indents_data = []
         ist = pytz.timezone('Asia/Kolkata')
 
-        for row in rows:
-            indent_id, vehicle, pickup, drops_raw, exit_time = row
-            drops = [d.strip() for d in drops_raw.split(",") if d.strip()]
+        for position, row in enumerate(rows):
+            indent_id, vehicle, pickup, drops_raw, exit_time, pickup_lat, pickup_lon, drop_lats, drop_lons = row
+            drops = split_drops(drops_raw)
             exit_time = exit_time or datetime.now()
             exit_time_ist = exit_time.astimezone(ist)
 
@@ -1437,38 +1380,35 @@ def optimize():
 
             app.logger.debug(f"Indent {indent_id} addresses: {all_addresses}")
 
-            # Geocode addresses (retry internally)
-            coords = []
-            for addr in all_addresses:
-                lat, lon = geocode_address(addr)
-                # If geocode failed, log and leave (None, None)
-                if lat is None or lon is None:
-                    app.logger.warning(f"Geocode missing for '{addr}' (indent {indent_id})")
-                    coords.append((None, None))
-                else:
-                    coords.append((lat, lon))
-                # Be polite to Nominatim
-                time.sleep(1)
-
-            app.logger.debug(f"Indent {indent_id} coords: {coords}")
+            # Coordinates stored by the geocode worker; (None, None) until it has run
+            drop_coords = list(zip(drop_lats, drop_lons)) if drop_lats and len(drop_lats) == len(drops) else []
+            coords = [(pickup_lat, pickup_lon)] + (drop_coords or [(None, None)] * len(drops))
 
-            # Create distance matrix
-            dist_matrix = create_distance_matrix(coords)
+            # Stored lanes, else estimated from the stored coordinates; nothing is geocoded here
+            lane_km = lane_matrix(all_addresses, coords)
+            unresolved = [all_addresses[i] for i, row in enumerate(lane_km)
+                          if all(km is None for j, km in enumerate(row) if j != i)]
+            if unresolved:
+                app.logger.warning(f"No lane distances for {unresolved} (indent {indent_id})")
+            dist_matrix = [[float(km or 0.0) for km in row] for row in lane_km]
 
-            # If too many invalid coords, skip TSP and default to input order
-            invalid_count = sum(1 for (lat, lon) in coords if lat is None or lon is None)
+            # If too many unresolved addresses, skip TSP and default to input order
+            invalid_count = len(unresolved)
             if invalid_count > 0 and invalid_count >= len(coords) - 1:
                 app.logger.warning(f"Too many invalid coords for indent {indent_id}, skipping TSP")
                 auto_route = all_addresses
                 total_distance = 0.0
+                duration_hours = None
                 est_arrival = [exit_time_ist] * len(all_addresses)
             else:
-                auto_route_index = solve_tsp(dist_matrix)
+                auto_route_index = solve_tsp(dist_matrix, budget.share(len(rows) - position))
                 if auto_route_index:
                     auto_route = [all_addresses[i] for i in auto_route_index]
                     total_distance = round(calculate_total_distance(auto_route_index, dist_matrix), 2)
 
-                    # Build cumulative ETA list aligned with auto_route
+                    # Build cumulative ETA list aligned with auto_route: road engine
+                    # drive times where it has them, else 40 km/h over the lane km
+                    road_hours = road_engine.leg_hours([coords[i] for i in auto_route_index])
                     est_arrival = [exit_time_ist]  # pickup first
                     cumulative_hours = 0.0
                     # iterate pairs over the route indices
@@ -1476,16 +1416,20 @@ def optimize():
                         from_idx = auto_route_index[j]
                         to_idx = auto_route_index[j+1]
                         dist_km = dist_matrix[from_idx][to_idx]
-                        travel_hours = (dist_km / 40.0) if dist_km else 0.0
+                        travel_hours = road_hours[j]
+                        if travel_hours is None:
+                            travel_hours = (dist_km / 40.0) if dist_km else 0.0
                         cumulative_hours += travel_hours
                         eta = exit_time + timedelta(hours=cumulative_hours)
                         eta_ist = eta.astimezone(ist)
                         est_arrival.append(eta_ist)
+                    duration_hours = cumulative_hours
                 else:
                     # fallback: no TSP solution
                     app.logger.warning(f"No TSP route for indent {indent_id}; using input order")
                     auto_route = all_addresses
                     total_distance = 0.0
+                    duration_hours = None
                     est_arrival = [exit_time_ist] * len(all_addresses)
 
             app.logger.info(f"Indent {indent_id} total_distance = {total_distance} km; route len={len(auto_route)}")
@@ -1498,7 +1442,8 @@ def optimize():
                 drops=drops,
                 total_distance=total_distance,
                 est_arrival=est_arrival[-1] if est_arrival else exit_time_ist,
-                exit_time=exit_time
+                exit_time=exit_time,
+                duration_hours=duration_hours
             )
 
             indents_data.append({
@@ -1513,7 +1458,6 @@ def optimize():
             })
 
         cursor.close()
-        conn.close()
         return render_template("route_optimize.html", indents_data=indents_data)
 
     except Exception as e:
@@ -1523,6 +1467,38 @@ def optimize():
 
 # -------- Trip History --------
 
+# Trips with no recorded distance fall back to the sum of their lanes, leg by
+# leg (pickup -> first drop -> next drop), splitting drop_location like
+# split_drops(); any unknown leg leaves the distance empty.
+TRIP_HISTORY_SQL = """
+    SELECT
+        t.indent_id, t.vehicle_no, t.driver_name,
+        t.pickup, t.drop_location, t.total_drops,
+        t.exit_time, t.eta_arrival_time, t.actual_arrival_time,
+        COALESCE(NULLIF(t.total_distance, 0), legs.distance_km) AS total_distance,
+        t.duration_hours, t.customer_details,
+        t.pod_url, t.created_at, i.customer_name
+    FROM trip_data t
+    LEFT JOIN indents i
+        ON t.indent_id = i.indent
+    LEFT JOIN LATERAL (
+        SELECT CASE WHEN COUNT(l.distance_km) = COUNT(*) THEN SUM(l.distance_km) END AS distance_km
+        FROM (
+            SELECT btrim(d.stop) AS stop,
+                   lag(btrim(d.stop), 1, t.pickup) OVER (ORDER BY d.n) AS origin
+            FROM unnest(string_to_array(t.drop_location, ',')) WITH ORDINALITY AS d(stop, n)
+            WHERE btrim(d.stop) <> ''
+        ) leg
+        LEFT JOIN lanes l
+            ON l.pickup_location = leg.origin AND l.drop_location = leg.stop
+    ) legs ON TRUE
+    WHERE 1=1
+"""
+register_query('trip_history', TRIP_HISTORY_SQL + """
+    AND t.exit_time >= %s AND t.exit_time < %s::date + 1
+    ORDER BY t.indent_id, t.id DESC
+""", ('2024-01-01', '2024-01-31'))
+
 
 @app.route('/trip-history', methods=['GET'])
 def trip_history():
@@ -1532,22 +1508,11 @@ def trip_history():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     # Main query: fetch trips with customer info
-    query = """
-        SELECT
-            t.indent_id, t.vehicle_no, t.driver_name,
-            t.pickup, t.drop_location, t.total_drops,
-            t.exit_time, t.eta_arrival_time, t.actual_arrival_time,
-            t.total_distance, t.duration_hours, t.customer_details,
-            t.pod_url, t.created_at, i.customer_name
-        FROM trip_data t
-        LEFT JOIN indents i
-            ON t.indent_id = i.indent
-        WHERE 1=1
-    """
+    query = TRIP_HISTORY_SQL
     params = []
 
     if vehicle_filter:
@@ -1557,7 +1522,8 @@ def trip_history():
         query += " AND t.indent_id=%s"
         params.append(indent_filter)
     if start_date and end_date:
-        query += " AND DATE(t.exit_time) BETWEEN %s AND %s"
+        # Half-open range keeps the exit_time index usable (no DATE() wrapper)
+        query += " AND t.exit_time >= %s AND t.exit_time < %s::date + 1"
         params.extend([start_date, end_date])
 
     query += " ORDER BY t.indent_id, t.id DESC"
@@ -1620,7 +1586,6 @@ def trip_history():
         }
 
     cursor.close()
-    conn.close()
 
     # Convert dict values to list for template
     trips = list(trips_dict.values())
@@ -1636,7 +1601,7 @@ def update_trip():
     actual_arrival_time = data.get("actual_arrival_time")
     pod_url = data.get("pod_url")
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
         UPDATE trip_data
@@ -1647,7 +1612,6 @@ def update_trip():
     """, (actual_arrival_time, pod_url, trip_id))
     conn.commit()
     cursor.close()
-    conn.close()
     return jsonify({"status": "success", "message": "Trip updated successfully"})
 
 @app.route('/tracking')
@@ -1,7 +1,6 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file,flash,jsonify,make_response
+from flask import Flask, render_template, request, redirect, url_for, session, send_file,flash,jsonify
 import pandas as pd
 import os
-import io
 from decimal import Decimal
 from collections import defaultdict
 import requests
@@ -14,16 +13,37 @@ from werkzeug.utils import secure_filename
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
 import folium
 
 from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
 
 import uuid
 from datetime import datetime,date, timedelta
 
+import database
+import migrations
+import query_advisor
+import fleet_cache
+import financials
+import lanes
+import geocoding
+import gazetteer
+import geocode_queue
+import site_matrix
+import road_engine
+import fleet_routing
+from database import get_db, indent_date_filters, indent_list_filters, INDENT_LIST_COLUMNS, order_list_filters
+from pagination import keyset_page, page_size, jsonable_row
+from query_advisor import register_query
+from fleet_cache import get_fleet, invalidate_fleet
+from financials import LANE_JOIN_SQL, TRIP_KM_SQL, refresh_days, refresh_vehicle
+from distances import point_distances
+from fleet_routing import solve_fleet, solver_options
+from gazetteer import lookup as gazetteer_lookup
+from geocode_queue import INDENT, enqueue as enqueue_geocode
+from streaming import csv_copy_response
+from ingest import validate_indents, bulk_insert_indents, upsert_orders, save_order, ORDER_CHUNK_ROWS, ORDER_COLUMNS
+
 
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -66,16 +86,19 @@ db_config = {
     'port': 5432
 }
 
-# Connect to the PostgreSQL database
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=db_config['host'],
-        user=db_config['user'],
-        password=db_config['password'],
-        dbname=db_config['database'],
-        port=db_config['port']
-    )
-    return conn
+# One pooled connection per request, checked out lazily via get_db()
+database.init_app(app, db_config)
+migrations.init_app(app)
+query_advisor.init_app(app)
+fleet_cache.init_app(app)
+financials.init_app(app)
+lanes.init_app(app)
+geocoding.init_app(app)
+gazetteer.init_app(app)
+geocode_queue.init_app(app)
+site_matrix.init_app(app)
+road_engine.init_app(app)
+fleet_routing.init_app(app)
 
 @app.route('/', methods=['GET', 'POST'])
 def auth():
@@ -88,12 +111,11 @@ def auth():
             username = request.form['username']
             password = request.form['password']
 
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor(cursor_factory=RealDictCursor)
             cursor.execute('SELECT * FROM users_tms WHERE username = %s', (username,))
             user = cursor.fetchone()
             cursor.close()
-            conn.close()
 
             if user:
                 stored_password = user['password']
@@ -111,14 +133,13 @@ def auth():
             email = request.form['email']
             password = request.form['password']
 
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor(cursor_factory=RealDictCursor)
             cursor.execute('SELECT * FROM users_tms WHERE username = %s', (username,))
             existing_user = cursor.fetchone()
 
             if existing_user:
                 cursor.close()
-                conn.close()
                 return render_template('login_signup.html', error='Username already exists', form_type='signup')
             else:
                 hashed_password = generate_password_hash(password)
@@ -128,7 +149,6 @@ def auth():
                 )
                 conn.commit()
                 cursor.close()
-                conn.close()
                 session['user'] = username
                 return redirect(url_for('dashboard'))
 
@@ -156,11 +176,7 @@ def fleet_master():
     if 'user' not in session:
         session['user'] = 'Admin'  # Temporary session for demo
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM fleet ORDER BY vehicle_id")
-    rows = cursor.fetchall()
+    rows = get_fleet().records
 
     fleet_data = [{
         'vehicle_id': row[0],
@@ -181,9 +197,6 @@ def fleet_master():
         'avg': row[15] if row[15] is not None else 0
     } for row in rows]
 
-    cursor.close()
-    conn.close()
-
     return render_template('fleet_master.html', data=fleet_data, user=session['user'])
 
 
@@ -193,7 +206,7 @@ def add_vehicle():
     form = request.form
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute("""
@@ -220,8 +233,10 @@ def add_vehicle():
             datetime.strptime(form['date_of_join'], '%Y-%m-%d'),
             float(form.get('avg') or 0)
         ))
+        refresh_vehicle(cursor, form['vehicle_id'])
 
         conn.commit()
+        invalidate_fleet()
         flash('Vehicle added successfully!', 'success')
 
     except psycopg2.IntegrityError:
@@ -232,7 +247,6 @@ def add_vehicle():
         flash(f'Error: {str(e)}', 'danger')
     finally:
         cursor.close()
-        conn.close()
 
     return redirect('/fleet_master')
 
@@ -240,7 +254,7 @@ def add_vehicle():
 # Edit Vehicle
 @app.route('/fleet_master/edit/<vehicle_id>', methods=['GET', 'POST'])
 def edit_vehicle(vehicle_id):
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     if request.method == 'POST':
@@ -294,8 +308,10 @@ def edit_vehicle(vehicle_id):
                 float(form.get('avg') or 0),
                 vehicle_id
             ))
+            refresh_vehicle(cursor, vehicle_id)
 
             conn.commit()
+            invalidate_fleet()
             flash('Vehicle updated successfully!', 'success')
             return redirect('/fleet_master')
 
@@ -308,7 +324,6 @@ def edit_vehicle(vehicle_id):
     cursor.execute("SELECT * FROM fleet WHERE vehicle_id = %s", (vehicle_id,))
     row = cursor.fetchone()
     cursor.close()
-    conn.close()
 
     if not row:
         flash('Vehicle not found.', 'warning')
@@ -345,7 +360,7 @@ def driver_master():
     if 'user' not in session:
         return redirect('/')
 
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     if request.method == 'POST':
@@ -390,7 +405,6 @@ def driver_master():
     data = [dict(zip(colnames, row)) for row in rows]
 
     cur.close()
-    conn.close()
 
     return render_template('driver_master.html', data=data)
 
@@ -557,87 +571,51 @@ def issue_management():
 
 
 # --------- ORDER MANAGEMENT -----------
+ORDER_LIST_SQL = "SELECT " + ", ".join(ORDER_COLUMNS) + " FROM orders"
+
+
 @app.route('/orders', methods=['GET', 'POST'])
 def orders():
+    """Order list (one keyset page at a time) plus the add/update form."""
     if 'user' not in session:
         return redirect('/')
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    want_json = request.args.get("format") == "json" or request.accept_mimetypes.best == "application/json"
+    conn = get_db()
 
     if request.method == 'POST':
-        data = request.form
-        order_id = data['order_id']
-
-        # Check if order exists
-        cur.execute("SELECT 1 FROM orders WHERE order_id = %s", (order_id,))
-        exists = cur.fetchone()
-
-        if exists:
-            # Update existing order
-            cur.execute("""
-                UPDATE orders SET
-                    customer_name = %s,
-                    created_date  = %s,
-                    order_type = %s,
-                    pickup_location_latlon = %s,
-                    drop_location_latlon = %s,
-                    volume_cbm = %s,
-                    weight_kg = %s,
-                    delivery_priority = %s,
-                    expected_delivery = %s,
-                    amount = %s,
-                    status = %s
-                WHERE order_id = %s
-            """, (
-                data['customer_name'],
-                data['created_date'],
-                data['order_type'],
-                data['pickup_location_latlon'],
-                data['drop_location_latlon'],
-                data['volume_cbm'],
-                data['weight_kg'],
-                data['delivery_priority'],
-                data['expected_delivery'],
-                data['amount'],
-                data['status'],
-                order_id
-            ))
-        else:
-            # Insert new order
-            cur.execute("""
-                INSERT INTO orders (
-                    order_id, customer_name, created_date, order_type, pickup_location_latlon,
-                    drop_location_latlon, volume_cbm, weight_kg,
-                    delivery_priority, expected_delivery, amount, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                data['order_id'],
-                data['customer_name'],
-                data['created_date'],
-                data['order_type'],
-                data['pickup_location_latlon'],
-                data['drop_location_latlon'],
-                data['volume_cbm'],
-                data['weight_kg'],
-                data['delivery_priority'],
-                data['expected_delivery'],
-                data['amount'],
-                data['status']
-            ))
-
-        conn.commit()
+        try:
+            order, inserted = save_order(conn, request.form)
+        except Exception as e:
+            conn.rollback()
+            if want_json:
+                return jsonify({'error': str(e)}), 400
+            flash(f"Error saving order: {e}", "danger")
+            return redirect(url_for('orders'))
 
-    # Fetch all orders
-    cur.execute("SELECT * FROM orders ORDER BY expected_delivery")
-    rows = cur.fetchall()
-    colnames = [desc[0] for desc in cur.description]
-    data = [dict(zip(colnames, row)) for row in rows]
+        if want_json:
+            return jsonify({'order': jsonable_row(order), 'inserted': inserted}), 201 if inserted else 200
+        flash(f"Order {order['order_id']} {'added' if inserted else 'updated'}.", "success")
+        return redirect(url_for('orders'))
 
+    filters, params, active_filters = order_list_filters(request.args)
+    cur = conn.cursor()
+    rows, next_cursor, prev_cursor = keyset_page(
+        cur, ORDER_LIST_SQL, filters, params, active_filters['sort'], 'order_id',
+        direction=active_filters['dir'].upper(), cursor=request.args.get('cursor'),
+        limit=page_size(request.args.get('limit'))
+    )
     cur.close()
-    conn.close()
+    data = [dict(zip(ORDER_COLUMNS, row)) for row in rows]
 
-    return render_template('orders.html', data=data)
+    if want_json:
+        return jsonify({
+            'orders': [jsonable_row(row) for row in data],
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+        })
+    return render_template('orders.html', data=data, filters=active_filters,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 
 @app.route('/delete_order/<order_id>', methods=['POST'])
@@ -646,7 +624,7 @@ def delete_order(order_id):
         return redirect('/')
 
     try:
-        conn = get_db_connection()
+        conn = get_db()
         cur = conn.cursor()
         cur.execute("DELETE FROM orders WHERE order_id = %s", (order_id,))
         conn.commit()
@@ -655,7 +633,6 @@ def delete_order(order_id):
         print("Error deleting order:", e)
     finally:
         cur.close()
-        conn.close()
 
     return redirect('/orders')
 @app.route('/upload_orders', methods=['POST'])
@@ -665,41 +642,13 @@ def upload_orders():
 
     file = request.files['orders_file']
     if file and file.filename.endswith('.csv'):
-        import pandas as pd
-        df = pd.read_csv(file)
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        for _, row in df.iterrows():
-            cur.execute("""
-                INSERT INTO orders (
-                    order_id, customer_name, created_date, order_type, pickup_location_latlon,
-                    drop_location_latlon, volume_cbm, weight_kg,
-                    delivery_priority, expected_delivery, amount, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (order_id) DO UPDATE SET
-                    customer_name = EXCLUDED.customer_name,
-                    created_date = EXCLUDED.created_date,
-                    order_type = EXCLUDED.order_type,
-                    pickup_location_latlon = EXCLUDED.pickup_location_latlon,
-                    drop_location_latlon = EXCLUDED.drop_location_latlon,
-                    volume_cbm = EXCLUDED.volume_cbm,
-                    weight_kg = EXCLUDED.weight_kg,
-                    delivery_priority = EXCLUDED.delivery_priority,
-                    expected_delivery = EXCLUDED.expected_delivery,
-                    amount = EXCLUDED.amount,
-                    status = EXCLUDED.status
-            """, (
-                row['Order_ID'], row['Customer_Name'], row['created_date'], row['Order_Type'],
-                row['Pickup_Location_LatLon'], row['Drop_Location_LatLon'],
-                row['Volume_CBM'], row['Weight_KG'],
-                row['Delivery_Priority'], row['Expected_Delivery'], row['amount'],
-                row['Status']
-            ))
-
-        conn.commit()
-        cur.close()
-        conn.close()
+        # Chunked COPY + one set-based upsert per chunk (see ingest.upsert_orders)
+        chunks = pd.read_csv(file, dtype=str, keep_default_na=False, chunksize=ORDER_CHUNK_ROWS)
+        counts, rejections = upsert_orders(get_db(), chunks)
+        flash(f"Orders uploaded: {counts['inserted']} inserted, {counts['updated']} updated, "
+              f"{counts['unchanged']} unchanged.", 'success')
+        if rejections:
+            flash(f"{len(rejections)} cell(s) rejected in the upload.", 'warning')
 
     return redirect('/orders')
 
@@ -728,7 +677,34 @@ city_coords = {
 }
 
 def geocode_address(addr):
-    return city_coords.get(str(addr).strip().title(), (0.0, 0.0))
+    return gazetteer_lookup(addr) or city_coords.get(str(addr).strip().title(), (0.0, 0.0))
+
+def with_stored_coords(order_df):
+    """
+    Pending orders that `flask geocode-worker` has located, with pickup_latlon /
+    drop_latlon tuples from the stored columns; the rest wait for the worker
+    and are flashed by order_id so the dispatcher sees them left out.
+    """
+    located = order_df['pickup_lat'].notna() & order_df['drop_lat'].notna()
+    if not located.all():
+        waiting = order_df.loc[~located, 'order_id'].astype(str).tolist()
+        app.logger.warning(f"{len(waiting)} pending orders have no coordinates yet; skipped")
+        shown = ', '.join(waiting[:20]) + (f" and {len(waiting) - 20} more" if len(waiting) > 20 else '')
+        flash(f"{len(waiting)} pending order(s) not routed, waiting on the geocoder: {shown}", 'warning')
+    order_df = order_df[located].reset_index(drop=True)
+    order_df['pickup_latlon'] = list(zip(order_df['pickup_lat'], order_df['pickup_lon']))
+    order_df['drop_latlon'] = list(zip(order_df['drop_lat'], order_df['drop_lon']))
+    return order_df
+
+def route_hours(points):
+    """Road engine drive hours along points in order, or None unless it knows every leg."""
+    legs = road_engine.leg_hours(points)
+    return sum(legs) if legs and None not in legs else None
+
+# Literal status so the planner can match the partial idx_orders_pending index
+PENDING_ORDERS_SQL = register_query('pending_orders', """
+    SELECT * FROM orders WHERE status = 'Pending' ORDER BY expected_delivery
+""")
 
 # ------------- ROUTE OPTIMIZATION -------------
 @app.route('/optimize', methods=['GET'])
@@ -736,16 +712,14 @@ def optimize():
     if 'user' not in session:
         return redirect('/')
 
-    conn = get_db_connection()
+    conn = get_db()
 
     fleet_df = pd.read_sql('SELECT * FROM fleet', conn)
-    order_df = pd.read_sql("SELECT * FROM orders WHERE status='Pending'", conn)
+    order_df = pd.read_sql(PENDING_ORDERS_SQL, conn)
     driver_df = pd.read_sql('SELECT * FROM driver_master', conn)
-    conn.close()
 
-    # Enrich data with lat/lon
-    order_df['pickup_latlon'] = order_df['pickup_location_latlon'].apply(geocode_address)
-    order_df['drop_latlon'] = order_df['drop_location_latlon'].apply(geocode_address)
+    # Lat/lon stored at write time
+    order_df = with_stored_coords(order_df)
 
     fleet_df['Current_Location_LatLon'] = fleet_df['driver_id'].map(
         lambda did: geocode_address(driver_df[driver_df['driver_id'] == did]['address'].values[0])
@@ -757,19 +731,8 @@ def optimize():
     fleet_locations = list(zip(fleet_df['Current_Lat'], fleet_df['Current_Lon']))
     drop_locations = list(order_df['drop_latlon'])
     locations = fleet_locations + drop_locations
-
-    def compute_distance_matrix(locations):
-        distances = {}
-        for i, from_loc in enumerate(locations):
-            distances[i] = {}
-            for j, to_loc in enumerate(locations):
-                if i == j:
-                    distances[i][j] = 0
-                else:
-                    distances[i][j] = int(geodesic(from_loc, to_loc).km * 1000)
-        return distances
-
-    distance_matrix = compute_distance_matrix(locations)
+    driver_addresses = fleet_df['driver_id'].map(driver_df.set_index('driver_id')['address'])
+    addresses = list(driver_addresses) + list(order_df['drop_location_latlon'])
 
     num_vehicles = len(fleet_df)
     vehicle_capacities_weight = fleet_df['capacity_weight_kg'].astype(int).tolist()
@@ -778,32 +741,12 @@ def optimize():
     demands_weight = [0] * num_vehicles + order_df['weight_kg'].astype(int).tolist()
     demands_volume = [0] * num_vehicles + order_df['volume_cbm'].astype(int).tolist()
 
-    starts = list(range(num_vehicles))
-    ends = list(range(num_vehicles))
-
-    manager = pywrapcp.RoutingIndexManager(len(locations), num_vehicles, starts, ends)
-    routing = pywrapcp.RoutingModel(manager)
-
-    def distance_callback(from_index, to_index):
-        return distance_matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-    demand_weight_callback_index = routing.RegisterUnaryTransitCallback(
-        lambda from_index: demands_weight[manager.IndexToNode(from_index)]
-    )
-    routing.AddDimensionWithVehicleCapacity(demand_weight_callback_index, 0, vehicle_capacities_weight, True, 'Weight')
-
-    demand_volume_callback_index = routing.RegisterUnaryTransitCallback(
-        lambda from_index: demands_volume[manager.IndexToNode(from_index)]
-    )
-    routing.AddDimensionWithVehicleCapacity(demand_volume_callback_index, 0, vehicle_capacities_volume, True, 'Volume')
-
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-
-    solution = routing.SolveWithParameters(search_parameters)
+    # Dense matrix for small fleets, a kNN arc graph past ROUTE_SPARSE_MIN_NODES
+    solution = solve_fleet(addresses, locations, num_vehicles, demands_weight, demands_volume,
+                           vehicle_capacities_weight, vehicle_capacities_volume, solver_options(request.args))
+    if len(locations) > app.config['ROUTE_MAX_NODES']:
+        flash(f"{len(order_df)} pending orders and {num_vehicles} vehicles are more than one request can route "
+              f"(ROUTE_MAX_NODES {app.config['ROUTE_MAX_NODES']}).", 'warning')
     routes_info = []
 
     # --- Helper Functions ---
@@ -819,9 +762,10 @@ def optimize():
     def estimate_fuel_consumption(distance_km, efficiency=0.2):
         return distance_km * efficiency
 
-    def calculate_delivery_window(distance_km):
+    def calculate_delivery_window(distance_km, road_hours=None):
         now = datetime.now()
-        travel_hours = estimate_travel_time_km(distance_km)
+        # Road engine drive time when every leg has one, else the 40 km/h estimate
+        travel_hours = road_hours if road_hours is not None else estimate_travel_time_km(distance_km)
         rest_hours = calculate_rest_time(distance_km)
         total_hours = travel_hours + rest_hours
         end_time = now + timedelta(hours=total_hours)
@@ -829,14 +773,9 @@ def optimize():
 
     # --- Process Solution ---
     if solution:
+        routes, route_meters = solution
         for vehicle_id in range(num_vehicles):
-            index = routing.Start(vehicle_id)
-            route = []
-            while not routing.IsEnd(index):
-                node_index = manager.IndexToNode(index)
-                route.append(node_index)
-                index = solution.Value(routing.NextVar(index))
-            route.append(manager.IndexToNode(index))
+            route = routes[vehicle_id]
 
             route_locations = [locations[i] for i in route]
             assigned_orders = [order_df.iloc[i - num_vehicles]['order_id'] for i in route if i >= num_vehicles]
@@ -853,12 +792,10 @@ def optimize():
 
             folium.PolyLine(locations=route_locations, color='blue', weight=3).add_to(m)
 
-            total_distance = sum(
-                geodesic(route_locations[i], route_locations[i + 1]).km
-                for i in range(len(route_locations) - 1)
-            )
+            total_distance = route_meters[vehicle_id] / 1000
 
-            window_start, window_end, total_time_hrs = calculate_delivery_window(total_distance)
+            window_start, window_end, total_time_hrs = calculate_delivery_window(
+                total_distance, route_hours(route_locations))
             fuel_eff = fleet_df.iloc[vehicle_id].get('fuel_efficiency_l_per_km', 0.2)
             fuel_used = estimate_fuel_consumption(total_distance, fuel_eff)
 
@@ -910,7 +847,7 @@ def save_manual_route():
 #     if 'user' not in session:
 #         return redirect('/')
 #
-#     conn = get_db_connection()
+#     conn = get_db()
 #
 #     fleet_df = pd.read_sql('SELECT * FROM fleet', conn)
 #     orders_df = pd.read_sql("SELECT * FROM orders WHERE status='Delivered'", conn)
@@ -1018,6 +955,10 @@ city_coords = {
 def geocode_address(addr):
     if not addr:
         return (0.0, 0.0)
+    # Offline gazetteer first; the static table covers boxes without one.
+    coords = gazetteer_lookup(addr)
+    if coords:
+        return coords
     addr = str(addr).strip().title()
     return city_coords.get(addr, (0.0, 0.0))
 
@@ -1025,12 +966,11 @@ def get_coords(addr):
     # Return lat, lon tuple from address string (for orders pickup/drop)
     return geocode_address(addr)
 
-def get_optimized_routes():
-    conn = get_db_connection()
+def get_optimized_routes(options=None):
+    conn = get_db()
     fleet_df = pd.read_sql('SELECT * FROM fleet', conn)
-    order_df = pd.read_sql("SELECT * FROM orders WHERE status='Pending'", conn)
+    order_df = pd.read_sql(PENDING_ORDERS_SQL, conn)
     drivers_df = pd.read_sql('SELECT * FROM driver_master', conn)
-    conn.close()
 
     # Add current driver location lat/lon in fleet_df
     def get_driver_addr(driver_id):
@@ -1046,23 +986,10 @@ def get_optimized_routes():
 
     # Location lists: fleet driver starts + order drop locations
     fleet_locations = list(zip(fleet_df['Current_Lat'], fleet_df['Current_Lon']))
-    order_df['pickup_latlon'] = order_df['pickup_location_latlon'].map(geocode_address)
-    order_df['drop_latlon'] = order_df['drop_location_latlon'].map(geocode_address)
+    order_df = with_stored_coords(order_df)
     drop_locations = list(order_df['drop_latlon'])
     locations = fleet_locations + drop_locations
-
-    def compute_distance_matrix(locations):
-        distances = {}
-        for i, from_loc in enumerate(locations):
-            distances[i] = {}
-            for j, to_loc in enumerate(locations):
-                if i == j:
-                    distances[i][j] = 0
-                else:
-                    distances[i][j] = int(geodesic(from_loc, to_loc).km * 1000)
-        return distances
-
-    distance_matrix = compute_distance_matrix(locations)
+    addresses = list(fleet_df['driver_address']) + list(order_df['drop_location_latlon'])
 
     num_vehicles = len(fleet_df)
     vehicle_cap_weight = fleet_df['capacity_weight_kg'].astype(int).tolist()
@@ -1071,34 +998,15 @@ def get_optimized_routes():
     demands_weight = [0]*num_vehicles + order_df['weight_kg'].astype(int).tolist()
     demands_volume = [0]*num_vehicles + order_df['volume_cbm'].astype(int).tolist()
 
-    starts = list(range(num_vehicles))
-    ends = list(range(num_vehicles))
-
-    manager = pywrapcp.RoutingIndexManager(len(locations), num_vehicles, starts, ends)
-    routing = pywrapcp.RoutingModel(manager)
-
-    def distance_callback(from_index, to_index):
-        return distance_matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-    demand_weight_callback_index = routing.RegisterUnaryTransitCallback(
-        lambda from_index: demands_weight[manager.IndexToNode(from_index)]
-    )
-    routing.AddDimensionWithVehicleCapacity(demand_weight_callback_index, 0, vehicle_cap_weight, True, 'Weight')
-
-    demand_volume_callback_index = routing.RegisterUnaryTransitCallback(
-        lambda from_index: demands_volume[manager.IndexToNode(from_index)]
-    )
-    routing.AddDimensionWithVehicleCapacity(demand_volume_callback_index, 0, vehicle_cap_volume, True, 'Volume')
-
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-
-    solution = routing.SolveWithParameters(search_parameters)
+    # Dense matrix for small fleets, a kNN arc graph past ROUTE_SPARSE_MIN_NODES
+    solution = solve_fleet(addresses, locations, num_vehicles, demands_weight, demands_volume,
+                           vehicle_cap_weight, vehicle_cap_volume, options)
+    if len(locations) > app.config['ROUTE_MAX_NODES']:
+        flash(f"{len(order_df)} pending orders and {num_vehicles} vehicles are more than one request can route "
+              f"(ROUTE_MAX_NODES {app.config['ROUTE_MAX_NODES']}).", 'warning')
     if not solution:
         return []
+    routes, route_meters = solution
 
     # Helper functions
     def estimate_travel_time_km(distance_km):
@@ -1110,33 +1018,29 @@ def get_optimized_routes():
     def estimate_fuel_consumption(distance_km, fuel_efficiency=0.2):
         return distance_km * fuel_efficiency
 
-    def calculate_delivery_window(distance_km):
+    def calculate_delivery_window(distance_km, road_hours=None):
         now = datetime.now()
-        travel_hrs = estimate_travel_time_km(distance_km)
+        # Road engine drive time when every leg has one, else the 40 km/h estimate
+        travel_hrs = road_hours if road_hours is not None else estimate_travel_time_km(distance_km)
         rest_hrs = calculate_rest_time(distance_km)
         total_hrs = travel_hrs + rest_hrs
         return now.strftime('%I:%M %p'), (now + timedelta(hours=total_hrs)).strftime('%I:%M %p'), total_hrs
 
     routes_info = []
+    # Pickup -> drop km of every order in one pass
+    order_df['trip_km'] = point_distances(order_df['pickup_latlon'], order_df['drop_latlon'], method='geodesic') / 1000
 
     for vehicle_id in range(num_vehicles):
-        index = routing.Start(vehicle_id)
-        route = []
-        while not routing.IsEnd(index):
-            route.append(manager.IndexToNode(index))
-            index = solution.Value(routing.NextVar(index))
-        route.append(manager.IndexToNode(index))
+        route = routes[vehicle_id]
 
         assigned_orders_idx = [i for i in route if i >= num_vehicles]
         assigned_orders = order_df.iloc[
             [i - num_vehicles for i in assigned_orders_idx]] if assigned_orders_idx else pd.DataFrame()
 
-        total_distance = 0
-        for i in range(len(route) - 1):
-            total_distance += geodesic(locations[route[i]], locations[route[i + 1]]).km
-        total_distance = round(total_distance, 2)
+        total_distance = round(route_meters[vehicle_id] / 1000, 2)
 
-        window_start, window_end, total_time_hrs = calculate_delivery_window(total_distance)
+        window_start, window_end, total_time_hrs = calculate_delivery_window(
+            total_distance, route_hours([locations[i] for i in route]))
 
         fuel_efficiency = fleet_df.loc[
             vehicle_id, 'fuel_efficiency_l_per_km'] if 'fuel_efficiency_l_per_km' in fleet_df.columns else 0.2
@@ -1150,8 +1054,7 @@ def get_optimized_routes():
 
         # Assigned orders route detail rows
         for _, order in assigned_orders.iterrows():
-            dist_km = round(
-                geodesic(get_coords(order['pickup_location_latlon']), get_coords(order['drop_location_latlon'])).km, 2)
+            dist_km = round(order['trip_km'], 2)
             expected_avg = fleet_df.loc[vehicle_id, 'avg'] if 'avg' in fleet_df.columns else 12
             fuel_used_l = round(dist_km / expected_avg, 2) if expected_avg > 0 else 0
             fuel_cost = round(fuel_used_l * 100, 2)  # Assume fuel cost = ₹100 per liter
@@ -1223,7 +1126,7 @@ def get_optimized_routes():
 
 @app.route('/trip-history')
 def trip_history():
-    routes = get_optimized_routes()
+    routes = get_optimized_routes(solver_options(request.args))
     if not routes:
         return "No routes found"
 
@@ -1235,20 +1138,9 @@ def tracking():
     return render_template('tracking.html')
 
 
-def calculate_distance(pickup, drop):
-    """
-    A simple placeholder function to calculate distance.
-    In a real application, you would use a geocoding API for this.
-    """
-    # For demonstration, we'll return a hardcoded value based on range
-    if (pickup == 'Sonipat' and drop == 'Delhi') or (pickup == 'Delhi' and drop == 'Sonipat'):
-        return 80  # Example distance
-    return 150  # Default distance
-
-
 @app.route('/financial')
 def financial():
-    conn = get_db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     # Define a fixed fuel price and a placeholder for fuel efficiency
@@ -1264,7 +1156,8 @@ def financial():
     misc_cost_per_trip = Decimal('50.0')  # Example: 50 Rs per trip
 
     # 🧾 Updated Query to get all required columns (mm.per_km_fuel_cost, mm.driver_salary, mm.toll_tax, mm.misc_cost and mm.criteria removed)
-    query = """
+    # Lane km joined from the lanes table (DEFAULT_LANE_KM until a lane is filled); nothing is geocoded here
+    query = f"""
     SELECT
         f.vehicle_id,
         f.driver_id,
@@ -1280,9 +1173,11 @@ def financial():
         i.load_per_bucket,
         mm.transport_rate,
         mm.loading_rate,
-        mm.unloading_rate
+        mm.unloading_rate,
+        {TRIP_KM_SQL} AS trip_km
     FROM fleet f
     LEFT JOIN indents i ON f.vehicle_id = i.vehicle_number
+    {LANE_JOIN_SQL}
     LEFT JOIN master_model mm ON i.range = mm.range AND f.model = mm.product
     WHERE i.indent_date IS NOT NULL
     """
@@ -1306,8 +1201,7 @@ def financial():
         no_of_buckets = Decimal(data.get('no_of_buckets', 0) or 0)
         load_per_bucket = Decimal(data.get('load_per_bucket', 0) or 0)
 
-        # Calculate distance dynamically
-        total_km = Decimal(calculate_distance(data['pickup_location'], data['drop_location']))
+        total_km = Decimal(str(data['trip_km']))
 
         transport_rate = Decimal(data.get('transport_rate', 0) or 0)
         loading_rate = Decimal(data.get('loading_rate', 0) or 0)
@@ -1354,19 +1248,16 @@ def financial():
         summary[data['driver_id']]['orders'] += 1 if data['lr_no'] else 0
 
         cur.close()
-        conn.close()
 
     return render_template("financial_dashboard.html", routes=routes, summary=summary)
 
 
 def get_all_vehicle_numbers():
-    """Retrieves all valid vehicle numbers from the fleet table for the dropdown."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT license_plate FROM fleet")
-    rows = cursor.fetchall()
-    conn.close()
-    return [row[0] for row in rows] # Returns a list of strings
+    """Valid vehicle numbers (license plates) as a frozenset, served from the fleet snapshot."""
+    return get_fleet().plates
+
+# id is selected last for the keyset tiebreak; zip(INDENT_LIST_COLUMNS, row) drops it.
+INDENT_LIST_SQL = "SELECT " + ", ".join(f'"{c}"' for c in INDENT_LIST_COLUMNS) + ", id FROM indents"
 
 @app.route("/def", methods=["GET", "POST"])
 def def_page():
@@ -1375,7 +1266,7 @@ def def_page():
     Handles form submissions for new indents and renders the main page.
     """
     valid_vehicles = get_all_vehicle_numbers()
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     if request.method == "POST":
@@ -1389,11 +1280,12 @@ def def_page():
                 # Insert the new indent into the database
                 cursor.execute("""
                     INSERT INTO indents (
-                        indent_date, indent, allocation_date, customer_name, range,
+                        indent_date, indent, allocation_date, customer_name, "range",
                         pickup_location, location, vehicle_number, vehicle_model,
                         vehicle_based, lr_no, material, load_per_bucket, no_of_buckets,
                         t_load, pod_received, freight_tiger_number, freight_tiger_month
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
                 """, (
                     new_indent.get("indent_date"),
                     new_indent.get("indent"),
@@ -1414,6 +1306,10 @@ def def_page():
                     new_indent.get("freight_tiger_number"),
                     new_indent.get("freight_tiger_month")
                 ))
+                new_id = cursor.fetchone()[0]
+                refresh_days(cursor, [(vehicle_no, new_indent.get("indent_date"))])
+                # Coordinates are filled in by `flask geocode-worker`
+                enqueue_geocode(cursor, INDENT, [new_id])
                 conn.commit()
                 flash("New indent created successfully!", "success")
             except Exception as e:
@@ -1421,18 +1317,19 @@ def def_page():
                 flash(f"Error creating indent: {str(e)}", "danger")
 
         cursor.close()
-        conn.close()
         return redirect(url_for("def_page"))
 
-    # Fetch all indents for the GET request
-    cursor.execute("SELECT * FROM indents")
-    rows = cursor.fetchall()
-    col_names = [desc[0] for desc in cursor.description]
-    indent_data = [dict(zip(col_names, row)) for row in rows]
-
-    conn.close()
+    # Fetch one page of indents for the GET request (keyset on indent_date, id)
+    filters, params, active_filters = indent_list_filters(request.args)
+    rows, next_cursor, prev_cursor = keyset_page(
+        cursor, INDENT_LIST_SQL, filters, params, 'indent_date', 'id',
+        cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit'))
+    )
+    indent_data = [dict(zip(INDENT_LIST_COLUMNS, row)) for row in rows]
+    cursor.close()
 
-    return render_template("def.html", indent_data=indent_data, fleet_data=valid_vehicles)
+    return render_template("def.html", indent_data=indent_data, fleet_data=get_fleet().plate_list,
+                           filters=active_filters, next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 
 @app.route("/upload_indent", methods=["POST"])
@@ -1448,9 +1345,9 @@ def upload_indent():
     try:
         filename = file.filename
         if filename.endswith(".csv"):
-            df = pd.read_csv(file)
+            df = pd.read_csv(file, dtype=str, keep_default_na=False)
         elif filename.endswith((".xlsx", ".xls")):
-            df = pd.read_excel(file)
+            df = pd.read_excel(file, dtype=str)
         else:
             flash("Unsupported file format.", "danger")
             return redirect(url_for("def_page"))
@@ -1464,39 +1361,19 @@ def upload_indent():
             flash("Missing 'vehicle_number' column.", "danger")
             return redirect(url_for("def_page"))
 
-        # Filter valid and invalid entries
-        valid_df = df[df["vehicle_number"].isin(valid_vehicles)]
-        invalid_df = df[~df["vehicle_number"].isin(valid_vehicles)]
-
-        conn = get_db_connection()
+        # Validate column-wise, then COPY the good rows in one set-based merge
+        valid_df, rejections = validate_indents(df, valid_vehicles)
 
         if not valid_df.empty:
-            records = valid_df.to_dict(orient="records")
-            for row in records:
-                conn.execute("""
-                    INSERT INTO indents (
-                        indent_date, indent, allocation_date, customer_name, range,
-                        pickup_location, location, vehicle_number, vehicle_model,
-                        vehicle_based, lr_no, material, load_per_bucket, no_of_buckets,
-                        t_load, pod_received, freight_tiger_number, freight_tiger_month
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    row.get("indent_date"), row.get("indent"), row.get("allocation_date"),
-                    row.get("customer_name"), row.get("range"), row.get("pickup_location"),
-                    row.get("location"), row.get("vehicle_number"), row.get("vehicle_model"),
-                    row.get("vehicle_based"), row.get("lr_no"), row.get("material"),
-                    row.get("load_per_bucket"), row.get("no_of_buckets"), row.get("t_load"),
-                    row.get("pod_received"), row.get("freight_tiger_number"), row.get("freight_tiger_month")
-                ))
-            conn.commit()
-            flash(f"{len(records)} valid indent(s) uploaded successfully!", "success")
-
-        if not invalid_df.empty:
-            flash(f"{len(invalid_df)} row(s) skipped due to invalid vehicle numbers.", "warning")
+            inserted = bulk_insert_indents(get_db(), valid_df)
+            flash(f"{inserted} valid indent(s) uploaded successfully!", "success")
 
-        conn.close()
+        if rejections:
+            details = "; ".join(f"row {r['row']} {r['column']}: {r['reason']}" for r in rejections[:10])
+            flash(f"{len(df) - len(valid_df)} row(s) skipped: {details}", "warning")
 
     except Exception as e:
+        get_db().rollback()
         flash(f"Error processing file: {str(e)}", "danger")
 
     return redirect(url_for("def_page"))
@@ -1504,34 +1381,35 @@ def upload_indent():
 
 @app.route("/export_indents")
 def export_indents():
-    """Exports all indents to a downloadable CSV file."""
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM indents", conn)
-    conn.close()
+    """Streams indents as CSV (optionally filtered and gzipped) via COPY TO STDOUT."""
+    start_date = request.args.get("start_date", "").strip()
+    end_date = request.args.get("end_date", "").strip()
+    vehicle = request.args.get("vehicle", "").strip()
+    compress = request.args.get("gzip", "") in ("1", "true", "yes")
 
-    # Create an in-memory file for CSV data
-    output = io.StringIO()
-    df.to_csv(output, index=False)
+    filters, params = indent_date_filters(start_date, end_date)
+    if vehicle:
+        filters.append("vehicle_number = %s")
+        params.append(vehicle)
 
-    # Create the response
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=indents.csv"
-    response.headers["Content-type"] = "text/csv"
+    query = "SELECT * FROM indents"
+    if filters:
+        query += " WHERE " + " AND ".join(filters)
+    query += " ORDER BY id"
 
-    return response
+    return csv_copy_response(get_db(), query, params, "indents.csv", compress=compress)
 
 
 
 @app.route("/master_model")
 def master_model():
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM master_model")
     rows = cursor.fetchall()
     col_names = [desc[0] for desc in cursor.description]
     master_data = [dict(zip(col_names, row)) for row in rows]
     cursor.close()
-    conn.close()
     return render_template("master_model.html", rows=master_data)
 
 
@@ -1546,7 +1424,7 @@ def add_row():
         "modified_by": "Admin"
     }
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT INTO master_model (range, product, transport_rate, loading_rate, unloading_rate, modified_by)
@@ -1561,7 +1439,6 @@ def add_row():
     ))
     conn.commit()
     cursor.close()
-    conn.close()
 
     flash("New business plan added successfully!", "success")
     return redirect(url_for("master_model"))
@@ -0,0 +1,257 @@
+"""
+PostgreSQL connection pooling shared by app.py and app1.py.
+
+Each gunicorn worker lazily builds its own pool (pools are never shared
+across a fork). A request checks out at most one connection, keeps it on
+``flask.g`` and hands it back to the pool on app-context teardown.
+"""
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions, pool as pg_pool
+from flask import g, current_app, jsonify
+
+# -------------------------- Pool State --------------------------
+
+_pool = None
+_pool_pid = None
+_slots = None
+_lock = threading.Lock()
+_last_used = {}
+
+_stats = {
+    'checkouts': 0,
+    'waits': 0,
+    'timeouts': 0,
+    'discarded': 0,
+    'wait_seconds_total': 0.0,
+    'checkout_seconds_total': 0.0,
+    'checkout_seconds_max': 0.0,
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within DB_POOL_TIMEOUT."""
+
+
+def init_app(app, db_config):
+    """Registers pool settings, teardown handling and the metrics endpoint."""
+    app.config.setdefault('DB_CONFIG', db_config)
+    app.config.setdefault('DB_POOL_MIN', int(os.environ.get('DB_POOL_MIN', 1)))
+    app.config.setdefault('DB_POOL_MAX', int(os.environ.get('DB_POOL_MAX', 5)))
+    app.config.setdefault('DB_POOL_TIMEOUT', float(os.environ.get('DB_POOL_TIMEOUT', 10)))
+    # Connections idle for longer than this are pinged before being handed out.
+    app.config.setdefault('DB_POOL_PING_AFTER', float(os.environ.get('DB_POOL_PING_AFTER', 30)))
+
+    app.teardown_appcontext(release_db)
+    app.add_url_rule('/metrics/db_pool', 'db_pool_metrics', db_pool_metrics)
+
+
+def _get_pool():
+    """Returns this process's pool, creating it after a fork if needed."""
+    global _pool, _pool_pid, _slots
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _lock:
+        if _pool is None or _pool_pid != pid:
+            cfg = current_app.config['DB_CONFIG']
+            maxconn = current_app.config['DB_POOL_MAX']
+            _pool = pg_pool.ThreadedConnectionPool(
+                current_app.config['DB_POOL_MIN'],
+                maxconn,
+                host=cfg['host'],
+                user=cfg['user'],
+                password=cfg['password'],
+                dbname=cfg['database'],
+                port=cfg['port']
+            )
+            _slots = threading.BoundedSemaphore(maxconn)
+            _pool_pid = pid
+            _last_used.clear()
+    return _pool
+
+
+def _is_healthy(conn):
+    """Cheap liveness check; only pings connections that sat idle for a while."""
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < current_app.config['DB_POOL_PING_AFTER']:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout():
+    started = time.monotonic()
+    db_pool = _get_pool()
+
+    if not _slots.acquire(blocking=False):
+        _stats['waits'] += 1
+        if not _slots.acquire(timeout=current_app.config['DB_POOL_TIMEOUT']):
+            _stats['timeouts'] += 1
+            raise PoolTimeout('Timed out waiting for a database connection')
+        _stats['wait_seconds_total'] += time.monotonic() - started
+
+    try:
+        conn = db_pool.getconn()
+        while not _is_healthy(conn):
+            _stats['discarded'] += 1
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+
+    elapsed = time.monotonic() - started
+    _stats['checkouts'] += 1
+    _stats['checkout_seconds_total'] += elapsed
+    _stats['checkout_seconds_max'] = max(_stats['checkout_seconds_max'], elapsed)
+    return conn
+
+
+def get_db():
+    """Returns the connection checked out for the current request."""
+    if 'db' not in g:
+        g.db = _checkout()
+    return g.db
+
+
+def release_db(exc=None):
+    """Rolls back any open transaction and returns the connection to the pool."""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+
+    broken = conn.closed != 0
+    if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+
+    if broken:
+        _stats['discarded'] += 1
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+
+    try:
+        _pool.putconn(conn, close=broken)
+    finally:
+        _slots.release()
+
+
+# -------------------------- Query Helpers --------------------------
+
+def indent_date_filters(start_date, end_date, column='indent_date'):
+    """Builds sargable, parameterized date-range clauses for an indents query."""
+    if start_date and end_date:
+        return [f"{column} BETWEEN %s AND %s"], [start_date, end_date]
+    if start_date:
+        return [f"{column} >= %s"], [start_date]
+    if end_date:
+        return [f"{column} <= %s"], [end_date]
+    return [], []
+
+
+# Columns rendered by the /def indent table (id is only used as the page key).
+INDENT_LIST_COLUMNS = [
+    'indent_date', 'indent', 'allocation_date', 'customer_name', 'range',
+    'pickup_location', 'location', 'vehicle_number', 'vehicle_model',
+    'vehicle_based', 'lr_no', 'material', 'load_per_bucket', 'no_of_buckets',
+    't_load', 'pod_received', 'freight_tiger_number', 'freight_tiger_month',
+    'loading_time', 'parking_time', 'exit_time', 'status',
+]
+INDENT_LIST_STATUSES = ('loading', 'parking', 'exit')
+
+
+def indent_list_filters(args):
+    """
+    Builds the /def list filters from request args.
+    Returns (clauses, params, active) where active echoes the applied filters.
+    """
+    active = {
+        'vehicle': (args.get('vehicle') or '').strip(),
+        'customer': (args.get('customer') or '').strip(),
+        'status': (args.get('status') or '').strip().lower(),
+        'start_date': args.get('start_date') or '',
+        'end_date': args.get('end_date') or '',
+    }
+    clauses, params = indent_date_filters(active['start_date'], active['end_date'])
+    if active['vehicle']:
+        clauses.append("vehicle_number = %s")
+        params.append(active['vehicle'])
+    if active['customer']:
+        clauses.append("customer_name ILIKE %s")
+        params.append(f"%{active['customer']}%")
+    if active['status'] == 'pending':
+        clauses.append("status IS NULL")
+    elif active['status'] in INDENT_LIST_STATUSES:
+        clauses.append("status = %s")
+        params.append(active['status'])
+    else:
+        active['status'] = ''
+    return clauses, params, active
+
+
+# /orders sort options; each one is backed by an index ending in order_id.
+ORDER_LIST_SORTS = ('expected_delivery', 'created_date', 'order_id')
+
+
+def order_list_filters(args):
+    """
+    Builds the /orders list filters and sort from request args.
+    Returns (clauses, params, active); active['sort'] / active['dir'] are always valid.
+    """
+    active = {
+        'status': (args.get('status') or '').strip(),
+        'priority': (args.get('priority') or '').strip(),
+        'customer': (args.get('customer') or '').strip(),
+        'start_date': args.get('start_date') or '',
+        'end_date': args.get('end_date') or '',
+        'sort': args.get('sort') if args.get('sort') in ORDER_LIST_SORTS else 'expected_delivery',
+        'dir': 'desc' if (args.get('dir') or '').lower() == 'desc' else 'asc',
+    }
+    clauses, params = indent_date_filters(active['start_date'], active['end_date'], column='expected_delivery')
+    if active['status']:
+        clauses.append("status = %s")
+        params.append(active['status'])
+    if active['priority']:
+        clauses.append("delivery_priority = %s")
+        params.append(active['priority'])
+    if active['customer']:
+        clauses.append("customer_name ILIKE %s")
+        params.append(f"%{active['customer']}%")
+    return clauses, params, active
+
+
+# -------------------------- Metrics --------------------------
+
+def pool_stats():
+    """Snapshot of pool size, wait and checkout-latency counters for this worker."""
+    stats = dict(_stats)
+    checkouts = stats['checkouts'] or 1
+    waits = stats['waits'] or 1
+    stats.update({
+        'pid': os.getpid(),
+        'max_size': current_app.config['DB_POOL_MAX'],
+        'open': len(_pool._pool) + len(_pool._used) if _pool is not None and _pool_pid == os.getpid() else 0,
+        'in_use': len(_pool._used) if _pool is not None and _pool_pid == os.getpid() else 0,
+        'wait_seconds_avg': stats['wait_seconds_total'] / waits,
+        'checkout_seconds_avg': stats['checkout_seconds_total'] / checkouts,
+    })
+    return stats
+
+
+def db_pool_metrics():
+    return jsonify(pool_stats())
@@ -0,0 +1,256 @@
+"""
+Vectorized distance matrices for the route optimizers.
+
+distance_matrix() turns a list of (lat, lon) points into a C-contiguous
+int32 matrix of metres in one broadcast NumPy pass (row blocks bound the
+temporaries), ready for OR-Tools, which only takes integer arc costs.
+Two methods:
+
+    'haversine'  great circle on a 6371 km sphere (what app.py used)
+    'geodesic'   Vincenty's inverse formula on the WGS-84 ellipsoid,
+                 iterated over whole arrays; within a millimetre of
+                 geopy's geodesic(), which app1 called per cell
+
+Other modules can register a provider for another method (road_engine
+adds 'road'); cells it cannot answer fall back to the great circle.
+
+Points that are missing, non-finite, out of range or (0, 0) (the
+placeholder geocode_address() returns for unknown places) are masked:
+their rows and columns get invalid_cost and the mask is returned so
+callers can report them.
+"""
+import math
+import time
+
+import click
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+# WGS-84
+_WGS84_A = 6378137.0
+_WGS84_F = 1 / 298.257223563
+_WGS84_B = (1 - _WGS84_F) * _WGS84_A
+VINCENTY_MAX_ITER = 200
+VINCENTY_TOLERANCE = 1e-12
+
+# Rows per block: block_rows x n float64 temporaries stay around 100 MB for 10k points.
+BLOCK_ROWS = 1024
+
+METHODS = ('haversine', 'geodesic')
+
+# name -> (fn(starts, ends) -> float64 metres with NaN where unknown, symmetric)
+_providers = {}
+
+
+def init_app(app):
+    app.cli.add_command(distance_benchmark_command)
+
+
+def coords_array(coords):
+    """
+    (lat, lon) degrees as an (n, 2) float64 array plus a validity mask;
+    None entries and (None, None) pairs become NaN and are masked. A float
+    array (such as the points this returns) is taken as is, without a
+    per-point Python pass.
+    """
+    if isinstance(coords, np.ndarray) and coords.dtype.kind == 'f':
+        points = coords.astype(np.float64, copy=False).reshape(-1, 2)
+    else:
+        points = np.array([(np.nan, np.nan) if c is None else
+                           tuple(np.nan if v is None else v for v in c) for c in coords],
+                          dtype=np.float64).reshape(-1, 2)
+    lat, lon = points[:, 0], points[:, 1]
+    valid = (np.isfinite(points).all(axis=1)
+             & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+             & ~((lat == 0) & (lon == 0)))
+    return points, valid
+
+
+# -------------------------- Kernels --------------------------
+# Broadcasting kernels over radians; return metres as float64.
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _vincenty_m(lat1, lon1, lat2, lon2):
+    f = _WGS84_F
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    big_l = (lon2 - lon1) + np.zeros_like(lat1 + lat2)
+    lam = big_l
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(VINCENTY_MAX_ITER):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            # Coincident points: sin_sigma == 0.
+            sin_alpha = np.where(sin_sigma > 0, cos_u1 * cos_u2 * sin_lam / sin_sigma, 0.0)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines: cos2_alpha == 0.
+            cos_2sm = np.where(cos2_alpha > 0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha, 0.0)
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = big_l + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (2 * cos_2sm ** 2 - 1)))
+            # Pairs with a NaN end stay NaN; counting them as converged keeps them from
+            # running every other pair through all VINCENTY_MAX_ITER iterations.
+            converged = (np.abs(lam - previous) <= VINCENTY_TOLERANCE) | np.isnan(lam)
+            if converged.all():
+                break
+
+        u_sq = cos2_alpha * (_WGS84_A ** 2 - _WGS84_B ** 2) / _WGS84_B ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sm + big_b / 4 * (
+            cos_sigma * (2 * cos_2sm ** 2 - 1)
+            - big_b / 6 * cos_2sm * (4 * sin_sigma ** 2 - 3) * (4 * cos_2sm ** 2 - 3)))
+        meters = _WGS84_B * big_a * (sigma - delta_sigma)
+
+    # Nearly antipodal pairs do not converge; the sphere is within 0.5% there.
+    if not converged.all():
+        meters = np.where(converged, meters, _haversine_m(lat1, lon1, lat2, lon2))
+    return meters
+
+
+_KERNELS = {'haversine': _haversine_m, 'geodesic': _vincenty_m}
+
+
+def register_provider(name, fn, symmetric=False):
+    """
+    Adds a matrix method: fn gets (k, 2) and (m, 2) float64 (lat, lon) arrays
+    of valid points and returns a k x m float64 matrix of metres, NaN where
+    it has no answer.
+    """
+    _providers[name] = (fn, symmetric)
+
+
+def methods():
+    """Every usable method name: the built-in kernels and registered providers."""
+    return METHODS + tuple(sorted(_providers))
+
+
+def is_symmetric(method):
+    """Whether a -> b always equals b -> a (not so along one-way roads)."""
+    return method in _KERNELS or _providers[method][1]
+
+
+def _kernel(method):
+    if method not in _KERNELS:
+        raise ValueError(f"Unknown distance method {method!r}; use one of {', '.join(methods())}")
+    return _KERNELS[method]
+
+
+# -------------------------- Matrices --------------------------
+
+def cross_matrix(starts, ends, method='haversine', invalid_cost=0, block_rows=BLOCK_ROWS):
+    """
+    len(starts) x len(ends) matrix of metres as C-contiguous int32, plus the
+    two validity masks; cells touching an invalid point hold invalid_cost.
+    """
+    kernel = None if method in _providers else _kernel(method)
+    a, valid_a = coords_array(starts)
+    b, valid_b = coords_array(ends)
+    matrix = np.full((len(a), len(b)), invalid_cost, dtype=np.int32)
+    rows_index, cols_index = np.flatnonzero(valid_a), np.flatnonzero(valid_b)
+    if kernel is None and len(rows_index) and len(cols_index):
+        meters = _providers[method][0](a[rows_index], b[cols_index])
+        missing = np.isnan(meters)
+        if missing.any():
+            i, j = np.nonzero(missing)
+            pa, pb = np.radians(a[rows_index[i]]), np.radians(b[cols_index[j]])
+            meters[i, j] = _haversine_m(pa[:, 0], pa[:, 1], pb[:, 0], pb[:, 1])
+        matrix[np.ix_(rows_index, cols_index)] = np.rint(meters)
+    elif len(rows_index) and len(cols_index):
+        lat_a, lon_a = np.radians(a[rows_index, 0]), np.radians(a[rows_index, 1])
+        lat_b, lon_b = np.radians(b[cols_index, 0])[np.newaxis, :], np.radians(b[cols_index, 1])[np.newaxis, :]
+        columns = cols_index[np.newaxis, :]
+        for start in range(0, len(rows_index), block_rows):
+            rows = slice(start, start + block_rows)
+            meters = kernel(lat_a[rows, np.newaxis], lon_a[rows, np.newaxis], lat_b, lon_b)
+            matrix[rows_index[rows, np.newaxis], columns] = np.rint(meters)
+    return matrix, valid_a, valid_b
+
+
+def distance_matrix(coords, method='haversine', invalid_cost=0, block_rows=BLOCK_ROWS):
+    """
+    Full n x n matrix of metres between coords as C-contiguous int32.
+    Returns (matrix, valid); rows and columns of invalid points hold
+    invalid_cost and the diagonal is 0.
+    """
+    matrix, valid, _ = cross_matrix(coords, coords, method, invalid_cost, block_rows)
+    np.fill_diagonal(matrix, 0)
+    return matrix, valid
+
+
+def point_distances(starts, ends, method='haversine'):
+    """Metres between starts[i] and ends[i] as float64; NaN where either end is invalid."""
+    kernel = _kernel(method)
+    a, valid_a = coords_array(starts)
+    b, valid_b = coords_array(ends)
+    a, b = np.radians(a), np.radians(b)
+    with np.errstate(invalid='ignore'):
+        meters = kernel(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+    return np.where(valid_a & valid_b, meters, np.nan)
+
+
+def route_length(matrix, route):
+    """Sum of matrix arcs along a route of node indices, in the matrix's units."""
+    route = np.asarray(route, dtype=np.intp)
+    if len(route) < 2:
+        return 0
+    return int(np.asarray(matrix)[route[:-1], route[1:]].astype(np.int64).sum())
+
+
+# -------------------------- Benchmark --------------------------
+
+def _loop_matrix(points, method):
+    """The per-cell Python loop the optimizers used to run (km, like before)."""
+    n = len(points)
+    if method == 'geodesic':
+        from geopy.distance import geodesic
+        cell = lambda p, q: geodesic(p, q).km
+    else:
+        def cell(p, q):
+            phi1, phi2 = math.radians(p[0]), math.radians(q[0])
+            a = (math.sin((phi2 - phi1) / 2) ** 2
+                 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(q[1] - p[1]) / 2) ** 2)
+            return EARTH_RADIUS_M / 1000 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return [[0.0 if i == j else cell(points[i], points[j]) for j in range(n)] for i in range(n)]
+
+
+@click.command('distance-benchmark')
+@click.option('--points', default=1000, show_default=True, help='Random points for the vectorized matrix.')
+@click.option('--loop-points', default=200, show_default=True,
+              help='Points for the per-cell loop (it is much slower); results are cross-checked on these.')
+@click.option('--method', type=click.Choice(METHODS), default='haversine', show_default=True)
+def distance_benchmark_command(points, loop_points, method):
+    """Compares distance_matrix() with the per-cell loop on random points in India."""
+    rng = np.random.default_rng(7)
+    coords = list(zip(rng.uniform(8, 35, points).tolist(), rng.uniform(68, 97, points).tolist()))
+
+    started = time.perf_counter()
+    matrix, _ = distance_matrix(coords, method=method)
+    seconds = time.perf_counter() - started
+    click.echo(f"vectorized: {points:>6,} points ({points * points:,} cells) in {seconds * 1000:.1f} ms")
+
+    loop_points = min(loop_points, points)
+    started = time.perf_counter()
+    expected = _loop_matrix(coords[:loop_points], method)
+    loop_seconds = time.perf_counter() - started
+    click.echo(f"loop:       {loop_points:>6,} points ({loop_points * loop_points:,} cells) in {loop_seconds:.2f} s")
+    per_cell = (loop_seconds / loop_points ** 2) / (seconds / points ** 2)
+    click.echo(f"speedup:    {per_cell:.0f}x per cell")
+
+    # int32 metres are rounded, so allow the half metre plus float noise.
+    worst = float(np.max(np.abs(matrix[:loop_points, :loop_points] - np.array(expected) * 1000)))
+    if worst > 1.0:
+        raise click.ClickException(f"Vectorized matrix differs from the loop by up to {worst:.2f} m")
+    click.echo(f"agreement:  within {worst:.3f} m of the loop on all {loop_points * loop_points:,} cells")
@@ -0,0 +1,181 @@
+"""
+Trip P&L rules and the vehicle_daily_financials rollup.
+
+The rollup holds one row per (vehicle_id, day) with that day's trip totals.
+Every code path that writes indents refreshes the (vehicle, day) keys it
+touched inside its own transaction, so the dashboard can aggregate at most
+days x fleet-size rollup rows instead of scanning raw indents.
+"""
+from decimal import Decimal
+
+import click
+
+from database import get_db, indent_date_filters
+
+# -------------------------- Trip P&L Rules --------------------------
+
+FUEL_PRICE_PER_LITER = Decimal('96.0')
+FUEL_EFFICIENCY_KMPL = Decimal('12.0')
+TOLL_TAX_PER_TRIP = Decimal('100.0')
+MISC_COST_PER_TRIP = Decimal('50.0')
+COST_PER_KM_FUEL = FUEL_PRICE_PER_LITER / FUEL_EFFICIENCY_KMPL
+FIXED_COST_PER_TRIP = TOLL_TAX_PER_TRIP + MISC_COST_PER_TRIP
+
+# Trip kilometres for lanes the lanes table does not know yet.
+DEFAULT_LANE_KM = 150
+
+# SQL fragments over `indents i` joined to `fleet f` and LANE_JOIN_SQL; NULL inputs count as 0.
+LANE_JOIN_SQL = "LEFT JOIN lanes l ON l.pickup_location = i.pickup_location AND l.drop_location = i.location"
+TRIP_LOAD_SQL = "COALESCE(i.no_of_buckets, 0) * COALESCE(i.load_per_bucket, 0)"
+TRIP_REVENUE_SQL = f"{TRIP_LOAD_SQL} * COALESCE(f.avg, 0)"
+TRIP_KM_SQL = f"COALESCE(l.distance_km, {DEFAULT_LANE_KM})"
+TRIP_FUEL_COST_SQL = f"({TRIP_KM_SQL}) * {COST_PER_KM_FUEL}"
+# An indent's free-text "range" ("120", "100-120", "0-100Km") is parsed once,
+# on write, into the generated columns indents.range_min_km / range_max_km.
+# Anything else leaves both NULL (it counts as 0 distance).
+RANGE_PATTERN = r"^\s*[0-9]+(\.[0-9]+)?(\s*-\s*[0-9]+(\.[0-9]+)?)?\s*(km|kms)?\s*$"
+RANGE_MIN_KM_SQL = rf"""
+    CASE WHEN "range" ~* '{RANGE_PATTERN}'
+         THEN substring("range" from '^\s*([0-9]+(?:\.[0-9]+)?)')::numeric END
+"""
+RANGE_MAX_KM_SQL = rf"""
+    CASE WHEN "range" ~* '{RANGE_PATTERN}'
+         THEN substring("range" from '([0-9]+(?:\.[0-9]+)?)[^0-9]*$')::numeric END
+"""
+
+# -------------------------- Rollup Maintenance --------------------------
+
+ROLLUP_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS vehicle_daily_financials (
+        vehicle_id VARCHAR(50) NOT NULL,
+        day DATE NOT NULL,
+        trips INTEGER NOT NULL,
+        completed_trips INTEGER NOT NULL,
+        total_load NUMERIC(14, 2) NOT NULL,
+        revenue NUMERIC(14, 2) NOT NULL,
+        fuel_cost NUMERIC(14, 2) NOT NULL,
+        fixed_cost NUMERIC(14, 2) NOT NULL,
+        range_distance NUMERIC(14, 2) NOT NULL,
+        updated_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (vehicle_id, day)
+    )
+"""
+
+# {keys} is a relation of (vehicle_id, day) pairs to recompute.
+_ROLLUP_UPSERT_SQL = f"""
+    INSERT INTO vehicle_daily_financials (
+        vehicle_id, day, trips, completed_trips, total_load, revenue,
+        fuel_cost, fixed_cost, range_distance, updated_at
+    )
+    SELECT
+        i.vehicle_number,
+        i.indent_date,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE i.status = 'exit'),
+        SUM({TRIP_LOAD_SQL}),
+        SUM({TRIP_REVENUE_SQL}),
+        SUM({TRIP_FUEL_COST_SQL}),
+        COUNT(*) * {FIXED_COST_PER_TRIP},
+        COALESCE(SUM(i.range_max_km), 0),
+        NOW()
+    FROM indents i
+    LEFT JOIN fleet f ON f.vehicle_id = i.vehicle_number
+    {LANE_JOIN_SQL}
+    WHERE (i.vehicle_number, i.indent_date) IN (SELECT vehicle_id, day FROM {{keys}})
+    GROUP BY i.vehicle_number, i.indent_date
+    ON CONFLICT (vehicle_id, day) DO UPDATE SET
+        trips = EXCLUDED.trips,
+        completed_trips = EXCLUDED.completed_trips,
+        total_load = EXCLUDED.total_load,
+        revenue = EXCLUDED.revenue,
+        fuel_cost = EXCLUDED.fuel_cost,
+        fixed_cost = EXCLUDED.fixed_cost,
+        range_distance = EXCLUDED.range_distance,
+        updated_at = EXCLUDED.updated_at
+"""
+
+# Keys whose last indent was deleted or moved to another day.
+_ROLLUP_PRUNE_SQL = """
+    DELETE FROM vehicle_daily_financials r
+    WHERE (r.vehicle_id, r.day) IN (SELECT vehicle_id, day FROM {keys})
+      AND NOT EXISTS (
+          SELECT 1 FROM indents i
+          WHERE i.vehicle_number = r.vehicle_id AND i.indent_date = r.day
+      )
+"""
+
+_KEYS_PARAM_SQL = "unnest(%s::varchar[], %s::date[]) AS k(vehicle_id, day)"
+_ALL_KEYS_SQL = "(SELECT DISTINCT vehicle_number AS vehicle_id, indent_date AS day FROM indents{where}) AS k"
+
+# Full refill with the current rules. Changing them means appending a migration
+# step that runs this; shipped steps keep their own copy.
+BACKFILL_SQL = _ROLLUP_UPSERT_SQL.format(keys=_ALL_KEYS_SQL.format(where=""))
+
+
+def refresh_days(cur, keys):
+    """
+    Recomputes the rollup rows for an iterable of (vehicle_id, day) pairs.
+    Runs on the caller's cursor so it commits with the indent write.
+    """
+    keys = {(vehicle, day) for vehicle, day in keys if vehicle and day}
+    if not keys:
+        return 0
+    vehicles, days = zip(*keys)
+    params = (list(vehicles), list(days))
+    cur.execute(_ROLLUP_UPSERT_SQL.format(keys=_KEYS_PARAM_SQL), params)
+    cur.execute(_ROLLUP_PRUNE_SQL.format(keys=_KEYS_PARAM_SQL), params)
+    return len(keys)
+
+
+def refresh_from_table(cur, table):
+    """Recomputes the rollup for every (vehicle_number, indent_date) present in table."""
+    keys = f"(SELECT DISTINCT vehicle_number AS vehicle_id, indent_date AS day FROM {table}) AS k"
+    cur.execute(_ROLLUP_UPSERT_SQL.format(keys=keys))
+    cur.execute(_ROLLUP_PRUNE_SQL.format(keys=keys))
+
+
+def refresh_vehicle(cur, vehicle_id):
+    """Recomputes every day of one vehicle (its fleet avg feeds revenue)."""
+    keys = "(SELECT vehicle_number AS vehicle_id, indent_date AS day FROM indents WHERE vehicle_number = %s) AS k"
+    cur.execute(_ROLLUP_UPSERT_SQL.format(keys=keys), (vehicle_id,))
+
+
+def refresh_lane(cur, pickup, drop):
+    """Recomputes every day with a trip on one lane (its distance feeds fuel cost)."""
+    keys = ("(SELECT vehicle_number AS vehicle_id, indent_date AS day FROM indents"
+            " WHERE pickup_location = %s AND location = %s) AS k")
+    cur.execute(_ROLLUP_UPSERT_SQL.format(keys=keys), (pickup, drop))
+
+
+def _where_sql(clauses):
+    return (" WHERE " + " AND ".join(clauses)) if clauses else ""
+
+
+def rebuild(conn, start_date=None, end_date=None):
+    """Recomputes the rollup from scratch, optionally for a date window only."""
+    day_where, params = indent_date_filters(start_date, end_date, column='day')
+    indent_where, _ = indent_date_filters(start_date, end_date)
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM vehicle_daily_financials" + _where_sql(day_where), params)
+    keys = _ALL_KEYS_SQL.format(where=_where_sql(indent_where))
+    cur.execute(_ROLLUP_UPSERT_SQL.format(keys=keys), params)
+    rows = cur.rowcount
+    conn.commit()
+    cur.close()
+    return rows
+
+
+# -------------------------- CLI --------------------------
+
+def init_app(app):
+    app.cli.add_command(rollup_rebuild_command)
+
+
+@click.command('rollup-rebuild')
+@click.option('--start', 'start_date', default=None, help='First day to rebuild (YYYY-MM-DD).')
+@click.option('--end', 'end_date', default=None, help='Last day to rebuild (YYYY-MM-DD).')
+def rollup_rebuild_command(start_date, end_date):
+    """Rebuilds vehicle_daily_financials from indents (backfills / rule changes)."""
+    rows = rebuild(get_db(), start_date, end_date)
+    click.echo(f"Rebuilt {rows} vehicle-day rollup rows.")
@@ -0,0 +1,103 @@
+"""
+In-process snapshot of the fleet registry.
+
+Vehicle validation (indent forms, uploads, dropdowns) reads an immutable
+snapshot instead of querying ``fleet`` on every request. Writers call
+invalidate_fleet(); the next reader reloads. Other gunicorn workers notice
+through the mtime of a stamp file under the instance folder, and a TTL
+bounds staleness after writes made outside the app.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+from database import get_db
+
+# Same order as the fleet table (fleet routes read rows positionally).
+FLEET_COLUMNS = [
+    'vehicle_id', 'vehicle_name', 'make', 'model', 'vin', 'type', 'group', 'status',
+    'license_plate', 'current_meter', 'capacity_weight_kg', 'capacity_vol_cbm',
+    'documents_expiry', 'driver_id', 'date_of_join', 'avg',
+]
+
+FleetRecord = namedtuple('FleetRecord', FLEET_COLUMNS)
+
+# ids / plates are frozensets for O(1) membership; the *_list tuples are sorted for dropdowns.
+FleetSnapshot = namedtuple('FleetSnapshot', 'version ids plates id_list plate_list records loaded_at stamp')
+
+_snapshot = None
+_version = 0
+_lock = threading.Lock()
+
+FLEET_SQL = "SELECT " + ", ".join(f'"{c}"' for c in FLEET_COLUMNS) + " FROM fleet ORDER BY vehicle_id"
+
+
+def init_app(app):
+    app.config.setdefault('FLEET_CACHE_TTL', float(os.environ.get('FLEET_CACHE_TTL', 300)))
+
+
+def _stamp_path():
+    return os.path.join(current_app.instance_path, 'fleet_cache.stamp')
+
+
+def _read_stamp():
+    try:
+        return os.stat(_stamp_path()).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _is_fresh(snapshot, stamp):
+    if snapshot is None or snapshot.stamp != stamp:
+        return False
+    return time.monotonic() - snapshot.loaded_at < current_app.config['FLEET_CACHE_TTL']
+
+
+def _load(stamp):
+    global _version
+    cur = get_db().cursor()
+    cur.execute(FLEET_SQL)
+    records = tuple(FleetRecord(*row) for row in cur.fetchall())
+    cur.close()
+
+    ids = frozenset(r.vehicle_id for r in records if r.vehicle_id)
+    plates = frozenset(r.license_plate for r in records if r.license_plate)
+    _version += 1
+    return FleetSnapshot(
+        version=_version,
+        ids=ids,
+        plates=plates,
+        id_list=tuple(sorted(ids)),
+        plate_list=tuple(sorted(plates)),
+        records=records,
+        loaded_at=time.monotonic(),
+        stamp=stamp,
+    )
+
+
+def get_fleet():
+    """Returns the current fleet snapshot, reloading it if it was invalidated or expired."""
+    global _snapshot
+    stamp = _read_stamp()
+    snapshot = _snapshot
+    if _is_fresh(snapshot, stamp):
+        return snapshot
+
+    with _lock:
+        if not _is_fresh(_snapshot, stamp):
+            _snapshot = _load(stamp)
+        return _snapshot
+
+
+def invalidate_fleet():
+    """Drops this worker's snapshot and signals the other workers to reload theirs."""
+    global _snapshot
+    with _lock:
+        _snapshot = None
+    path = _stamp_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a'):
+        os.utime(path)
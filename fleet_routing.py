@@ -0,0 +1,438 @@
+"""
+Fleet CVRP over vehicle starts plus pending orders (app1's optimizers).
+
+Small instances are solved on the full matrix as before. From
+ROUTE_SPARSE_MIN_NODES nodes on, the n^2 matrix itself is the problem, so
+only a sparse arc graph is priced and searched: every order keeps arcs to
+its ROUTE_KNN_NEIGHBORS nearest orders (in both directions) and every
+vehicle start is connected to and from every order. Neighbours come from a
+KD-tree over unit vectors (SciPy when installed, else blocked NumPy) and
+the kept arcs are priced through the site matrix. An arc off the graph
+costs as much as dropping an order (below), so the search never takes one
+and nothing outside the O(n k) graph is ever priced. NextVar domains are
+left whole: IntVar.SetValues() is O(n) per order in OR-Tools (15 s over
+10k nodes) and found the same routes.
+
+OR-Tools' first-solution heuristics strand orders on such a graph (their
+remaining neighbours are all routed), so the search starts from a greedy
+seed instead: each vehicle takes its nearest unrouted order that fits,
+through the graph where it can and by a jump arc (added to the graph)
+where it cannot. Every order is also a disjunction with a drop penalty far
+above any detour, which keeps the model solvable when the fleet cannot
+carry every order; dropped orders are logged and left out of the routes.
+
+Dense costs and all demands are handed to OR-Tools as native matrices and
+vectors (RegisterTransitMatrix / RegisterUnaryTransitVector), so the
+search never calls back into Python for them. search_parameters() bounds
+every solve. A request's time_limit (ROUTE_TIME_LIMIT_SECONDS by default,
+at most ROUTE_MAX_TIME_LIMIT_SECONDS, which stays under gunicorn's 30 s
+worker timeout) is one RouteBudget for the whole request, shared out
+across its solves.
+
+With native matrices the dense path holds up past a few hundred nodes; it
+is its n^2 build and memory that give out. In a 10 s request over random
+Delhi-NCR orders (a vehicle per 100) it routed 0.7% shorter than the graph
+at 1000 nodes and 2.6% shorter at 2000, but took 273 MB against 156 MB and 454 MB against
+198 MB, and at 3000 nodes the matrix alone took 13 s, leaving no solution.
+Hence ROUTE_SPARSE_MIN_NODES = 1000. The graph build and greedy seed still
+grow with vehicles x orders (every depot arc is priced), so past
+ROUTE_MAX_NODES (15000: 10 s of a 25 s budget left to search; at 20000 the
+build and seed alone took 23 s) solve_fleet() refuses rather than run into
+the worker timeout.
+``flask route-benchmark`` times Python callbacks against native matrices.
+"""
+import math
+import os
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+
+from distances import coords_array, distance_matrix, route_length
+from lanes import ROAD_DETOUR_FACTOR, ROAD_METHODS, haversine_km
+from site_matrix import matrix_method, site_arc_costs, site_distance_matrix
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # blocked NumPy search instead
+    cKDTree = None
+
+# Rows per block in the NumPy neighbour search (block x n float64 temporaries).
+KNN_BLOCK_ROWS = 1024
+
+# Dropping an order costs this many times the longest priced arc.
+DROP_PENALTY_ARCS = 100
+
+
+def init_app(app):
+    # Dense stays ahead on route length up to ~2000 nodes but needs ~2x the memory (module docstring)
+    app.config.setdefault('ROUTE_SPARSE_MIN_NODES', int(os.environ.get('ROUTE_SPARSE_MIN_NODES', 1000)))
+    # Graph build plus seed grow with vehicles x orders: past ~15k nodes they outlast a 25 s budget
+    app.config.setdefault('ROUTE_MAX_NODES', int(os.environ.get('ROUTE_MAX_NODES', 15000)))
+    app.config.setdefault('ROUTE_KNN_NEIGHBORS', int(os.environ.get('ROUTE_KNN_NEIGHBORS', 20)))
+    app.config.setdefault('ROUTE_TIME_LIMIT_SECONDS', float(os.environ.get('ROUTE_TIME_LIMIT_SECONDS', 10)))
+    # Whole-request search budget; keep it below the gunicorn worker timeout (30 s by default)
+    app.config.setdefault('ROUTE_MAX_TIME_LIMIT_SECONDS', float(os.environ.get('ROUTE_MAX_TIME_LIMIT_SECONDS', 25)))
+    app.config.setdefault('ROUTE_SOLUTION_LIMIT', int(os.environ.get('ROUTE_SOLUTION_LIMIT', 0)))
+    app.config.setdefault('ROUTE_GUIDED_LOCAL_SEARCH',
+                          os.environ.get('ROUTE_GUIDED_LOCAL_SEARCH', '') in ('1', 'true', 'yes'))
+    app.cli.add_command(route_benchmark_command)
+
+
+# -------------------------- Search parameters --------------------------
+
+def positive_seconds(value):
+    """value as a positive, finite number of seconds, else None."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if math.isfinite(seconds) and seconds > 0 else None
+
+
+def solver_options(args):
+    """time_limit / solution_limit / guided overrides from request args; invalid values are ignored."""
+    options = {}
+    time_limit = positive_seconds(args.get('time_limit'))
+    if time_limit is not None:
+        options['time_limit'] = time_limit_seconds(time_limit)
+    try:
+        if args.get('solution_limit'):
+            options['solution_limit'] = int(args['solution_limit'])
+    except ValueError:
+        pass
+    if args.get('guided'):
+        options['guided'] = args['guided'] in ('1', 'true', 'yes')
+    return options
+
+
+def time_limit_seconds(time_limit=None):
+    """time_limit if positive and finite, else ROUTE_TIME_LIMIT_SECONDS; at most ROUTE_MAX_TIME_LIMIT_SECONDS."""
+    cfg = current_app.config
+    return min(positive_seconds(time_limit) or cfg['ROUTE_TIME_LIMIT_SECONDS'], cfg['ROUTE_MAX_TIME_LIMIT_SECONDS'])
+
+
+def search_parameters(time_limit=None, solution_limit=None, guided=None):
+    """
+    PATH_CHEAPEST_ARC plus the configured (or given) budget. Every search
+    gets a time limit, at most ROUTE_MAX_TIME_LIMIT_SECONDS; a time_limit
+    that is not positive and finite falls back to ROUTE_TIME_LIMIT_SECONDS.
+    """
+    cfg = current_app.config
+    time_limit = time_limit_seconds(time_limit)
+    solution_limit = cfg['ROUTE_SOLUTION_LIMIT'] if solution_limit is None else solution_limit
+    guided = cfg['ROUTE_GUIDED_LOCAL_SEARCH'] if guided is None else guided
+
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    if guided:
+        params.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    params.time_limit.FromMilliseconds(max(1, int(time_limit * 1000)))
+    if solution_limit and solution_limit > 0:
+        params.solution_limit = solution_limit
+    return params
+
+
+class RouteBudget:
+    """One request's search time (its options' time_limit), shared out across the solves it runs."""
+
+    def __init__(self, options=None):
+        self.options = dict(options or {})
+        self.deadline = time.monotonic() + time_limit_seconds(self.options.get('time_limit'))
+
+    def share(self, solves_left=1):
+        """Options for the next solve: an even share of what is left, never less than a millisecond."""
+        left = max(self.deadline - time.monotonic(), 0.001)
+        return dict(self.options, time_limit=left / max(solves_left, 1))
+
+
+def int_matrix(matrix, scale=1):
+    """Nested lists of int64 (scaled and rounded once) for RegisterTransitMatrix()."""
+    values = np.asarray(matrix, dtype=np.float64) * scale
+    return np.rint(np.nan_to_num(values)).astype(np.int64).tolist()
+
+
+# -------------------------- Neighbours --------------------------
+
+def nearest_neighbors(coords, k):
+    """(n, k) node indices of each point's k nearest others by great circle; rows of invalid points are -1."""
+    points, valid = coords_array(coords)
+    index = np.flatnonzero(valid)
+    k = max(0, min(k, len(index) - 1))
+    out = np.full((len(points), k), -1, dtype=np.intp)
+    if not k:
+        return out
+    lat, lon = np.radians(points[index, 0]), np.radians(points[index, 1])
+    xyz = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    rows = np.arange(len(index))
+
+    if cKDTree is not None:
+        # Chord length orders points like the great circle does.
+        _, found = cKDTree(xyz).query(xyz, k=k + 1)
+        found = found.reshape(len(index), k + 1)
+        # Drop each point itself (not always first when points coincide), else the farthest.
+        keep = found != rows[:, np.newaxis]
+        keep[keep.all(axis=1), -1] = False
+        found = found[keep].reshape(len(index), k)
+    else:
+        found = np.empty((len(index), k), dtype=np.intp)
+        for start in range(0, len(index), KNN_BLOCK_ROWS):
+            block = rows[start:start + KNN_BLOCK_ROWS]
+            closeness = xyz[block] @ xyz.T
+            closeness[np.arange(len(block)), block] = -np.inf
+            found[block] = np.argpartition(-closeness, k - 1, axis=1)[:, :k]
+    out[index] = index[found]
+    return out
+
+
+# -------------------------- Arc graph --------------------------
+
+class ArcGraph:
+    """Sparse arcs between route nodes with their int32 metre costs."""
+
+    def __init__(self, coords, arcs, costs, detour=1.0):
+        self.n = len(coords)
+        self.coords = [tuple(c) for c in coords_array(coords)[0].tolist()]
+        self.detour = detour
+        self.costs = [dict() for _ in range(self.n)]
+        self.add(arcs, costs)
+
+    def __len__(self):
+        return sum(len(row) for row in self.costs)
+
+    def add(self, arcs, costs):
+        # One dict.update() per tail over its slice of the arcs sorted by tail.
+        order = np.argsort(arcs[:, 0], kind='stable')
+        tails = arcs[order, 0]
+        heads, costs = arcs[order, 1].tolist(), np.asarray(costs)[order].tolist()
+        bounds = np.flatnonzero(np.diff(tails)) + 1
+        for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(tails)]):
+            if end > start:
+                self.costs[int(tails[start])].update(zip(heads[start:end], costs[start:end]))
+
+    def cost(self, tail, head):
+        cost = self.costs[tail].get(head)
+        if cost is None:
+            # Off the graph: the great circle estimate, e.g. for the seed's jump arcs.
+            km = haversine_km(*self.coords[tail], *self.coords[head])
+            # Nodes without coordinates cost 0, like in the dense matrix.
+            cost = 0 if km != km else int(round(km * 1000 * self.detour))
+        return cost
+
+    def route_length(self, route):
+        return sum(self.cost(a, b) for a, b in zip(route[:-1], route[1:]))
+
+
+def build_arc_graph(addresses, coords, num_depots, k):
+    """
+    ArcGraph over depots (the first num_depots nodes) and orders: kNN arcs
+    between orders in both directions plus every depot <-> order arc.
+    """
+    points, _ = coords_array(coords)
+    n = len(points)
+    orders = np.arange(num_depots, n)
+    depots = np.arange(num_depots)
+    neighbors = nearest_neighbors(points[num_depots:], k)
+    tails = np.repeat(orders, neighbors.shape[1])
+    heads = neighbors.ravel()
+    linked = heads >= 0
+    knn = np.column_stack([tails[linked], heads[linked] + num_depots])
+    depot_out = np.column_stack([np.repeat(depots, len(orders)), np.tile(orders, num_depots)])
+    depot_in = np.column_stack([np.tile(orders, num_depots), np.repeat(depots, len(orders))])
+    # Only kNN arcs can repeat (mutual neighbours): dedupe them on one sorted int64 key per arc.
+    keys = np.sort(np.concatenate([knn, knn[:, ::-1]]).astype(np.int64) @ np.array([n, 1]))
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    arcs = np.concatenate([np.column_stack([keys // n, keys % n]), depot_out, depot_in,
+                           np.column_stack([depots, depots])]).astype(np.intp)
+    detour = ROAD_DETOUR_FACTOR if matrix_method() in ROAD_METHODS else 1.0
+    return ArcGraph(points, arcs, site_arc_costs(addresses, points, arcs), detour)
+
+
+def greedy_routes(graph, num_vehicles, demands_weight, demands_volume, capacities_weight, capacities_volume):
+    """
+    Seed routes (order nodes per vehicle, depots excluded): each vehicle in
+    turn takes the cheapest fitting unrouted order among the graph arcs out
+    of its last stop, else the nearest fitting one anywhere. Returns (routes,
+    jumps) where jumps are the arcs used that are not in the graph.
+    """
+    points, _ = coords_array(graph.coords)
+    lat, lon = np.radians(points[:, 0]), np.radians(points[:, 1])
+    xyz = np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    xyz = np.nan_to_num(xyz)
+    unrouted = np.zeros(graph.n, dtype=bool)
+    unrouted[num_vehicles:] = True
+    weight = np.asarray(demands_weight, dtype=np.int64)
+    volume = np.asarray(demands_volume, dtype=np.int64)
+
+    routes, jumps = [], []
+    for vehicle in range(num_vehicles):
+        route, current = [], vehicle
+        room_weight, room_volume = int(capacities_weight[vehicle]), int(capacities_volume[vehicle])
+        while True:
+            step = None
+            for head in sorted(graph.costs[current], key=graph.costs[current].get):
+                if unrouted[head] and weight[head] <= room_weight and volume[head] <= room_volume:
+                    step = head
+                    break
+            if step is None:
+                fits = np.flatnonzero(unrouted & (weight <= room_weight) & (volume <= room_volume))
+                if not len(fits):
+                    break
+                # Largest dot product between unit vectors = nearest by great circle.
+                step = int(fits[np.argmax(xyz[fits] @ xyz[current])])
+                if step not in graph.costs[current]:
+                    jumps.append((current, step))
+            route.append(step)
+            unrouted[step] = False
+            room_weight -= int(weight[step])
+            room_volume -= int(volume[step])
+            current = step
+        routes.append(route)
+    return routes, np.array(jumps, dtype=np.intp).reshape(-1, 2)
+
+
+# -------------------------- Solver --------------------------
+
+def _solve(n, num_vehicles, matrix, demands_weight, demands_volume, capacities_weight, capacities_volume,
+           budget, graph=None):
+    """
+    Routes (node lists, start to end) per vehicle, or None. matrix is ignored
+    when a graph is given. The search gets what is left of the RouteBudget
+    once the model is built.
+    """
+    depots = list(range(num_vehicles))
+    manager = pywrapcp.RoutingIndexManager(n, num_vehicles, depots, depots)
+    routing = pywrapcp.RoutingModel(manager)
+
+    if graph is None:
+        transit_callback_index = routing.RegisterTransitMatrix(matrix)
+    else:
+        # The sparse graph has no matrix to hand over. The seed's jump arcs join it first.
+        seed, jumps = greedy_routes(graph, num_vehicles, demands_weight, demands_volume,
+                                    capacities_weight, capacities_volume)
+        if len(jumps):
+            graph.add(jumps, np.array([graph.cost(tail, head) for tail, head in jumps.tolist()]))
+        penalty = max(DROP_PENALTY_ARCS * max(max(row.values(), default=0) for row in graph.costs), 1)
+        nodes = [manager.IndexToNode(index) for index in range(routing.Size() + num_vehicles)]
+        costs = graph.costs
+
+        def distance_callback(from_index, to_index):
+            # Off the graph an arc costs as much as dropping an order, so no improving move takes one.
+            return costs[nodes[from_index]].get(nodes[to_index], penalty)
+
+        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    demand_weight_callback_index = routing.RegisterUnaryTransitVector([int(d) for d in demands_weight])
+    routing.AddDimensionWithVehicleCapacity(demand_weight_callback_index, 0, capacities_weight, True, 'Weight')
+
+    demand_volume_callback_index = routing.RegisterUnaryTransitVector([int(d) for d in demands_volume])
+    routing.AddDimensionWithVehicleCapacity(demand_volume_callback_index, 0, capacities_volume, True, 'Volume')
+
+    if graph is None:
+        solution = routing.SolveWithParameters(search_parameters(**budget.share()))
+    else:
+        for node in range(num_vehicles, n):
+            routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+        routing.CloseModelWithParameters(search_parameters(**budget.share()))
+        start = routing.ReadAssignmentFromRoutes(
+            [[manager.NodeToIndex(node) for node in route] for route in seed], True)
+        params = search_parameters(**budget.share())
+        solution = routing.SolveFromAssignmentWithParameters(start, params) if start else None
+    if not solution:
+        return None
+    routes = []
+    for vehicle_id in range(num_vehicles):
+        index = routing.Start(vehicle_id)
+        route = []
+        while not routing.IsEnd(index):
+            route.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        route.append(manager.IndexToNode(index))
+        routes.append(route)
+    dropped = sorted(set(range(num_vehicles, n)).difference(*routes))
+    if dropped:
+        current_app.logger.warning(f"Fleet capacity left {len(dropped)} orders unrouted: nodes {dropped}")
+    return routes
+
+
+def solve_fleet(addresses, locations, num_vehicles, demands_weight, demands_volume,
+                capacities_weight, capacities_volume, options=None):
+    """
+    Solves the CVRP where the first num_vehicles nodes are the vehicles'
+    start (and end) locations and the rest are orders. options are
+    search_parameters() overrides (see solver_options()); their time_limit
+    covers building the graph as well as the search. Returns (routes,
+    metres per route) or None when no solution is found or there are more
+    than ROUTE_MAX_NODES nodes; on the sparse graph, orders the fleet cannot
+    carry are left out of the routes instead.
+    """
+    cfg = current_app.config
+    budget = RouteBudget(options)
+    n = len(locations)
+    if n > cfg['ROUTE_MAX_NODES']:
+        current_app.logger.warning(f"Not routing {n} nodes, more than ROUTE_MAX_NODES ({cfg['ROUTE_MAX_NODES']})")
+        return None
+    _, valid = coords_array(locations)
+    if not valid.all():
+        current_app.logger.warning(f"No coordinates for route nodes {np.flatnonzero(~valid).tolist()}")
+    args = (demands_weight, demands_volume, capacities_weight, capacities_volume)
+
+    if n < cfg['ROUTE_SPARSE_MIN_NODES']:
+        # Known sites come from the shared site matrix, the rest in one vectorized pass
+        matrix, _ = site_distance_matrix(addresses, locations)
+        routes = _solve(n, num_vehicles, matrix.tolist(), *args, budget)
+        return None if routes is None else (routes, [route_length(matrix, route) for route in routes])
+
+    graph = build_arc_graph(addresses, locations, num_vehicles, cfg['ROUTE_KNN_NEIGHBORS'])
+    current_app.logger.info(f"Routing {n - num_vehicles} orders on {len(graph):,} priced arcs instead of {n * n:,}")
+    routes = _solve(n, num_vehicles, None, *args, budget, graph=graph)
+    return None if routes is None else (routes, [graph.route_length(route) for route in routes])
+
+
+# -------------------------- Benchmark --------------------------
+
+def _benchmark_solve(matrix, num_vehicles, demands, capacity, native, time_limit):
+    """(seconds, objective) for one CVRP solve with native matrices or the old Python callbacks."""
+    manager = pywrapcp.RoutingIndexManager(len(matrix), num_vehicles, 0)
+    routing = pywrapcp.RoutingModel(manager)
+    if native:
+        transit_callback_index = routing.RegisterTransitMatrix(matrix)
+        demand_callback_index = routing.RegisterUnaryTransitVector(demands)
+    else:
+        transit_callback_index = routing.RegisterTransitCallback(
+            lambda from_index, to_index: matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)])
+        demand_callback_index = routing.RegisterUnaryTransitCallback(
+            lambda from_index: demands[manager.IndexToNode(from_index)])
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    routing.AddDimensionWithVehicleCapacity(demand_callback_index, 0, [capacity] * num_vehicles, True, 'Load')
+    params = search_parameters(time_limit=time_limit, solution_limit=0, guided=False)
+    started = time.perf_counter()
+    solution = routing.SolveWithParameters(params)
+    return time.perf_counter() - started, solution.ObjectiveValue() if solution else None
+
+
+@click.command('route-benchmark')
+@click.option('--nodes', default='100,500,1000', show_default=True, help='Comma-separated instance sizes.')
+@click.option('--orders-per-vehicle', default=50, show_default=True)
+@click.option('--time-limit', default=None, type=float,
+              help='Seconds per solve [default: ROUTE_MAX_TIME_LIMIT_SECONDS]; objectives only match '
+                   'when both searches reach their local optimum within it.')
+def route_benchmark_command(nodes, orders_per_vehicle, time_limit):
+    """Times CVRP solves with Python transit/demand callbacks against native matrices and vectors."""
+    time_limit = time_limit or current_app.config['ROUTE_MAX_TIME_LIMIT_SECONDS']
+    rng = np.random.default_rng(7)
+    for n in [int(size) for size in nodes.split(',') if size.strip()]:
+        coords = list(zip(rng.uniform(28.3, 28.9, n).tolist(), rng.uniform(76.8, 77.5, n).tolist()))
+        matrix = int_matrix(distance_matrix(coords)[0])
+        demands = [0] + rng.integers(1, 10, n - 1).tolist()
+        num_vehicles = max(1, (n - 1) // orders_per_vehicle)
+        capacity = int(np.ceil(sum(demands) / num_vehicles * 1.2))
+
+        callback_seconds, callback_cost = _benchmark_solve(matrix, num_vehicles, demands, capacity, False, time_limit)
+        native_seconds, native_cost = _benchmark_solve(matrix, num_vehicles, demands, capacity, True, time_limit)
+        click.echo(f"{n:>5} nodes, {num_vehicles:>2} vehicles: callbacks {callback_seconds:8.2f} s (cost {callback_cost}), "
+                   f"native {native_seconds:8.2f} s (cost {native_cost}), "
+                   f"{callback_seconds / max(native_seconds, 1e-9):.1f}x faster")
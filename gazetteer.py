@@ -0,0 +1,311 @@
+"""
+Offline gazetteer geocoder (Indian cities, towns and PIN codes).
+
+``flask gazetteer-build`` turns GeoNames dumps (``IN.txt`` places and,
+optionally, the ``IN.txt`` postal-code file) into flat .npy arrays under
+the instance folder. Workers open them with mmap_mode='r', so the data is
+shared through the page cache instead of copied per process.
+
+Layout (one row per place, one entry per distinct normalized name):
+    coords.npy       float32 (places, 2)   lat, lon
+    names.npy        uint8                 sorted names, concatenated UTF-8
+    name_offs.npy    int64   (names + 1)   byte offsets into names.npy
+    name_rows.npy    uint32  (names,)      best (most populous) place per name
+    name_grams.npy   uint16  (names,)      trigram count per name
+    gram_keys.npy    uint32                sorted trigram hashes
+    gram_offs.npy    int64   (grams + 1)   postings offsets
+    gram_names.npy   uint32                name indices per trigram
+    pins.npy         uint32                sorted PIN codes
+    pin_rows.npy     uint32                place row per PIN
+    admin.npy        uint8   (places,)     1 for admin areas (states, districts)
+
+Lookups: a 6-digit PIN in the address, then an exact match on a comma
+separated part (binary search), then trigram (Dice) fuzzy matching. Parts
+are tried from the right: leading parts ("Sector 18", "Industrial Area")
+are generic names found all over the country, while the trailing ones
+name the city and state.
+"""
+import csv
+import os
+import re
+import sys
+import threading
+import unicodedata
+import zlib
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+import click
+import numpy as np
+from flask import current_app
+
+from snapshots import current, new_version, publish
+
+# GeoNames feature classes kept: populated places and admin areas.
+FEATURE_CLASSES = ('P', 'A')
+FUZZY_MIN_SCORE = 0.6
+
+Match = namedtuple('Match', 'lat lon name kind score')
+
+_ARRAYS = ('coords', 'names', 'name_offs', 'name_rows', 'name_grams',
+           'gram_keys', 'gram_offs', 'gram_names', 'pins', 'pin_rows', 'admin')
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+_PIN = re.compile(r"(?<!\d)(\d{6})(?!\d)")
+
+_store = None
+_loaded = False
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('GAZETTEER_DIR', os.environ.get(
+        'GAZETTEER_DIR', os.path.join(app.instance_path, 'gazetteer')))
+    app.cli.add_command(gazetteer_build_command)
+
+
+def normalize_name(text):
+    """ASCII-folded, lower-case, alphanumerics separated by single spaces."""
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return _NON_ALNUM.sub(' ', text).strip()
+
+
+def trigrams(name):
+    """Hashed character trigrams of a normalized name (padded at both ends)."""
+    padded = f"  {name} "
+    return {zlib.crc32(padded[i:i + 3].encode()) for i in range(len(padded) - 2)}
+
+
+# -------------------------- Store --------------------------
+
+class Gazetteer:
+    """Read-only view over the memory-mapped arrays."""
+
+    def __init__(self, path):
+        for name in _ARRAYS:
+            file = os.path.join(path, f"{name}.npy")
+            # Builds older than admin.npy count every place as a city.
+            if name == 'admin' and not os.path.exists(file):
+                self.admin = np.zeros(len(self.coords), dtype=np.uint8)
+                continue
+            setattr(self, name, np.load(file, mmap_mode='r'))
+        self.size = len(self.name_rows)
+
+    def name_at(self, i):
+        return bytes(self.names[self.name_offs[i]:self.name_offs[i + 1]]).decode()
+
+    def _match(self, name_index, kind, score):
+        row = self.name_rows[name_index]
+        lat, lon = self.coords[row]
+        return Match(float(lat), float(lon), self.name_at(name_index), kind, score)
+
+    def exact(self, name):
+        """Index of a normalized name, or None (binary search over the sorted names)."""
+        index = bisect_left(_NameView(self), name.encode())
+        if index < self.size and self.name_at(index) == name:
+            return index
+        return None
+
+    def prefix(self, prefix, limit=10):
+        """Names starting with prefix, in sorted order."""
+        index = bisect_left(_NameView(self), prefix.encode())
+        out = []
+        while index < self.size and len(out) < limit:
+            name = self.name_at(index)
+            if not name.startswith(prefix):
+                break
+            out.append(name)
+            index += 1
+        return out
+
+    def fuzzy(self, name):
+        """(name index, Dice score) of the closest name by trigrams, or None."""
+        grams = np.fromiter(trigrams(name), dtype=np.uint32)
+        slots = np.searchsorted(self.gram_keys, grams)
+        known = slots < len(self.gram_keys)
+        known[known] = self.gram_keys[slots[known]] == grams[known]
+        if not known.any():
+            return None
+        postings = np.concatenate([self.gram_names[self.gram_offs[s]:self.gram_offs[s + 1]]
+                                   for s in slots[known].tolist()])
+        # Each name lists a trigram once, so the counts are shared trigrams.
+        candidates, common = np.unique(postings, return_counts=True)
+        scores = 2.0 * common / (len(grams) + self.name_grams[candidates])
+        best = int(np.argmax(scores))
+        return int(candidates[best]), float(scores[best])
+
+    def pin(self, code):
+        slot = np.searchsorted(self.pins, code)
+        if slot < len(self.pins) and self.pins[slot] == code:
+            lat, lon = self.coords[self.pin_rows[slot]]
+            return Match(float(lat), float(lon), str(code), 'pin', 1.0)
+        return None
+
+    def match(self, address):
+        """Best Match for a free-text address, or None."""
+        if not address:
+            return None
+        text = str(address)
+        for code in _PIN.findall(text):
+            found = self.pin(int(code))
+            if found:
+                return found
+
+        # Right to left: the city/state parts come last.
+        parts = [normalize_name(p) for p in reversed(text.split(','))]
+        parts = [p for p in parts if p and not p.isdigit()]
+        whole = normalize_name(text)
+        if whole and whole not in parts:
+            parts.insert(0, whole)
+
+        # A city beats an admin area (the trailing state) and a locality.
+        found = [index for index in map(self.exact, parts) if index is not None]
+        for index in found:
+            if not self.admin[self.name_rows[index]]:
+                return self._match(index, 'exact', 1.0)
+        if found:
+            return self._match(found[0], 'exact', 1.0)
+
+        best = None
+        for part in parts:
+            found = self.fuzzy(part)
+            if found and found[1] >= FUZZY_MIN_SCORE and (best is None or found[1] > best[1]):
+                best = found
+        return self._match(best[0], 'fuzzy', best[1]) if best else None
+
+
+class _NameView:
+    """Sequence of name bytes so bisect can run over the mapped blob."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.size
+
+    def __getitem__(self, i):
+        return bytes(self.store.names[self.store.name_offs[i]:self.store.name_offs[i + 1]])
+
+
+def get_gazetteer():
+    """This worker's mapped gazetteer, or None if none has been built."""
+    global _store, _loaded
+    if _loaded:
+        return _store
+    with _lock:
+        if not _loaded:
+            path = current_app.config['GAZETTEER_DIR']
+            version = current(path)
+            if version and os.path.exists(os.path.join(version, 'coords.npy')):
+                _store = Gazetteer(version)
+            else:
+                current_app.logger.info(f"No gazetteer at {path}; run `flask gazetteer-build`.")
+            _loaded = True
+    return _store
+
+
+def lookup(address):
+    """(lat, lon) for an address from the offline gazetteer, or None."""
+    store = get_gazetteer()
+    found = store.match(address) if store is not None else None
+    return (found.lat, found.lon) if found else None
+
+
+# -------------------------- Build --------------------------
+
+def _read_places(path):
+    """Yields (names, lat, lon, population, is_admin) from a GeoNames country dump."""
+    csv.field_size_limit(sys.maxsize)
+    with open(path, encoding='utf-8', newline='') as fh:
+        for row in csv.reader(fh, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) < 15 or row[6] not in FEATURE_CLASSES:
+                continue
+            yield {row[1], row[2]}, float(row[4]), float(row[5]), int(row[14] or 0), row[6] == 'A'
+
+
+def _read_postal(path):
+    """Yields (pin, place name, lat, lon) from a GeoNames postal-code dump."""
+    with open(path, encoding='utf-8', newline='') as fh:
+        for row in csv.reader(fh, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) < 11 or not row[1].isdigit() or not row[9] or not row[10]:
+                continue
+            yield int(row[1]), row[2], float(row[9]), float(row[10])
+
+
+def build(places_path, postal_path, out_dir):
+    """Writes the gazetteer arrays to out_dir; returns (places, names, pins)."""
+    coords, population, admin = [], [], []
+    best = {}  # normalized name -> place row with the largest population
+
+    def add(names, lat, lon, pop, is_admin=False):
+        row = len(coords)
+        coords.append((lat, lon))
+        population.append(pop)
+        admin.append(is_admin)
+        for raw in names:
+            name = normalize_name(raw)
+            if name and (name not in best or pop > population[best[name]]):
+                best[name] = row
+        return row
+
+    for names, lat, lon, pop, is_admin in _read_places(places_path):
+        add(names, lat, lon, pop, is_admin)
+
+    pins = {}
+    if postal_path:
+        for code, place, lat, lon in _read_postal(postal_path):
+            if code not in pins:
+                pins[code] = add({place}, lat, lon, 0)
+
+    names = sorted(best, key=lambda n: n.encode())
+    blob = [n.encode() for n in names]
+    name_offs = np.zeros(len(blob) + 1, dtype=np.int64)
+    name_offs[1:] = np.cumsum([len(b) for b in blob])
+
+    postings = defaultdict(list)
+    name_grams = np.zeros(len(names), dtype=np.uint16)
+    for i, name in enumerate(names):
+        grams = trigrams(name)
+        name_grams[i] = min(len(grams), np.iinfo(np.uint16).max)
+        for gram in grams:
+            postings[gram].append(i)
+    gram_keys = np.array(sorted(postings), dtype=np.uint32)
+    gram_offs = np.zeros(len(gram_keys) + 1, dtype=np.int64)
+    gram_offs[1:] = np.cumsum([len(postings[g]) for g in gram_keys.tolist()])
+    gram_names = np.fromiter((i for g in gram_keys.tolist() for i in postings[g]),
+                             dtype=np.uint32, count=int(gram_offs[-1]))
+
+    pin_codes = np.array(sorted(pins), dtype=np.uint32)
+    arrays = {
+        'coords': np.array(coords, dtype=np.float32).reshape(-1, 2),
+        'names': np.frombuffer(b''.join(blob), dtype=np.uint8),
+        'name_offs': name_offs,
+        'name_rows': np.array([best[n] for n in names], dtype=np.uint32),
+        'name_grams': name_grams,
+        'gram_keys': gram_keys,
+        'gram_offs': gram_offs,
+        'gram_names': gram_names,
+        'pins': pin_codes,
+        'pin_rows': np.array([pins[c] for c in pin_codes.tolist()], dtype=np.uint32),
+        'admin': np.array(admin, dtype=np.uint8),
+    }
+
+    # Write a new version and swap the link, so workers never see half a build or none.
+    version = new_version(out_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(version, f"{name}.npy"), array)
+    publish(out_dir, version)
+    return len(coords), len(names), len(pin_codes)
+
+
+@click.command('gazetteer-build')
+@click.argument('places', type=click.Path(exists=True, dir_okay=False))
+@click.option('--postal', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='GeoNames postal-code dump (IN.txt from the postal_codes export).')
+def gazetteer_build_command(places, postal):
+    """Builds the offline gazetteer from a GeoNames country dump (e.g. IN.txt)."""
+    out_dir = current_app.config['GAZETTEER_DIR']
+    counts = build(places, postal, out_dir)
+    click.echo("Wrote {} places, {} names and {} PIN codes to {}.".format(*counts, out_dir))
+    click.echo("Restart the web workers to map the new files.")
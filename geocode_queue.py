@@ -0,0 +1,293 @@
+"""
+Write-time geocoding for indents and orders.
+
+Every write that adds or changes an address queues the row in
+``geocode_queue`` in the same transaction. ``flask geocode-worker`` claims
+due rows, resolves their addresses in one geocode_many() batch and stores
+the coordinates on the row itself (indents: pickup_lat/lon plus drop_lats/
+drop_lons aligned with split_drops(location); orders: pickup_/drop_lat/lon),
+so route optimization reads ready columns and never geocodes inline.
+``flask geocode-backfill`` queues existing rows that have no coordinates.
+"""
+import os
+import time
+
+import click
+from flask import current_app
+
+from database import get_db
+from geocoding import geocode_many
+
+INDENT = 'indent'
+ORDER = 'order'
+
+# -------------------------- Schema --------------------------
+
+GEOCODE_QUEUE_SQL = [
+    """
+    ALTER TABLE indents
+        ADD COLUMN IF NOT EXISTS pickup_lat DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS pickup_lon DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS drop_lats DOUBLE PRECISION[],
+        ADD COLUMN IF NOT EXISTS drop_lons DOUBLE PRECISION[]
+    """,
+    """
+    ALTER TABLE orders
+        ADD COLUMN IF NOT EXISTS pickup_lat DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS pickup_lon DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS drop_lat DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS drop_lon DOUBLE PRECISION
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS geocode_queue (
+        kind VARCHAR(10) NOT NULL,
+        row_key TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        enqueued_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (kind, row_key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_geocode_queue_due ON geocode_queue (next_attempt_at)",
+]
+
+# Rows still missing a coordinate (a drop array with a NULL counts).
+INDENT_MISSING_SQL = "(pickup_lat IS NULL OR drop_lats IS NULL OR array_position(drop_lats, NULL) IS NOT NULL)"
+ORDER_MISSING_SQL = "(pickup_lat IS NULL OR drop_lat IS NULL)"
+
+# ON CONFLICT SET list for orders: keep coordinates only while the address is unchanged.
+ORDER_COORD_RESET_SQL = """
+    pickup_lat = CASE WHEN orders.pickup_location_latlon IS NOT DISTINCT FROM EXCLUDED.pickup_location_latlon
+                      THEN orders.pickup_lat END,
+    pickup_lon = CASE WHEN orders.pickup_location_latlon IS NOT DISTINCT FROM EXCLUDED.pickup_location_latlon
+                      THEN orders.pickup_lon END,
+    drop_lat = CASE WHEN orders.drop_location_latlon IS NOT DISTINCT FROM EXCLUDED.drop_location_latlon
+                    THEN orders.drop_lat END,
+    drop_lon = CASE WHEN orders.drop_location_latlon IS NOT DISTINCT FROM EXCLUDED.drop_location_latlon
+                    THEN orders.drop_lon END
+"""
+
+_REQUEUE_SQL = "ON CONFLICT (kind, row_key) DO UPDATE SET attempts = 0, next_attempt_at = NOW()"
+
+_ENQUEUE_SQL = f"""
+    INSERT INTO geocode_queue (kind, row_key)
+    SELECT %s, unnest(%s::text[])
+    {_REQUEUE_SQL}
+"""
+
+# Leases due rows by pushing next_attempt_at out; a worker that dies mid-batch
+# simply lets the lease run out.
+_CLAIM_SQL = """
+    UPDATE geocode_queue q
+    SET attempts = q.attempts + 1, next_attempt_at = NOW() + %s * INTERVAL '1 second'
+    FROM (
+        SELECT kind, row_key FROM geocode_queue
+        WHERE next_attempt_at <= NOW()
+        ORDER BY next_attempt_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ) due
+    WHERE q.kind = due.kind AND q.row_key = due.row_key
+    RETURNING q.kind, q.row_key, q.attempts
+"""
+
+_INDENT_ADDRESSES_SQL = "SELECT id::text, pickup_location, location FROM indents WHERE id = ANY(%s::int[])"
+_ORDER_ADDRESSES_SQL = """
+    SELECT order_id, pickup_location_latlon, drop_location_latlon FROM orders WHERE order_id = ANY(%s)
+"""
+
+# The address guards skip rows edited since they were read; the edit queued them again.
+_INDENT_COORDS_SQL = """
+    UPDATE indents SET pickup_lat = %s, pickup_lon = %s, drop_lats = %s::float8[], drop_lons = %s::float8[]
+    WHERE id = %s AND pickup_location IS NOT DISTINCT FROM %s AND location IS NOT DISTINCT FROM %s
+"""
+_ORDER_COORDS_SQL = """
+    UPDATE orders SET pickup_lat = %s, pickup_lon = %s, drop_lat = %s, drop_lon = %s
+    WHERE order_id = %s
+      AND pickup_location_latlon IS NOT DISTINCT FROM %s AND drop_location_latlon IS NOT DISTINCT FROM %s
+"""
+
+_DONE_SQL = "DELETE FROM geocode_queue WHERE kind = %s AND row_key = %s"
+_RETRY_SQL = """
+    UPDATE geocode_queue SET next_attempt_at = NOW() + %s * INTERVAL '1 second'
+    WHERE kind = %s AND row_key = %s
+"""
+
+_BACKFILL_SQL = {
+    INDENT: f"SELECT id FROM indents WHERE id > %s AND {INDENT_MISSING_SQL} ORDER BY id LIMIT %s",
+    ORDER: f"SELECT order_id FROM orders WHERE order_id > %s AND {ORDER_MISSING_SQL} ORDER BY order_id LIMIT %s",
+}
+_BACKFILL_START = {INDENT: 0, ORDER: ''}
+
+# fn(conn, resolved) run by the worker after every batch (see on_batch).
+_batch_hooks = []
+
+
+def init_app(app):
+    app.config.setdefault('GEOCODE_QUEUE_BATCH', int(os.environ.get('GEOCODE_QUEUE_BATCH', 100)))
+    app.config.setdefault('GEOCODE_QUEUE_POLL_SECONDS', float(os.environ.get('GEOCODE_QUEUE_POLL_SECONDS', 5)))
+    app.config.setdefault('GEOCODE_QUEUE_LEASE', int(os.environ.get('GEOCODE_QUEUE_LEASE', 300)))
+    # Unresolved rows retry after 1 min, 2 min, 4 min ... and are dropped after the last attempt.
+    app.config.setdefault('GEOCODE_QUEUE_RETRY', int(os.environ.get('GEOCODE_QUEUE_RETRY', 60)))
+    app.config.setdefault('GEOCODE_QUEUE_MAX_ATTEMPTS', int(os.environ.get('GEOCODE_QUEUE_MAX_ATTEMPTS', 8)))
+    app.cli.add_command(geocode_worker_command)
+    app.cli.add_command(geocode_backfill_command)
+
+
+def split_drops(location):
+    """Drop addresses of an indent's comma separated location, in order."""
+    return [d.strip() for d in (location or '').split(',') if d.strip()]
+
+
+def on_batch(fn):
+    """Registers fn(conn, resolved) to run after each worker batch, idle ones included."""
+    _batch_hooks.append(fn)
+
+
+# -------------------------- Enqueue --------------------------
+
+def enqueue(cur, kind, keys):
+    """
+    Queues rows for geocoding (again, if already queued). Runs on the
+    caller's cursor so it commits with the write that changed the addresses.
+    """
+    keys = [str(k) for k in keys if k is not None]
+    if keys:
+        cur.execute(_ENQUEUE_SQL, (kind, keys))
+    return len(keys)
+
+
+def enqueue_sql(kind, source):
+    """INSERT queueing the `key` column of source (a CTE or subquery), for set-based writes."""
+    return f"""
+        INSERT INTO geocode_queue (kind, row_key)
+        SELECT '{kind}', key::text FROM {source}
+        {_REQUEUE_SQL}
+    """
+
+
+# -------------------------- Worker --------------------------
+
+def _indent_update(key, pickup, location, found):
+    drops = split_drops(location)
+    start = found.get(pickup)
+    ends = [found.get(d) for d in drops]
+    coords = (start[0] if start else None, start[1] if start else None,
+              [e[0] if e else None for e in ends], [e[1] if e else None for e in ends])
+    resolved = start is not None and all(ends)
+    return coords + (int(key), pickup, location), resolved
+
+
+def _order_update(key, pickup, drop, found):
+    start, end = found.get(pickup), found.get(drop)
+    coords = (start[0] if start else None, start[1] if start else None,
+              end[0] if end else None, end[1] if end else None)
+    return coords + (key, pickup, drop), start is not None and end is not None
+
+
+_KINDS = {
+    INDENT: (_INDENT_ADDRESSES_SQL, _INDENT_COORDS_SQL, _indent_update, int),
+    ORDER: (_ORDER_ADDRESSES_SQL, _ORDER_COORDS_SQL, _order_update, str),
+}
+
+
+def run_batch(conn):
+    """
+    Claims up to GEOCODE_QUEUE_BATCH due rows, geocodes all their addresses
+    at once and stores the coordinates. Returns (claimed, resolved).
+    """
+    cfg = current_app.config
+    cur = conn.cursor()
+    cur.execute(_CLAIM_SQL, (cfg['GEOCODE_QUEUE_LEASE'], cfg['GEOCODE_QUEUE_BATCH']))
+    claimed = cur.fetchall()
+    conn.commit()
+    if not claimed:
+        cur.close()
+        return 0, 0
+
+    attempts = {(kind, key): n for kind, key, n in claimed}
+    rows = {}
+    for kind, (select_sql, _, _, key_type) in _KINDS.items():
+        keys = [key_type(key) for k, key, _ in claimed if k == kind]
+        if keys:
+            cur.execute(select_sql, (keys,))
+            rows[kind] = cur.fetchall()
+
+    addresses = set()
+    for kind, kind_rows in rows.items():
+        for _, pickup, drop in kind_rows:
+            addresses.add(pickup)
+            addresses.update(split_drops(drop) if kind == INDENT else [drop])
+    # geocode_many commits its cache writes, so nothing is pending here.
+    found = geocode_many(addresses)
+
+    unresolved = set()
+    for kind, kind_rows in rows.items():
+        _, update_sql, build, _ = _KINDS[kind]
+        for key, pickup, drop in kind_rows:
+            params, ok = build(key, pickup, drop, found)
+            cur.execute(update_sql, params)
+            if not ok:
+                unresolved.add((kind, key))
+
+    for (kind, key), tries in attempts.items():
+        if (kind, key) not in unresolved:
+            # Resolved, or the row is gone.
+            cur.execute(_DONE_SQL, (kind, key))
+        elif tries >= cfg['GEOCODE_QUEUE_MAX_ATTEMPTS']:
+            current_app.logger.warning(f"Giving up geocoding {kind} {key} after {tries} attempts")
+            cur.execute(_DONE_SQL, (kind, key))
+        else:
+            cur.execute(_RETRY_SQL, (cfg['GEOCODE_QUEUE_RETRY'] * 2 ** (tries - 1), kind, key))
+    conn.commit()
+    cur.close()
+    return len(claimed), len(claimed) - len(unresolved)
+
+
+@click.command('geocode-worker')
+@click.option('--once', is_flag=True, help='Drain the due rows and exit instead of polling.')
+def geocode_worker_command(once):
+    """Geocodes queued indents and orders (run next to the web workers)."""
+    conn = get_db()
+    poll = current_app.config['GEOCODE_QUEUE_POLL_SECONDS']
+    click.echo("Geocode worker started.")
+    while True:
+        claimed, resolved = run_batch(conn)
+        for hook in _batch_hooks:
+            hook(conn, resolved)
+        if claimed:
+            click.echo(f"Geocoded {resolved} of {claimed} queued rows.")
+            continue
+        if once:
+            break
+        time.sleep(poll)
+
+
+@click.command('geocode-backfill')
+@click.option('--kind', type=click.Choice([INDENT, ORDER, 'all']), default='all', show_default=True)
+@click.option('--batch', default=1000, show_default=True, help='Rows queued per transaction.')
+@click.option('--after', default=None, help='Resume after this id / order_id (printed as progress); needs --kind.')
+def geocode_backfill_command(kind, batch, after):
+    """
+    Queues existing rows without coordinates for `flask geocode-worker`.
+    Each batch commits on its own and re-running skips rows that already
+    have coordinates, so an interrupted backfill can simply be restarted.
+    """
+    if after is not None and kind == 'all':
+        raise click.UsageError("--after needs --kind indent or --kind order.")
+    conn = get_db()
+    cur = conn.cursor()
+    for current in ([INDENT, ORDER] if kind == 'all' else [kind]):
+        last = _BACKFILL_START[current] if after is None else type(_BACKFILL_START[current])(after)
+        total = 0
+        while True:
+            cur.execute(_BACKFILL_SQL[current], (last, batch))
+            keys = [row[0] for row in cur.fetchall()]
+            if not keys:
+                break
+            total += enqueue(cur, current, keys)
+            conn.commit()
+            last = keys[-1]
+            click.echo(f"Queued {total} {current} rows (last {current} key: {last}).")
+        click.echo(f"Done: {total} {current} rows queued.")
+    cur.close()
@@ -0,0 +1,307 @@
+"""
+Geocoding behind a two-level cache.
+
+geocode() / geocode_many() answer from a per-worker LRU, then the offline
+gazetteer, then the ``geocode_cache`` table, and only then ask the remote
+provider. Cache entries are keyed by normalize_address(), so case, spacing
+and punctuation variants of the same depot or customer share one entry.
+Misses ("no such place") are cached too, with a shorter TTL; failed
+requests (timeouts, 5xx) are not cached at all.
+
+Remote lookups go through GeocodingClient: one keep-alive session per
+process, distinct addresses fetched concurrently, concurrent requests for
+the same address collapsed into one (SingleFlight), and every request
+paced by a RateLimiter whose state lives in a file under the instance
+folder, so all gunicorn workers on the box share the provider's budget.
+"""
+import fcntl
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import click
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from database import get_db
+from gazetteer import lookup as gazetteer_lookup
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+NOMINATIM_HEADERS = {"User-Agent": "MyApp/1.0 (your-email@example.com)"}
+
+GEOCODE_CACHE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        address_key TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        lat DOUBLE PRECISION,
+        lon DOUBLE PRECISION,
+        fetched_at TIMESTAMPTZ DEFAULT NOW(),
+        expires_at TIMESTAMPTZ NOT NULL
+    )
+"""
+
+_CACHE_SQL = """
+    SELECT lat, lon, EXTRACT(EPOCH FROM expires_at)
+    FROM geocode_cache WHERE address_key = %s AND expires_at > NOW()
+"""
+_CACHE_MANY_SQL = """
+    SELECT address_key, lat, lon, EXTRACT(EPOCH FROM expires_at)
+    FROM geocode_cache WHERE address_key = ANY(%s) AND expires_at > NOW()
+"""
+_CACHE_UPSERT_SQL = """
+    INSERT INTO geocode_cache (address_key, address, lat, lon, fetched_at, expires_at)
+    VALUES (%s, %s, %s, %s, NOW(), NOW() + %s * INTERVAL '1 second')
+    ON CONFLICT (address_key) DO UPDATE SET
+        address = EXCLUDED.address,
+        lat = EXCLUDED.lat,
+        lon = EXCLUDED.lon,
+        fetched_at = EXCLUDED.fetched_at,
+        expires_at = EXCLUDED.expires_at
+"""
+
+# address_key -> (coords or None, expires_at epoch seconds)
+_cache = OrderedDict()
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+_PUNCTUATION = re.compile(r"[,.;:/#()\-]+")
+_SPACES = re.compile(r"\s+")
+
+
+def init_app(app):
+    app.config.setdefault('GEOCODE_CACHE_SIZE', int(os.environ.get('GEOCODE_CACHE_SIZE', 10000)))
+    app.config.setdefault('GEOCODE_TTL', int(os.environ.get('GEOCODE_TTL', 90 * 86400)))
+    app.config.setdefault('GEOCODE_NEGATIVE_TTL', int(os.environ.get('GEOCODE_NEGATIVE_TTL', 86400)))
+    app.config.setdefault('GEOCODE_URL', os.environ.get('GEOCODE_URL', NOMINATIM_URL))
+    # Nominatim's usage policy allows one request per second.
+    app.config.setdefault('GEOCODE_RATE', float(os.environ.get('GEOCODE_RATE', 1.0)))
+    app.config.setdefault('GEOCODE_CONCURRENCY', int(os.environ.get('GEOCODE_CONCURRENCY', 4)))
+    app.cli.add_command(geocode_prune_command)
+
+
+def normalize_address(address):
+    """Cache key for an address: NFKC, case-folded, punctuation and runs of spaces collapsed."""
+    text = unicodedata.normalize('NFKC', str(address)).casefold()
+    return _SPACES.sub(' ', _PUNCTUATION.sub(' ', text)).strip()
+
+
+def _lru_get(key):
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return False, None
+        if entry[1] <= time.time():
+            del _cache[key]
+            return False, None
+        _cache.move_to_end(key)
+        return True, entry[0]
+
+
+def _lru_put(key, coords, expires_at):
+    with _lock:
+        _cache[key] = (coords, expires_at)
+        _cache.move_to_end(key)
+        while len(_cache) > current_app.config['GEOCODE_CACHE_SIZE']:
+            _cache.popitem(last=False)
+
+
+# -------------------------- Remote Client --------------------------
+
+class RateLimiter:
+    """
+    Cross-process GCRA limiter. Callers reserve the next slot under an
+    exclusive flock on path (the file holds the theoretical arrival time)
+    and sleep outside the lock, so concurrent callers queue up in order.
+    """
+
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def reserve(self):
+        """Books a slot and returns how long to wait for it."""
+        with open(self.path, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            raw = fh.read().strip()
+            now = time.time()
+            tat = max(float(raw) if raw else 0.0, now)
+            fh.seek(0)
+            fh.truncate()
+            fh.write(repr(tat + self.interval))
+        return max(0.0, tat - self.tolerance - now)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the first caller's result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+class GeocodingClient:
+    """Nominatim-style /search client; safe to share between threads."""
+
+    def __init__(self, url, headers, limiter, concurrency=4, timeout=10, logger=None):
+        self.url = url
+        self.headers = headers
+        self.limiter = limiter
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.logger = logger
+        self.flight = SingleFlight()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _fetch(self, address):
+        """(coords, definitive); definitive is False when the request itself failed."""
+        self.limiter.acquire()
+        try:
+            resp = self.session.get(self.url, params={"q": address, "format": "json", "limit": 1},
+                                    headers=self.headers, timeout=self.timeout)
+            resp.raise_for_status()
+            data = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            if self.logger:
+                self.logger.warning(f"Geocode request failed for '{address}': {e}")
+            return None, False
+        try:
+            lat, lon = float(data[0]["lat"]), float(data[0]["lon"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None, True
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return None, True
+        return (lat, lon), True
+
+    def lookup(self, address):
+        return self.flight.do(normalize_address(address), lambda: self._fetch(address))
+
+    def lookup_many(self, addresses):
+        """{address_key: address} -> {address_key: (coords, definitive)}, fetched concurrently."""
+        if not addresses:
+            return {}
+        keys = list(addresses)
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(keys))) as pool:
+            results = pool.map(lambda key: self.lookup(addresses[key]), keys)
+            return dict(zip(keys, results))
+
+
+def get_client():
+    """This process's client (sessions are not shared across a fork)."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                cfg = current_app.config
+                limiter = RateLimiter(os.path.join(current_app.instance_path, 'geocode_rate'),
+                                      cfg['GEOCODE_RATE'])
+                _client = GeocodingClient(cfg['GEOCODE_URL'], NOMINATIM_HEADERS, limiter,
+                                          concurrency=cfg['GEOCODE_CONCURRENCY'], logger=current_app.logger)
+                _client_pid = pid
+    return _client
+
+
+# -------------------------- Lookups --------------------------
+
+def geocode(address):
+    """Resolves an address to (lat, lon), or None if it cannot be found."""
+    return geocode_many([address]).get(address)
+
+
+def geocode_many(addresses):
+    """
+    Resolves many addresses at once: {address: (lat, lon) or None}. Cache
+    misses go remote concurrently; their results are stored in
+    geocode_cache and committed on the request connection, so call it
+    outside of a pending write.
+    """
+    result, pending = {}, {}
+    for address in addresses:
+        if not address or not str(address).strip():
+            result[address] = None
+            continue
+        key = normalize_address(address)
+        hit, coords = _lru_get(key)
+        if not hit:
+            coords = gazetteer_lookup(address)
+            hit = coords is not None
+        if hit:
+            result[address] = coords
+        else:
+            pending.setdefault(key, []).append(address)
+    if not pending:
+        return result
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(_CACHE_MANY_SQL, (list(pending),))
+    for key, lat, lon, expires_at in cur.fetchall():
+        coords = (lat, lon) if lat is not None else None
+        _lru_put(key, coords, float(expires_at))
+        for address in pending.pop(key):
+            result[address] = coords
+
+    fetched = get_client().lookup_many({key: group[0] for key, group in pending.items()})
+    rows = []
+    for key, (coords, definitive) in fetched.items():
+        for address in pending[key]:
+            result[address] = coords
+        if definitive:
+            ttl = current_app.config['GEOCODE_TTL' if coords else 'GEOCODE_NEGATIVE_TTL']
+            lat, lon = coords if coords else (None, None)
+            rows.append((key, str(pending[key][0]).strip(), lat, lon, ttl))
+            _lru_put(key, coords, time.time() + ttl)
+    if rows:
+        cur.executemany(_CACHE_UPSERT_SQL, rows)
+        conn.commit()
+    cur.close()
+    return result
+
+
+# -------------------------- CLI --------------------------
+
+@click.command('geocode-prune')
+def geocode_prune_command():
+    """Deletes expired geocode_cache rows."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM geocode_cache WHERE expires_at <= NOW()")
+    deleted = cur.rowcount
+    conn.commit()
+    cur.close()
+    click.echo(f"Deleted {deleted} expired geocode cache rows.")
+
@@ -0,0 +1,279 @@
+"""
+Bulk ingestion helpers for spreadsheet uploads.
+
+Rows are validated column-wise with pandas, streamed into a temporary
+staging table with COPY FROM STDIN and merged into the real table with a
+single set-based statement, so a large sheet costs a handful of round
+trips instead of one INSERT per row.
+"""
+import io
+
+import pandas as pd
+
+from financials import refresh_from_table
+from geocode_queue import INDENT, ORDER, ORDER_COORD_RESET_SQL, ORDER_MISSING_SQL, enqueue, enqueue_sql
+
+INDENT_COLUMNS = [
+    'indent_date', 'indent', 'allocation_date', 'customer_name', 'range',
+    'pickup_location', 'location', 'vehicle_number', 'vehicle_model',
+    'vehicle_based', 'lr_no', 'material', 'load_per_bucket', 'no_of_buckets',
+    't_load', 'pod_received', 'freight_tiger_number', 'freight_tiger_month',
+]
+INDENT_DATE_COLUMNS = ['indent_date', 'allocation_date']
+INDENT_NUMERIC_COLUMNS = ['load_per_bucket', 'no_of_buckets', 't_load']
+
+# Rows per COPY chunk; bounds the size of each CSV buffer.
+COPY_CHUNK_ROWS = 10000
+
+# Spreadsheet row numbers are 1-based and row 1 is the header.
+HEADER_ROWS = 2
+
+
+# -------------------------- Validation --------------------------
+
+def _blank_to_na(series):
+    """Treats empty / whitespace-only strings like missing cells (see clean_numeric)."""
+    if series.dtype == object:
+        return series.mask(series.astype(str).str.strip() == '')
+    return series
+
+
+def parse_dates(series):
+    """Parses ISO dates first, then day-first dates; unparseable cells become NaT."""
+    series = _blank_to_na(series)
+    parsed = pd.to_datetime(series, errors='coerce', format='ISO8601')
+    retry = parsed.isna() & series.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(series[retry], errors='coerce', dayfirst=True, format='mixed')
+    return parsed
+
+
+def _reject(rejections, mask, series, column, reason):
+    for index, value in series[mask].items():
+        rejections.append({
+            'row': int(index) + HEADER_ROWS,
+            'column': column,
+            'value': None if pd.isna(value) else str(value),
+            'reason': reason,
+        })
+
+
+def validate_indents(df, valid_vehicles):
+    """
+    Validates an uploaded indent sheet.
+    Returns (clean_df, rejections) where clean_df holds INDENT_COLUMNS with
+    typed values and rejections lists one entry per bad cell.
+    """
+    df = df.reindex(columns=INDENT_COLUMNS)
+    rejections = []
+    bad = pd.Series(False, index=df.index)
+
+    vehicles = df['vehicle_number'].astype('string').str.strip()
+    invalid_vehicle = ~vehicles.isin(list(valid_vehicles))
+    _reject(rejections, invalid_vehicle, df['vehicle_number'], 'vehicle_number', 'unknown vehicle number')
+    bad |= invalid_vehicle
+    df['vehicle_number'] = vehicles
+
+    for column in INDENT_DATE_COLUMNS:
+        raw = _blank_to_na(df[column])
+        parsed = parse_dates(raw)
+        invalid = parsed.isna() & raw.notna()
+        _reject(rejections, invalid, raw, column, 'unparseable date')
+        bad |= invalid
+        df[column] = parsed.dt.strftime('%Y-%m-%d')
+
+    for column in INDENT_NUMERIC_COLUMNS:
+        raw = _blank_to_na(df[column])
+        parsed = pd.to_numeric(raw, errors='coerce')
+        invalid = parsed.isna() & raw.notna()
+        _reject(rejections, invalid, raw, column, 'unparseable number')
+        bad |= invalid
+        df[column] = parsed
+
+    rejections.sort(key=lambda r: r['row'])
+    return df[~bad], rejections
+
+
+# -------------------------- COPY Helpers --------------------------
+
+def copy_dataframe(cursor, table, columns, df, chunk_rows=COPY_CHUNK_ROWS):
+    """Streams df into table with COPY FROM STDIN, one bounded CSV buffer per chunk."""
+    column_list = ', '.join(f'"{c}"' for c in columns)
+    statement = f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '')"
+    for start in range(0, len(df), chunk_rows):
+        buffer = io.StringIO()
+        df.iloc[start:start + chunk_rows].to_csv(buffer, index=False, header=False, columns=columns)
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+
+
+def bulk_insert_indents(conn, df):
+    """
+    COPYs validated indent rows into a staging table, merges them in one INSERT
+    and refreshes the daily financial rollup for the (vehicle, day) keys touched.
+    The new rows are queued for geocoding in the same statement.
+    """
+    column_list = ', '.join(f'"{c}"' for c in INDENT_COLUMNS)
+    cur = conn.cursor()
+    # Only the loaded columns: LIKE would copy id's NOT NULL without its default.
+    cur.execute(f"CREATE TEMP TABLE indents_staging ON COMMIT DROP AS SELECT {column_list} FROM indents WITH NO DATA")
+    copy_dataframe(cur, 'indents_staging', INDENT_COLUMNS, df)
+    # Every inserted id is new, so the queue INSERT's rowcount is the indent count.
+    cur.execute(f"""
+        WITH inserted AS (
+            INSERT INTO indents ({column_list}) SELECT {column_list} FROM indents_staging
+            RETURNING id AS key
+        )
+        {enqueue_sql(INDENT, 'inserted')}
+    """)
+    inserted = cur.rowcount
+    refresh_from_table(cur, 'indents_staging')
+    conn.commit()
+    cur.close()
+    return inserted
+
+
+# -------------------------- Orders Upsert --------------------------
+
+# Upload sheet header -> orders column
+ORDER_CSV_COLUMNS = {
+    'Order_ID': 'order_id',
+    'Customer_Name': 'customer_name',
+    'created_date': 'created_date',
+    'Order_Type': 'order_type',
+    'Pickup_Location_LatLon': 'pickup_location_latlon',
+    'Drop_Location_LatLon': 'drop_location_latlon',
+    'Volume_CBM': 'volume_cbm',
+    'Weight_KG': 'weight_kg',
+    'Delivery_Priority': 'delivery_priority',
+    'Expected_Delivery': 'expected_delivery',
+    'amount': 'amount',
+    'Status': 'status',
+}
+ORDER_COLUMNS = list(ORDER_CSV_COLUMNS.values())
+ORDER_DATE_COLUMNS = ['created_date', 'expected_delivery']
+ORDER_NUMERIC_COLUMNS = ['volume_cbm', 'weight_kg', 'amount']
+
+ORDER_CHUNK_ROWS = 20000
+
+
+def validate_orders(chunk):
+    """Renames upload headers and type-checks one chunk; returns (clean_df, rejections)."""
+    df = chunk.rename(columns=ORDER_CSV_COLUMNS).reindex(columns=ORDER_COLUMNS)
+    rejections = []
+    bad = pd.Series(False, index=df.index)
+
+    order_ids = _blank_to_na(df['order_id'])
+    missing_id = order_ids.isna()
+    _reject(rejections, missing_id, df['order_id'], 'order_id', 'missing order id')
+    bad |= missing_id
+    df['order_id'] = order_ids.astype('string').str.strip()
+
+    for column in ORDER_DATE_COLUMNS:
+        raw = _blank_to_na(df[column])
+        parsed = parse_dates(raw)
+        invalid = parsed.isna() & raw.notna()
+        _reject(rejections, invalid, raw, column, 'unparseable date')
+        bad |= invalid
+        df[column] = parsed.dt.strftime('%Y-%m-%d')
+
+    for column in ORDER_NUMERIC_COLUMNS:
+        raw = _blank_to_na(df[column])
+        parsed = pd.to_numeric(raw, errors='coerce')
+        invalid = parsed.isna() & raw.notna()
+        _reject(rejections, invalid, raw, column, 'unparseable number')
+        bad |= invalid
+        df[column] = parsed
+
+    rejections.sort(key=lambda r: r['row'])
+    # Original line order decides which duplicate of an order_id wins.
+    df = df[~bad].assign(line_no=lambda d: d.index)
+    return df, rejections
+
+
+def _order_merge_sql():
+    columns = ', '.join(ORDER_COLUMNS)
+    updates = ',\n            '.join(f"{c} = EXCLUDED.{c}" for c in ORDER_COLUMNS if c != 'order_id')
+    current = ', '.join(f"orders.{c}" for c in ORDER_COLUMNS if c != 'order_id')
+    incoming = ', '.join(f"EXCLUDED.{c}" for c in ORDER_COLUMNS if c != 'order_id')
+    # xmax = 0 only for freshly inserted tuples; updates skipped by the WHERE
+    # clause return nothing and are counted as unchanged. Rows left without
+    # coordinates (new, or an address changed) are queued for geocoding.
+    return f"""
+        WITH src AS (
+            SELECT DISTINCT ON (order_id) {columns}
+            FROM orders_staging
+            ORDER BY order_id, line_no DESC
+        ), merged AS (
+            INSERT INTO orders ({columns})
+            SELECT {columns} FROM src
+            ON CONFLICT (order_id) DO UPDATE SET
+            {updates},
+            {ORDER_COORD_RESET_SQL}
+            WHERE ({current}) IS DISTINCT FROM ({incoming})
+            RETURNING order_id, (xmax = 0) AS inserted, {ORDER_MISSING_SQL} AS needs_coords
+        ), queued AS (
+            {enqueue_sql(ORDER, '(SELECT order_id AS key FROM merged WHERE needs_coords) AS m')}
+        )
+        SELECT
+            COUNT(*) FILTER (WHERE inserted),
+            COUNT(*) FILTER (WHERE NOT inserted),
+            (SELECT COUNT(*) FROM src)
+        FROM merged
+    """
+
+
+def upsert_orders(conn, chunks):
+    """
+    Upserts an iterable of raw upload chunks via COPY + one merge per chunk.
+    Returns (counts, rejections); everything commits in a single transaction.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    rejections = []
+    merge_sql = _order_merge_sql()
+
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE orders_staging (LIKE orders, line_no BIGINT) ON COMMIT DROP
+    """)
+    for chunk in chunks:
+        clean, chunk_rejections = validate_orders(chunk)
+        rejections += chunk_rejections
+        if clean.empty:
+            continue
+
+        cur.execute("TRUNCATE orders_staging")
+        copy_dataframe(cur, 'orders_staging', ORDER_COLUMNS + ['line_no'], clean)
+        cur.execute(merge_sql)
+        inserted, updated, staged = cur.fetchone()
+        counts['inserted'] += inserted
+        counts['updated'] += updated
+        counts['unchanged'] += staged - inserted - updated
+
+    conn.commit()
+    cur.close()
+    return counts, rejections
+
+
+def save_order(conn, form):
+    """
+    Inserts or updates one order from the /orders form in a single statement
+    (queueing it for geocoding if it has no coordinates) and commits.
+    Returns (row, inserted) with row as a dict of the stored order.
+    """
+    columns = ', '.join(ORDER_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(ORDER_COLUMNS))
+    updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in ORDER_COLUMNS if c != 'order_id')
+    cur = conn.cursor()
+    cur.execute(f"""
+        INSERT INTO orders ({columns}) VALUES ({placeholders})
+        ON CONFLICT (order_id) DO UPDATE SET {updates}, {ORDER_COORD_RESET_SQL}
+        RETURNING {columns}, (xmax = 0) AS inserted, {ORDER_MISSING_SQL} AS needs_coords
+    """, [form[c] for c in ORDER_COLUMNS])
+    *values, inserted, needs_coords = cur.fetchone()
+    row = dict(zip(ORDER_COLUMNS, values))
+    if needs_coords:
+        enqueue(cur, ORDER, [row['order_id']])
+    conn.commit()
+    cur.close()
+    return row, inserted
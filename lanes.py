@@ -0,0 +1,221 @@
+"""
+Lane distances: (pickup_location, drop_location) -> distance_km.
+
+The ``lanes`` table is the single source of trip kilometres. SQL reads it
+through LANE_JOIN_SQL (financials.TRIP_KM_SQL falls back to DEFAULT_LANE_KM
+for lanes not known yet); Python callers use lane_distance(), which checks a
+per-worker LRU, then the table, and on a miss geocodes both ends once and
+stores the lane so every later lookup is O(1).
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import click
+from flask import current_app
+
+from database import get_db
+from site_matrix import matrix_method, site_distance_matrix
+from financials import refresh_lane
+from geocoding import geocode, geocode_many
+
+# Crow-flies -> road kilometres for lanes filled from coordinates.
+ROAD_DETOUR_FACTOR = 1.3
+# Site matrix methods that already measure along roads.
+ROAD_METHODS = ('road',)
+
+LANES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS lanes (
+        pickup_location TEXT NOT NULL,
+        drop_location TEXT NOT NULL,
+        distance_km NUMERIC(10, 2) NOT NULL,
+        source VARCHAR(20) NOT NULL,
+        updated_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (pickup_location, drop_location)
+    )
+"""
+# The lane calculate_distance() used to special-case.
+LANES_SEED_SQL = """
+    INSERT INTO lanes (pickup_location, drop_location, distance_km, source)
+    VALUES ('Sonipat', 'Delhi', 80, 'manual'), ('Delhi', 'Sonipat', 80, 'manual')
+    ON CONFLICT DO NOTHING
+"""
+
+_LANE_SQL = "SELECT distance_km FROM lanes WHERE pickup_location = %s AND drop_location = %s"
+_LANE_INSERT_SQL = """
+    INSERT INTO lanes (pickup_location, drop_location, distance_km, source)
+    VALUES (%s, %s, %s, %s), (%s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+"""
+_LANES_MANY_SQL = """
+    SELECT l.pickup_location, l.drop_location, l.distance_km
+    FROM lanes l
+    JOIN unnest(%s::text[], %s::text[]) AS k(pickup, dropoff)
+      ON l.pickup_location = k.pickup AND l.drop_location = k.dropoff
+"""
+_MISSING_LANES_SQL = """
+    SELECT DISTINCT i.pickup_location, i.location
+    FROM indents i
+    LEFT JOIN lanes l ON l.pickup_location = i.pickup_location AND l.drop_location = i.location
+    WHERE l.pickup_location IS NULL
+      AND i.pickup_location IS NOT NULL AND i.location IS NOT NULL
+"""
+
+# Lanes geocoded per prefetch batch by `flask lanes-fill`.
+LANE_FILL_BATCH = 50
+
+# (pickup, drop) -> (km, expires). Unresolvable lanes are cached as None for
+# LANE_MISS_TTL_SECONDS only, so a loop does not re-geocode them per row but a
+# lane filled later (lanes-fill, the geocode worker) is picked up.
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('LANE_CACHE_SIZE', int(os.environ.get('LANE_CACHE_SIZE', 4096)))
+    app.config.setdefault('LANE_MISS_TTL_SECONDS', float(os.environ.get('LANE_MISS_TTL_SECONDS', 60)))
+    app.cli.add_command(lanes_fill_command)
+
+
+def _cache_get(key):
+    with _lock:
+        if key not in _cache:
+            return False, None
+        value, expires = _cache[key]
+        if expires is not None and expires <= time.monotonic():
+            del _cache[key]
+            return False, None
+        _cache.move_to_end(key)
+        return True, value
+
+
+def _cache_put(key, value):
+    expires = None if value is not None else time.monotonic() + current_app.config['LANE_MISS_TTL_SECONDS']
+    with _lock:
+        _cache[key] = (value, expires)
+        _cache.move_to_end(key)
+        while len(_cache) > current_app.config['LANE_CACHE_SIZE']:
+            _cache.popitem(last=False)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 6371.0 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def _measure(pickup, drop):
+    """Road-km estimate between two places from their (cached) coordinates."""
+    start, end = geocode(pickup), geocode(drop)
+    if start is None or end is None:
+        return None
+    return round(haversine_km(*start, *end) * ROAD_DETOUR_FACTOR, 2)
+
+
+def lane_distance(pickup, drop):
+    """
+    Distance in km for a lane, or None if an end cannot be geocoded.
+    New lanes are stored in both directions and the rollup days on them
+    refreshed, committing on the request connection; call it outside of
+    a pending write.
+    """
+    if not pickup or not drop:
+        return None
+    key = (pickup, drop)
+    hit, km = _cache_get(key)
+    if hit:
+        return km
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(_LANE_SQL, key)
+    row = cur.fetchone()
+    if row:
+        km = float(row[0])
+    else:
+        km = _measure(pickup, drop)
+        if km is not None:
+            cur.execute(_LANE_INSERT_SQL, (pickup, drop, km, 'geocoded', drop, pickup, km, 'geocoded'))
+            refresh_lane(cur, pickup, drop)
+            refresh_lane(cur, drop, pickup)
+            conn.commit()
+    cur.close()
+
+    _cache_put(key, km)
+    if km is not None:
+        _cache_put((drop, pickup), km)
+    return km
+
+
+def prefetch_lanes(lanes, geocode_missing=True):
+    """
+    Loads the given (pickup, drop) lanes into the LRU in one query, then
+    geocodes every place on a lane still unknown in one concurrent batch,
+    so the lane_distance() calls that follow never wait on serial lookups.
+    """
+    unknown = [lane for lane in set(lanes) if all(lane) and not _cache_get(lane)[0]]
+    if not unknown:
+        return
+    cur = get_db().cursor()
+    cur.execute(_LANES_MANY_SQL, ([p for p, _ in unknown], [d for _, d in unknown]))
+    for pickup, drop, km in cur.fetchall():
+        _cache_put((pickup, drop), float(km))
+    cur.close()
+    places = {place for lane in unknown if not _cache_get(lane)[0] for place in lane}
+    if places and geocode_missing:
+        geocode_many(places)
+
+
+def lane_matrix(places, coords=None):
+    """
+    Square km matrix over places via lane_distance(); unresolved pairs are None.
+    With coords (a stored (lat, lon) per place), lanes missing from the table
+    are estimated from them instead, so nothing is geocoded or written.
+    """
+    n = len(places)
+    matrix = [[0.0] * n for _ in range(n)]
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    prefetch_lanes(((places[i], places[j]) for i, j in pairs), geocode_missing=coords is None)
+    if coords is not None:
+        meters, valid = site_distance_matrix(places, coords)
+        detour = 1.0 if matrix_method() in ROAD_METHODS else ROAD_DETOUR_FACTOR
+    for i, j in pairs:
+        if coords is None:
+            km = lane_distance(places[i], places[j])
+        else:
+            km = _cache_get((places[i], places[j]))[1]
+            if km is None and valid[i] and valid[j]:
+                km = round(float(meters[i, j]) / 1000 * detour, 2)
+        matrix[i][j] = matrix[j][i] = km
+    return matrix
+
+
+# -------------------------- CLI --------------------------
+
+@click.command('lanes-fill')
+@click.option('--limit', default=None, type=int, help='Stop after this many lanes.')
+def lanes_fill_command(limit):
+    """Geocodes every indent lane missing from the lanes table."""
+    cur = get_db().cursor()
+    cur.execute(_MISSING_LANES_SQL)
+    missing = cur.fetchall()
+    cur.close()
+    if limit is not None:
+        missing = missing[:limit]
+
+    filled, failed = 0, []
+    for start in range(0, len(missing), LANE_FILL_BATCH):
+        batch = missing[start:start + LANE_FILL_BATCH]
+        prefetch_lanes(batch)
+        for pickup, drop in batch:
+            if lane_distance(pickup, drop) is None:
+                failed.append(f"{pickup} -> {drop}")
+            else:
+                filled += 1
+    click.echo(f"Filled {filled} of {len(missing)} missing lanes.")
+    for lane in failed:
+        click.echo(f"  unresolved: {lane}")
@@ -0,0 +1,388 @@
+"""
+Versioned schema migrations.
+
+Migrations run once per deploy (``flask db-upgrade``, wired to the Procfile
+release phase). Web workers never run DDL: at startup they only compare
+the version cached by the last upgrade against SCHEMA_VERSION.
+"""
+import os
+
+import click
+from flask import current_app
+
+from database import get_db
+from financials import ROLLUP_TABLE_SQL, BACKFILL_SQL, RANGE_MIN_KM_SQL, RANGE_MAX_KM_SQL
+from lanes import LANES_TABLE_SQL, LANES_SEED_SQL
+from reports import REPORT_TABLES_SQL
+from geocoding import GEOCODE_CACHE_TABLE_SQL
+from geocode_queue import GEOCODE_QUEUE_SQL
+
+# -------------------------- Hot Path Indexes --------------------------
+# Indexes backing the hottest route predicates. The query advisor reports any
+# of these that are missing from a database. Entries added after v2 also need
+# their own migration step.
+
+HOT_PATH_INDEXES = [
+    # update_status / get_status: WHERE indent = %s AND vehicle_number = %s
+    ('idx_indents_indent_vehicle', 'CREATE INDEX IF NOT EXISTS idx_indents_indent_vehicle ON indents (indent, vehicle_number)'),
+    # optimize / def: indent_date range scans, newest first
+    ('idx_indents_date_id', 'CREATE INDEX IF NOT EXISTS idx_indents_date_id ON indents (indent_date DESC, id DESC)'),
+    # financial: fleet -> indents join plus date range per vehicle
+    ('idx_indents_vehicle_date', 'CREATE INDEX IF NOT EXISTS idx_indents_vehicle_date ON indents (vehicle_number, indent_date)'),
+    # trip_history: exit_time range filter, ORDER BY indent_id, id DESC
+    ('idx_trip_data_exit_time', 'CREATE INDEX IF NOT EXISTS idx_trip_data_exit_time ON trip_data (exit_time)'),
+    ('idx_trip_data_indent_id', 'CREATE INDEX IF NOT EXISTS idx_trip_data_indent_id ON trip_data (indent_id, id DESC)'),
+    # app1 optimize: only pending orders are ever routed
+    ('idx_orders_pending', "CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders (expected_delivery) WHERE status = 'Pending'"),
+]
+
+# /orders keyset pages: every sort key is paired with order_id as tiebreak (v3).
+ORDER_LIST_INDEXES = [
+    ('idx_orders_expected_id', 'CREATE INDEX IF NOT EXISTS idx_orders_expected_id ON orders (expected_delivery, order_id)'),
+    ('idx_orders_created_id', 'CREATE INDEX IF NOT EXISTS idx_orders_created_id ON orders (created_date, order_id)'),
+    ('idx_orders_status_expected_id', 'CREATE INDEX IF NOT EXISTS idx_orders_status_expected_id ON orders (status, expected_delivery, order_id)'),
+]
+
+# Rollup refreshes after a lane is added select the indents on that lane (v5).
+LANE_INDEXES = [
+    ('idx_indents_lane', 'CREATE INDEX IF NOT EXISTS idx_indents_lane ON indents (pickup_location, location)'),
+]
+
+# Everything the query advisor expects to find.
+INDEXES = HOT_PATH_INDEXES + ORDER_LIST_INDEXES + LANE_INDEXES
+
+# -------------------------- Shipped Backfills --------------------------
+# The rollup backfill exactly as v4 and v5 shipped it. The live BACKFILL_SQL
+# reads columns added by later steps, so a shipped step keeps its own copy.
+_SHIPPED_ROLLUP_BACKFILL_SQL = r"""
+    INSERT INTO vehicle_daily_financials (
+        vehicle_id, day, trips, completed_trips, total_load, revenue,
+        fuel_cost, fixed_cost, range_distance, updated_at
+    )
+    SELECT
+        i.vehicle_number,
+        i.indent_date,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE i.status = 'exit'),
+        SUM(COALESCE(i.no_of_buckets, 0) * COALESCE(i.load_per_bucket, 0)),
+        SUM(COALESCE(i.no_of_buckets, 0) * COALESCE(i.load_per_bucket, 0) * COALESCE(f.avg, 0)),
+        SUM(({trip_km}) * 8),
+        COUNT(*) * 150.0,
+        COALESCE(SUM(
+            CASE
+                WHEN i."range" ~ '^[0-9]+(\.[0-9]+)?$' THEN i."range"::numeric
+                WHEN i."range" ~ '^[0-9]+(\.[0-9]+)?-[0-9]+(\.[0-9]+)?$' THEN
+                    (regexp_replace(i."range", '.*-(\d+(?:\.\d+)?)', '\1'))::numeric
+                ELSE 0
+            END
+        ) FILTER (WHERE i."range" IS NOT NULL), 0),
+        NOW()
+    FROM indents i
+    LEFT JOIN fleet f ON f.vehicle_id = i.vehicle_number
+    {lane_join}
+    WHERE (i.vehicle_number, i.indent_date) IN (SELECT vehicle_id, day FROM (SELECT DISTINCT vehicle_number AS vehicle_id, indent_date AS day FROM indents) AS k)
+    GROUP BY i.vehicle_number, i.indent_date
+    ON CONFLICT (vehicle_id, day) DO UPDATE SET
+        trips = EXCLUDED.trips,
+        completed_trips = EXCLUDED.completed_trips,
+        total_load = EXCLUDED.total_load,
+        revenue = EXCLUDED.revenue,
+        fuel_cost = EXCLUDED.fuel_cost,
+        fixed_cost = EXCLUDED.fixed_cost,
+        range_distance = EXCLUDED.range_distance,
+        updated_at = EXCLUDED.updated_at
+"""
+V4_BACKFILL_SQL = _SHIPPED_ROLLUP_BACKFILL_SQL.format(
+    trip_km="""
+        CASE WHEN (i.pickup_location, i.location) IN (('Sonipat', 'Delhi'), ('Delhi', 'Sonipat'))
+             THEN 80 ELSE 150 END
+    """,
+    lane_join="",
+)
+V5_BACKFILL_SQL = _SHIPPED_ROLLUP_BACKFILL_SQL.format(
+    trip_km="COALESCE(l.distance_km, 150)",
+    lane_join="LEFT JOIN lanes l ON l.pickup_location = i.pickup_location AND l.drop_location = i.location",
+)
+
+# -------------------------- Migrations --------------------------
+# Append new steps to the end; never edit a step that has shipped.
+
+MIGRATIONS = [
+    (1, 'baseline tables', [
+        """
+        CREATE TABLE IF NOT EXISTS users_tms (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            email VARCHAR(255),
+            password VARCHAR(255) NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS driver_master (
+            driver_id VARCHAR(50) PRIMARY KEY,
+            driver_name VARCHAR(100) NOT NULL,
+            license_number VARCHAR(50) NOT NULL,
+            contact_number VARCHAR(20),
+            address TEXT,
+            availability VARCHAR(20),
+            shift_info VARCHAR(50),
+            aadhar_file VARCHAR(255),
+            license_file VARCHAR(255)
+        )
+        """,
+        "ALTER TABLE driver_master ADD COLUMN IF NOT EXISTS vehicle_id VARCHAR(50)",
+        """
+        CREATE TABLE IF NOT EXISTS driver_financials (
+            financial_id SERIAL PRIMARY KEY,
+            driver_id VARCHAR(50) REFERENCES driver_master(driver_id) ON DELETE CASCADE,
+            salary NUMERIC(10, 2) NOT NULL,
+            bonus NUMERIC(10, 2) DEFAULT 0.00,
+            last_paid_date DATE
+        )
+        """,
+        # Column order matters: fleet routes read SELECT * positionally.
+        """
+        CREATE TABLE IF NOT EXISTS fleet (
+            vehicle_id VARCHAR(50) PRIMARY KEY,
+            vehicle_name VARCHAR(100),
+            make VARCHAR(100),
+            model VARCHAR(100),
+            vin VARCHAR(100),
+            type VARCHAR(50),
+            "group" VARCHAR(50),
+            status VARCHAR(50),
+            license_plate VARCHAR(50),
+            current_meter INTEGER,
+            capacity_weight_kg NUMERIC(12, 2),
+            capacity_vol_cbm NUMERIC(12, 2),
+            documents_expiry DATE,
+            driver_id VARCHAR(50),
+            date_of_join DATE,
+            avg NUMERIC(12, 2)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS indents (
+            id SERIAL PRIMARY KEY,
+            indent_date DATE,
+            indent VARCHAR(100),
+            allocation_date DATE,
+            customer_name VARCHAR(255),
+            "range" VARCHAR(50),
+            pickup_location TEXT,
+            location TEXT,
+            vehicle_number VARCHAR(50),
+            vehicle_model VARCHAR(100),
+            vehicle_based VARCHAR(100),
+            lr_no VARCHAR(100),
+            material VARCHAR(255),
+            load_per_bucket NUMERIC(12, 2),
+            no_of_buckets NUMERIC(12, 2),
+            t_load NUMERIC(12, 2),
+            pod_received VARCHAR(50),
+            freight_tiger_number VARCHAR(100),
+            freight_tiger_month VARCHAR(50),
+            loading_time TIMESTAMP,
+            parking_time TIMESTAMP,
+            exit_time TIMESTAMP,
+            status VARCHAR(20)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id VARCHAR(100) PRIMARY KEY,
+            customer_name VARCHAR(255),
+            created_date DATE,
+            order_type VARCHAR(50),
+            pickup_location_latlon TEXT,
+            drop_location_latlon TEXT,
+            volume_cbm NUMERIC(12, 2),
+            weight_kg NUMERIC(12, 2),
+            delivery_priority VARCHAR(20),
+            expected_delivery DATE,
+            amount NUMERIC(12, 2),
+            status VARCHAR(20)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS trip_data (
+            id SERIAL PRIMARY KEY,
+            indent_id VARCHAR(100),
+            vehicle_no VARCHAR(50),
+            driver_name VARCHAR(100),
+            pickup TEXT,
+            drop_location TEXT,
+            total_drops INTEGER,
+            exit_time TIMESTAMPTZ,
+            eta_arrival_time TIMESTAMPTZ,
+            actual_arrival_time TIMESTAMPTZ,
+            total_distance NUMERIC(12, 2),
+            duration_hours NUMERIC(8, 2),
+            customer_details JSONB,
+            pod_url TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS master_model (
+            id SERIAL PRIMARY KEY,
+            "range" VARCHAR(50),
+            product VARCHAR(100),
+            transport_rate NUMERIC(12, 2),
+            loading_rate NUMERIC(12, 2),
+            unloading_rate NUMERIC(12, 2),
+            modified_by VARCHAR(100),
+            modified_at TIMESTAMPTZ DEFAULT NOW()
+        )
+        """,
+    ]),
+    (2, 'hot path indexes', [sql for _, sql in HOT_PATH_INDEXES]),
+    (3, 'orders list indexes', [sql for _, sql in ORDER_LIST_INDEXES]),
+    (4, 'vehicle daily financials rollup', [
+        ROLLUP_TABLE_SQL,
+        "CREATE INDEX IF NOT EXISTS idx_vdf_day ON vehicle_daily_financials (day)",
+        V4_BACKFILL_SQL,
+    ]),
+    (5, 'lanes table', [
+        LANES_TABLE_SQL,
+        LANES_SEED_SQL,
+        *[sql for _, sql in LANE_INDEXES],
+        V5_BACKFILL_SQL,
+    ]),
+    # Generated columns: every write path parses "range" once, and adding
+    # them rewrites (backfills) the existing rows.
+    (6, 'indent range km columns', [
+        f"ALTER TABLE indents ADD COLUMN IF NOT EXISTS range_min_km NUMERIC GENERATED ALWAYS AS ({RANGE_MIN_KM_SQL}) STORED",
+        f"ALTER TABLE indents ADD COLUMN IF NOT EXISTS range_max_km NUMERIC GENERATED ALWAYS AS ({RANGE_MAX_KM_SQL}) STORED",
+        BACKFILL_SQL,
+    ]),
+    (7, 'report jobs', REPORT_TABLES_SQL),
+    (8, 'geocode cache', [GEOCODE_CACHE_TABLE_SQL]),
+    (9, 'stored coordinates and geocode queue', GEOCODE_QUEUE_SQL),
+    # Re-runs the rollup backfill with the current rules on every database.
+    (10, 'rollup backfill', [BACKFILL_SQL]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Arbitrary key so concurrent release runs serialize instead of racing.
+MIGRATION_LOCK_ID = 7261001
+
+
+def _cache_path(app):
+    return os.path.join(app.instance_path, 'schema_version')
+
+
+def read_cached_version(app):
+    """Returns the version recorded by the last upgrade on this box, or None."""
+    try:
+        with open(_cache_path(app)) as fh:
+            return int(fh.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached_version(app, version):
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(_cache_path(app), 'w') as fh:
+        fh.write(str(version))
+
+
+def current_version(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_migrations')")
+    if cur.fetchone()[0] is None:
+        cur.close()
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    version = cur.fetchone()[0]
+    cur.close()
+    return version
+
+
+def upgrade(conn, target=None):
+    """Applies every pending migration up to target in one transaction."""
+    target = SCHEMA_VERSION if target is None else target
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    applied = cur.fetchone()[0]
+
+    ran = []
+    for version, description, statements in MIGRATIONS:
+        if version <= applied or version > target:
+            continue
+        for statement in statements:
+            cur.execute(statement)
+        cur.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+            (version, description)
+        )
+        ran.append(version)
+
+    conn.commit()
+    cur.close()
+    return ran
+
+
+# -------------------------- Startup Check --------------------------
+
+def check_schema_version(app):
+    """Compares the cached schema version at boot; never touches the network."""
+    cached = read_cached_version(app)
+    if cached is None:
+        # No local record (e.g. the release ran on another box): verify once,
+        # lazily, on this worker's first request instead of at import time.
+        app.before_request(_verify_on_first_request)
+    elif cached < SCHEMA_VERSION:
+        app.logger.error(f"Database schema is at v{cached}, code expects v{SCHEMA_VERSION}; run `flask db-upgrade`.")
+
+
+def _verify_on_first_request():
+    app = current_app._get_current_object()
+    if app.config.get('SCHEMA_VERIFIED'):
+        return
+    app.config['SCHEMA_VERIFIED'] = True
+    version = current_version(get_db())
+    if version < SCHEMA_VERSION:
+        app.logger.error(f"Database schema is at v{version}, code expects v{SCHEMA_VERSION}; run `flask db-upgrade`.")
+    else:
+        write_cached_version(app, version)
+
+
+# -------------------------- CLI --------------------------
+
+def init_app(app):
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(db_version_command)
+    check_schema_version(app)
+
+
+@click.command('db-upgrade')
+@click.option('--target', type=int, default=None, help='Stop at this schema version.')
+def db_upgrade_command(target):
+    """Applies pending schema migrations (run once per deploy)."""
+    conn = get_db()
+    ran = upgrade(conn, target)
+    version = current_version(conn)
+    write_cached_version(current_app, version)
+    if ran:
+        click.echo(f"Applied migrations {ran}; schema is now v{version}.")
+    else:
+        click.echo(f"Schema already at v{version}.")
+
+
+@click.command('db-version')
+def db_version_command():
+    """Prints the database, cached and expected schema versions."""
+    click.echo(f"database: v{current_version(get_db())}")
+    click.echo(f"cached:   v{read_cached_version(current_app)}")
+    click.echo(f"code:     v{SCHEMA_VERSION}")
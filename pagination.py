@@ -0,0 +1,126 @@
+"""
+Keyset (cursor) pagination for list pages.
+
+Pages are addressed by the sort key of their first/last row instead of an
+OFFSET, so fetching any page is an index range scan of `limit` rows no
+matter how deep into the table it is. Cursors are opaque url-safe tokens.
+"""
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Parses a ?limit= value, clamped to 1..MAX_PAGE_SIZE."""
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return default
+
+
+def _jsonable(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def jsonable_row(row):
+    """Converts a row dict's dates and Decimals into JSON-friendly values."""
+    return {key: _jsonable(value) for key, value in row.items()}
+
+
+def encode_cursor(value, row_id, direction):
+    payload = json.dumps([_jsonable(value), row_id, direction], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Returns (value, row_id, 'next'|'prev') or None for a missing/garbled token."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        value, row_id, direction = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    if direction not in ('next', 'prev'):
+        return None
+    return value, row_id, direction
+
+
+def keyset_predicate(column, tiebreak, direction, value, row_id):
+    """
+    SQL + params for rows strictly after (value, row_id) in
+    ORDER BY column <direction>, tiebreak <direction> with Postgres'
+    default NULL placement (first for DESC, last for ASC).
+    """
+    op = '<' if direction == 'DESC' else '>'
+    if value is None:
+        if direction == 'DESC':
+            return f"(({column} IS NULL AND {tiebreak} {op} %s) OR {column} IS NOT NULL)", [row_id]
+        return f"({column} IS NULL AND {tiebreak} {op} %s)", [row_id]
+    clause = f"({column}, {tiebreak}) {op} (%s, %s)"
+    if direction == 'ASC':
+        clause = f"({clause} OR {column} IS NULL)"
+    return clause, [value, row_id]
+
+
+def keyset_page(cur, select_sql, filters, params, column, tiebreak,
+                direction='DESC', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Fetches one page. select_sql is any SELECT (CTEs and comments included)
+    and is wrapped as a subquery, so column, tiebreak and every clause in
+    filters must name its output columns.
+    Returns (rows, next_cursor, prev_cursor) with rows in display order.
+    """
+    decoded = decode_cursor(cursor)
+    going_back = decoded is not None and decoded[2] == 'prev'
+    scan_direction = direction if not going_back else ('ASC' if direction == 'DESC' else 'DESC')
+
+    where = list(filters)
+    params = list(params)
+    if decoded is not None:
+        clause, clause_params = keyset_predicate(column, tiebreak, scan_direction, decoded[0], decoded[1])
+        where.append(clause)
+        params += clause_params
+
+    query = f"SELECT {column} AS _page_key, {tiebreak} AS _page_id, _q.* FROM ({select_sql}) _q"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += f" ORDER BY {column} {scan_direction}, {tiebreak} {scan_direction} LIMIT %s"
+    params.append(limit + 1)
+
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if going_back:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        if has_more or going_back:
+            next_cursor = encode_cursor(_key(last, 0), _key(last, 1), 'next')
+        if decoded is not None and (not going_back or has_more):
+            prev_cursor = encode_cursor(_key(first, 0), _key(first, 1), 'prev')
+
+    return [_strip_keys(row) for row in rows], next_cursor, prev_cursor
+
+
+def _key(row, position):
+    if isinstance(row, dict):
+        return row['_page_key' if position == 0 else '_page_id']
+    return row[position]
+
+
+def _strip_keys(row):
+    if isinstance(row, dict):
+        return {k: v for k, v in row.items() if k not in ('_page_key', '_page_id')}
+    return row[2:]
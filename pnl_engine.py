@@ -0,0 +1,232 @@
+"""
+Columnar trip P&L engine.
+
+Computes load, revenue, fuel cost, total cost and PnL for many trips at once
+over NumPy int64 arrays. Quantities are fixed-point integers (hundredths for
+the NUMERIC(12, 2) inputs), so nothing ever passes through a float: every
+figure is computed exactly at full scale and rounded once, half-even, to
+paise, which is what quantizing the Decimal results of the row loop gives.
+"""
+import time
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import click
+import numpy as np
+import pandas as pd
+
+from financials import COST_PER_KM_FUEL, FIXED_COST_PER_TRIP, TRIP_KM_SQL
+
+# Inputs (buckets, load/bucket, avg, km) arrive in hundredths; money leaves in paise.
+INPUT_SCALE = 100
+LOAD_SCALE = INPUT_SCALE * INPUT_SCALE            # buckets x load/bucket
+MONEY_SCALE = LOAD_SCALE * INPUT_SCALE            # load x avg, in 1e-6 rupees
+PAISE = 100
+_INT64_MAX = np.iinfo(np.int64).max
+
+
+def to_fixed(value, scale):
+    """Converts a Decimal/str/int constant to an exact integer at scale."""
+    scaled = Decimal(str(value)) * scale
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f"{value} is not exact at scale {scale}")
+    return int(scaled)
+
+
+def round_half_even(values, divisor):
+    """Integer division of an int64 (or object) array, rounded half-to-even."""
+    # Floor division keeps the remainder in [0, divisor) for negative values too.
+    quotient = values // divisor
+    remainder = values - quotient * divisor
+    twice = remainder * 2
+    round_up = (twice > divisor) | ((twice == divisor) & (quotient % 2 == 1))
+    return quotient + round_up
+
+
+def _fits_int64(*maxima):
+    product = 1
+    for value in maxima:
+        product *= max(int(value), 1)
+    return product < _INT64_MAX // 4
+
+
+def trip_pnl(buckets, load_per_bucket, vehicle_avg, trip_km,
+             cost_per_km=COST_PER_KM_FUEL, fixed_cost=FIXED_COST_PER_TRIP):
+    """
+    Vectorized P&L for one batch of trips.
+
+    buckets, load_per_bucket, vehicle_avg and trip_km are integer arrays in
+    hundredths (NULLs as 0). Returns a dict of arrays: total_load in 1e-4
+    units, everything else in paise.
+    """
+    buckets = np.asarray(buckets, dtype=np.int64)
+    load_per_bucket = np.asarray(load_per_bucket, dtype=np.int64)
+    vehicle_avg = np.asarray(vehicle_avg, dtype=np.int64)
+    trip_km = np.asarray(trip_km, dtype=np.int64)
+
+    # Fall back to exact Python ints if a batch could overflow int64.
+    if len(buckets) and not _fits_int64(np.abs(buckets).max(), np.abs(load_per_bucket).max(),
+                                        np.abs(vehicle_avg).max()):
+        buckets, load_per_bucket, vehicle_avg, trip_km = (
+            a.astype(object) for a in (buckets, load_per_bucket, vehicle_avg, trip_km))
+
+    total_load = buckets * load_per_bucket                       # 1e-4
+    revenue = total_load * vehicle_avg                           # 1e-6 rupees
+    fuel_cost = trip_km * to_fixed(cost_per_km, LOAD_SCALE)      # 1e-6 rupees
+    total_cost = fuel_cost + to_fixed(fixed_cost, MONEY_SCALE)
+    pnl = revenue - total_cost
+
+    to_paise = MONEY_SCALE // PAISE
+    return {
+        'total_load': total_load,
+        'revenue': round_half_even(revenue, to_paise),
+        'fuel_cost': round_half_even(fuel_cost, to_paise),
+        'total_cost': round_half_even(total_cost, to_paise),
+        'pnl': round_half_even(pnl, to_paise),
+    }
+
+
+def format_fixed(values, places):
+    """Renders fixed-point integers as exact decimal strings ('-12.50')."""
+    values = np.asarray(values)
+    unit = 10 ** places
+    negative = values < 0
+    magnitude = np.abs(values)
+    whole = (magnitude // unit).astype(str)
+    frac = np.char.zfill((magnitude % unit).astype(str), places)
+    text = np.char.add(np.char.add(whole, '.'), frac)
+    return np.where(negative, np.char.add('-', text), text)
+
+
+# -------------------------- Trip Frames --------------------------
+
+# SELECT list over `indents i` / `fleet f` / `driver_master dm` / lanes `l` / distance `d`,
+# in TRIP_INPUT_COLUMNS order, with the numeric inputs already in hundredths.
+TRIP_INPUTS_SELECT_SQL = f"""
+    SELECT
+        f.vehicle_id,
+        f.vehicle_name,
+        dm.driver_name,
+        f.status,
+        f.type,
+        f."group",
+        i.customer_name,
+        i.material,
+        i.lr_no,
+        i.pickup_location,
+        i.location AS drop_location,
+        (COALESCE(i.no_of_buckets, 0) * {INPUT_SCALE})::bigint AS buckets,
+        (COALESCE(i.load_per_bucket, 0) * {INPUT_SCALE})::bigint AS load_per_bucket,
+        (COALESCE(f.avg, 0) * {INPUT_SCALE})::bigint AS vehicle_avg,
+        (({TRIP_KM_SQL}) * {INPUT_SCALE})::bigint AS trip_km,
+        COALESCE(d.total_distance, 0) AS total_distance
+"""
+TRIP_INPUT_COLUMNS = [
+    'vehicle_id', 'vehicle_name', 'driver_name', 'status', 'type', 'group',
+    'customer_name', 'material', 'lr_no', 'pickup_location', 'drop_location',
+    'buckets', 'load_per_bucket', 'vehicle_avg', 'trip_km', 'total_distance',
+]
+
+
+def trip_frame(records):
+    """
+    Builds the trip CSV frame (dashboard column names) from TRIP_INPUTS_SELECT_SQL
+    rows; money columns are exact two-place strings.
+    """
+    df = pd.DataFrame.from_records(records, columns=TRIP_INPUT_COLUMNS)
+    result = trip_pnl(df['buckets'].to_numpy(), df['load_per_bucket'].to_numpy(),
+                      df['vehicle_avg'].to_numpy(), df['trip_km'].to_numpy())
+    return pd.DataFrame({
+        'Vehicle ID': df['vehicle_id'],
+        'Vehicle Name': df['vehicle_name'].fillna(''),
+        'Driver Name': df['driver_name'].fillna(''),
+        'Status': df['status'].fillna(''),
+        'Type': df['type'].fillna(''),
+        'Group': df['group'].fillna(''),
+        'Customer': df['customer_name'].fillna(''),
+        'Material': df['material'].fillna(''),
+        'LR No.': df['lr_no'].fillna(''),
+        'Pickup': df['pickup_location'].fillna(''),
+        'Drop': df['drop_location'].fillna(''),
+        'No. Buckets': format_fixed(df['buckets'].to_numpy(), 2),
+        'Load/Bucket': format_fixed(df['load_per_bucket'].to_numpy(), 2),
+        'Total Load': format_fixed(result['total_load'], 4),
+        'Fuel Cost': format_fixed(result['fuel_cost'], 2),
+        'Total Cost': format_fixed(result['total_cost'], 2),
+        'Revenue': format_fixed(result['revenue'], 2),
+        'PnL': format_fixed(result['pnl'], 2),
+        # Strings keep every export batch on the same Parquet schema.
+        'Total Distance Travelled': df['total_distance'].astype(str),
+    })
+
+
+# -------------------------- Benchmark --------------------------
+
+def synthetic_trips(rows, seed=7):
+    """Random trips shaped like production indents, in hundredths."""
+    rng = np.random.default_rng(seed)
+    return {
+        'buckets': rng.integers(0, 60_00, rows),
+        'load_per_bucket': rng.integers(0, 5_000_00, rows),
+        'vehicle_avg': rng.integers(0, 50_00, rows),
+        'trip_km': np.where(rng.random(rows) < 0.2, 80_00, rng.integers(5_00, 900_00, rows)),
+    }
+
+
+def decimal_loop(trips):
+    """The per-row Decimal arithmetic financial() used to run, rounded to paise."""
+    cents = Decimal('0.01')
+    cost_per_km = Decimal(COST_PER_KM_FUEL)
+    fixed_cost = Decimal(FIXED_COST_PER_TRIP)
+    out = []
+    for b, l, a, km in zip(trips['buckets'].tolist(), trips['load_per_bucket'].tolist(),
+                           trips['vehicle_avg'].tolist(), trips['trip_km'].tolist()):
+        total_load = Decimal(b).scaleb(-2) * Decimal(l).scaleb(-2)
+        revenue = total_load * Decimal(a).scaleb(-2)
+        fuel_cost = Decimal(km).scaleb(-2) * cost_per_km
+        total_cost = fuel_cost + fixed_cost
+        pnl = revenue - total_cost
+        out.append({
+            'Total Load': total_load,
+            'Fuel Cost': fuel_cost.quantize(cents, ROUND_HALF_EVEN),
+            'Total Cost': total_cost.quantize(cents, ROUND_HALF_EVEN),
+            'Revenue': revenue.quantize(cents, ROUND_HALF_EVEN),
+            'PnL': pnl.quantize(cents, ROUND_HALF_EVEN),
+        })
+    return out
+
+
+def init_app(app):
+    app.cli.add_command(pnl_benchmark_command)
+
+
+@click.command('pnl-benchmark')
+@click.option('--rows', default=1_000_000, show_default=True, help='Synthetic trips for the engine.')
+@click.option('--loop-rows', default=200_000, show_default=True,
+              help='Trips for the Decimal loop (it is much slower); results are cross-checked on these.')
+def pnl_benchmark_command(rows, loop_rows):
+    """Compares the NumPy P&L engine with the per-row Decimal loop on synthetic trips."""
+    trips = synthetic_trips(rows)
+
+    started = time.perf_counter()
+    result = trip_pnl(trips['buckets'], trips['load_per_bucket'], trips['vehicle_avg'], trips['trip_km'])
+    engine_seconds = time.perf_counter() - started
+    click.echo(f"engine:  {rows:>9,} rows in {engine_seconds:.3f}s  ({rows / engine_seconds:,.0f} rows/s)")
+
+    loop_rows = min(loop_rows, rows)
+    sample = {k: v[:loop_rows] for k, v in trips.items()}
+    started = time.perf_counter()
+    expected = decimal_loop(sample)
+    loop_seconds = time.perf_counter() - started
+    click.echo(f"decimal: {loop_rows:>9,} rows in {loop_seconds:.3f}s  ({loop_rows / loop_seconds:,.0f} rows/s)")
+    click.echo(f"speedup: {(rows / engine_seconds) / (loop_rows / loop_seconds):.1f}x per row")
+
+    mismatches = 0
+    for key, column, places in (('Revenue', 'revenue', 2), ('Fuel Cost', 'fuel_cost', 2),
+                                ('Total Cost', 'total_cost', 2), ('PnL', 'pnl', 2),
+                                ('Total Load', 'total_load', 4)):
+        want = np.array([int(row[key].scaleb(places)) for row in expected], dtype=object)
+        got = result[column][:loop_rows].astype(object)
+        mismatches += int(np.count_nonzero(got != want))
+    if mismatches:
+        raise click.ClickException(f"{mismatches} values differ from the Decimal loop")
+    click.echo(f"exact:   all {loop_rows:,} rows match the Decimal loop to the paisa")
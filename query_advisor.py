@@ -0,0 +1,165 @@
+"""
+Registry of hot route queries plus a `flask query-advisor` command.
+
+Routes register their SQL with register_query() next to where it is
+used. The advisor migrates and seeds a *local* database, runs
+EXPLAIN (ANALYZE, BUFFERS) on every registered query and flags
+sequential scans so index regressions show up before they ship.
+"""
+import json
+import os
+from urllib.parse import urlparse
+
+import click
+import psycopg2
+
+import migrations
+
+ROUTE_QUERIES = {}
+
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+# Tables this small are cheaper to scan than to index; don't flag them.
+SEQ_SCAN_ROW_THRESHOLD = 1000
+
+
+def register_query(name, sql, sample_params=()):
+    """Records a route query (and params matching the seed data); returns sql unchanged."""
+    ROUTE_QUERIES[name] = (sql, tuple(sample_params))
+    return sql
+
+
+# -------------------------- Seed Data --------------------------
+
+SEED_SQL = [
+    """
+    INSERT INTO driver_master (driver_id, driver_name, license_number, address)
+    SELECT 'DRV' || g, 'Driver ' || g, 'DL' || g, 'Delhi'
+    FROM generate_series(1, %(vehicles)s) g
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO fleet (vehicle_id, vehicle_name, model, status, capacity_weight_kg,
+                       capacity_vol_cbm, driver_id, avg)
+    SELECT 'HR55AB' || lpad(g::text, 4, '0'), 'Truck ' || g, 'TATA 407', 'Active', 5000, 30,
+           'DRV' || g, 10 + g %% 5
+    FROM generate_series(1, %(vehicles)s) g
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO indents (indent_date, indent, customer_name, "range", pickup_location, location,
+                         vehicle_number, lr_no, material, load_per_bucket, no_of_buckets, status)
+    SELECT CURRENT_DATE - (g %% 365), 'IND' || g, 'Customer ' || (g %% 200),
+           (g %% 4) * 100 || '-' || ((g %% 4) + 1) * 100 || 'Km', 'Sonipat', 'Delhi',
+           'HR55AB' || lpad((g %% %(vehicles)s + 1)::text, 4, '0'), 'LR' || g, 'Cement',
+           25, 40, (ARRAY['loading', 'parking', 'exit'])[g %% 3 + 1]
+    FROM generate_series(1, %(rows)s) g
+    """,
+    """
+    INSERT INTO trip_data (indent_id, vehicle_no, driver_name, pickup, drop_location, total_drops,
+                           exit_time, total_distance, duration_hours, customer_details)
+    SELECT 'IND' || g, 'HR55AB' || lpad((g %% %(vehicles)s + 1)::text, 4, '0'), 'AUTO-DRIVER',
+           'Sonipat', 'Delhi', 1, NOW() - (g %% 365) * INTERVAL '1 day', 80, 2, '[]'
+    FROM generate_series(1, %(rows)s / 2) g
+    """,
+    """
+    INSERT INTO orders (order_id, customer_name, created_date, order_type, pickup_location_latlon,
+                        drop_location_latlon, volume_cbm, weight_kg, delivery_priority,
+                        expected_delivery, amount, status)
+    SELECT 'ORD' || g, 'Customer ' || (g %% 200), CURRENT_DATE - (g %% 30), 'B2B', 'Delhi', 'Noida',
+           2, 300, (ARRAY['High', 'Medium', 'Low'])[g %% 3 + 1], CURRENT_DATE + (g %% 10), 1500,
+           CASE WHEN g %% 10 = 0 THEN 'Pending' ELSE 'Delivered' END
+    FROM generate_series(1, %(rows)s) g
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+def seed(conn, rows, vehicles=50):
+    cur = conn.cursor()
+    for statement in SEED_SQL:
+        cur.execute(statement, {'rows': rows, 'vehicles': vehicles})
+    conn.commit()
+    cur.execute("ANALYZE")
+    cur.close()
+
+
+# -------------------------- Plan Inspection --------------------------
+
+def find_seq_scans(plan):
+    """Yields every Seq Scan node in an EXPLAIN (FORMAT JSON) plan tree."""
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan
+    for child in plan.get('Plans', []):
+        yield from find_seq_scans(child)
+
+
+def explain(conn, sql, params):
+    """Runs EXPLAIN ANALYZE inside a rolled-back transaction and returns the plan root."""
+    cur = conn.cursor()
+    try:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        result = cur.fetchone()[0]
+    finally:
+        conn.rollback()
+        cur.close()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]
+
+
+def missing_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")
+    existing = {row[0] for row in cur.fetchall()}
+    cur.close()
+    return [name for name, _ in migrations.INDEXES if name not in existing]
+
+
+# -------------------------- CLI --------------------------
+
+def init_app(app):
+    app.cli.add_command(query_advisor_command)
+
+
+@click.command('query-advisor')
+@click.option('--dsn', default=lambda: os.environ.get('TMS_ADVISOR_DSN', 'postgresql://localhost/tms_dev'),
+              help='Local database to migrate, seed and EXPLAIN against.')
+@click.option('--seed', 'seed_rows', type=int, default=0, help='Insert this many synthetic indents first.')
+@click.option('--allow-remote', is_flag=True, help='Permit a non-local host (never point this at production).')
+def query_advisor_command(dsn, seed_rows, allow_remote):
+    """EXPLAIN (ANALYZE, BUFFERS) every registered route query and flag sequential scans."""
+    host = urlparse(dsn).hostname or ''
+    if host not in LOCAL_HOSTS and not allow_remote:
+        raise click.UsageError(f"Refusing to run against non-local host '{host}'.")
+
+    conn = psycopg2.connect(dsn)
+    try:
+        migrations.upgrade(conn)
+        if seed_rows:
+            seed(conn, seed_rows)
+            click.echo(f"Seeded {seed_rows} indents.")
+
+        for name in missing_indexes(conn):
+            click.echo(f"MISSING INDEX  {name}")
+
+        flagged = 0
+        for name, (sql, params) in sorted(ROUTE_QUERIES.items()):
+            plan = explain(conn, sql, params)
+            root = plan['Plan']
+            scans = [node for node in find_seq_scans(root) if node.get('Plan Rows', 0) >= SEQ_SCAN_ROW_THRESHOLD
+                     or node.get('Actual Rows', 0) >= SEQ_SCAN_ROW_THRESHOLD]
+            shared_hit = root.get('Shared Hit Blocks', 0)
+            shared_read = root.get('Shared Read Blocks', 0)
+            status = 'SEQ SCAN' if scans else 'ok'
+            click.echo(f"{status:<9} {name:<32} {plan.get('Execution Time', 0):>9.2f} ms  "
+                       f"buffers hit={shared_hit} read={shared_read}")
+            for node in scans:
+                flagged += 1
+                click.echo(f"          -> Seq Scan on {node.get('Relation Name')} "
+                           f"(rows={node.get('Actual Rows')}, filter={node.get('Filter', '-')})")
+    finally:
+        conn.close()
+
+    if flagged:
+        raise SystemExit(1)
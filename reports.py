@@ -0,0 +1,262 @@
+"""
+Background report jobs with cached results.
+
+Expensive reports (e.g. /financial over a long date range) are queued in
+``report_jobs`` and computed by ``flask report-worker``, a separate local
+process, so web workers return a job id at once. Results land in
+``report_results`` keyed by the normalized filters. Each result carries a
+fingerprint of the vehicle_daily_financials rows in its date range, taken
+in the same snapshot as the report; every indent write refreshes those
+rows, so a fingerprint mismatch means new data landed and the result is
+recomputed.
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+import click
+from flask import current_app
+
+from database import get_db, indent_date_filters
+
+# -------------------------- Schema --------------------------
+
+REPORT_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS report_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind VARCHAR(50) NOT NULL,
+        report_key VARCHAR(64) NOT NULL,
+        params JSONB NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'queued',
+        error TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        started_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    )
+    """,
+    # At most one live job per report.
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_report_jobs_active
+    ON report_jobs (report_key) WHERE status IN ('queued', 'running')
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_report_jobs_status_id ON report_jobs (status, id)",
+    """
+    CREATE TABLE IF NOT EXISTS report_results (
+        report_key VARCHAR(64) PRIMARY KEY,
+        kind VARCHAR(50) NOT NULL,
+        params JSONB NOT NULL,
+        fingerprint TEXT NOT NULL,
+        result JSONB NOT NULL,
+        computed_at TIMESTAMPTZ DEFAULT NOW()
+    )
+    """,
+]
+
+_FINGERPRINT_SQL = "SELECT COUNT(*), MAX(updated_at) FROM vehicle_daily_financials{where}"
+
+_RESULT_SQL = "SELECT fingerprint, result::text, computed_at FROM report_results WHERE report_key = %s"
+
+_ENQUEUE_SQL = """
+    INSERT INTO report_jobs (kind, report_key, params)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (report_key) WHERE status IN ('queued', 'running') DO NOTHING
+    RETURNING id
+"""
+_ACTIVE_JOB_SQL = "SELECT id FROM report_jobs WHERE report_key = %s AND status IN ('queued', 'running')"
+
+# Queued jobs, plus running ones whose worker died mid-report.
+_CLAIM_SQL = """
+    UPDATE report_jobs SET status = 'running', started_at = NOW()
+    WHERE id = (
+        SELECT id FROM report_jobs
+        WHERE status = 'queued'
+           OR (status = 'running' AND started_at < NOW() - %s * INTERVAL '1 second')
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, report_key, params
+"""
+
+_SAVE_RESULT_SQL = """
+    INSERT INTO report_results (report_key, kind, params, fingerprint, result, computed_at)
+    VALUES (%s, %s, %s, %s, %s, NOW())
+    ON CONFLICT (report_key) DO UPDATE SET
+        params = EXCLUDED.params,
+        fingerprint = EXCLUDED.fingerprint,
+        result = EXCLUDED.result,
+        computed_at = EXCLUDED.computed_at
+"""
+
+_FINISH_JOB_SQL = "UPDATE report_jobs SET status = %s, error = %s, finished_at = NOW() WHERE id = %s"
+
+_JOB_SQL = "SELECT id, kind, status, error, created_at, started_at, finished_at FROM report_jobs WHERE id = %s"
+
+# kind -> fn(conn, **params) returning a JSON-able dict (Decimals allowed).
+_reports = {}
+
+
+def init_app(app):
+    app.config.setdefault('REPORT_ASYNC_DAYS', int(os.environ.get('REPORT_ASYNC_DAYS', 14)))
+    # Window shown when no dates are picked; keep it within REPORT_ASYNC_DAYS.
+    app.config.setdefault('REPORT_DEFAULT_DAYS', int(os.environ.get('REPORT_DEFAULT_DAYS', 7)))
+    app.config.setdefault('REPORT_POLL_SECONDS', float(os.environ.get('REPORT_POLL_SECONDS', 2)))
+    app.config.setdefault('REPORT_JOB_TIMEOUT', int(os.environ.get('REPORT_JOB_TIMEOUT', 900)))
+    app.cli.add_command(report_worker_command)
+
+
+def register_report(kind, fn):
+    """Registers the function the worker runs for jobs of this kind."""
+    _reports[kind] = fn
+
+
+# -------------------------- Keys & Encoding --------------------------
+
+def report_key(kind, params):
+    """Stable key for a report's normalized params (see normalize_filters)."""
+    raw = json.dumps([kind, params], sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def normalize_filters(vehicle, driver, start_date, end_date):
+    """Dashboard filters with whitespace / case that cannot change the result folded away."""
+    return {
+        'vehicle': (vehicle or '').strip(),
+        'driver': (driver or '').strip().lower(),
+        'start_date': (start_date or '').strip(),
+        'end_date': (end_date or '').strip(),
+    }
+
+
+def default_window(start_date, end_date):
+    """Fills in the last REPORT_DEFAULT_DAYS when neither date is given."""
+    if start_date or end_date:
+        return start_date, end_date
+    today = date.today()
+    start = today - timedelta(days=current_app.config['REPORT_DEFAULT_DAYS'])
+    return start.isoformat(), today.isoformat()
+
+
+def is_long_range(start_date, end_date):
+    """Open-ended ranges and ranges over REPORT_ASYNC_DAYS go through a job."""
+    if not start_date or not end_date:
+        return True
+    try:
+        days = (date.fromisoformat(end_date) - date.fromisoformat(start_date)).days
+    except ValueError:
+        return False
+    return days > current_app.config['REPORT_ASYNC_DAYS']
+
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if len(obj) == 1 and '__decimal__' in obj:
+        return Decimal(obj['__decimal__'])
+    return obj
+
+
+def _fingerprint(cur, params):
+    clauses, values = indent_date_filters(params.get('start_date'), params.get('end_date'), column='day')
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+    cur.execute(_FINGERPRINT_SQL.format(where=where), values)
+    count, updated = cur.fetchone()
+    return f"{count}:{updated.isoformat() if updated else ''}"
+
+
+# -------------------------- Web Side --------------------------
+
+def cached_report(conn, kind, params):
+    """Returns (result, computed_at) if a result for params is still current, else None."""
+    cur = conn.cursor()
+    cur.execute(_RESULT_SQL, (report_key(kind, params),))
+    row = cur.fetchone()
+    current = row is not None and row[0] == _fingerprint(cur, params)
+    cur.close()
+    if not current:
+        return None
+    return json.loads(row[1], object_hook=_decode), row[2]
+
+
+def enqueue_report(conn, kind, params):
+    """Queues a report (or joins the one already queued/running) and returns its job id."""
+    key = report_key(kind, params)
+    cur = conn.cursor()
+    cur.execute(_ENQUEUE_SQL, (kind, key, json.dumps(params)))
+    row = cur.fetchone()
+    if row is None:
+        cur.execute(_ACTIVE_JOB_SQL, (key,))
+        row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    # The live job finished between the two statements: queue a fresh one.
+    return row[0] if row else enqueue_report(conn, kind, params)
+
+
+def job_status(conn, job_id):
+    """The job row as a dict, or None."""
+    cur = conn.cursor()
+    cur.execute(_JOB_SQL, (job_id,))
+    row = cur.fetchone()
+    cur.close()
+    if not row:
+        return None
+    return dict(zip(('id', 'kind', 'status', 'error', 'created_at', 'started_at', 'finished_at'), row))
+
+
+# -------------------------- Worker --------------------------
+
+def run_next_job(conn):
+    """Claims and runs one job; returns its id, or None if the queue is empty."""
+    cur = conn.cursor()
+    cur.execute(_CLAIM_SQL, (current_app.config['REPORT_JOB_TIMEOUT'],))
+    job = cur.fetchone()
+    conn.commit()
+    if job is None:
+        cur.close()
+        return None
+
+    job_id, kind, key, params = job
+    try:
+        # One snapshot for the fingerprint and the report it describes.
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        fingerprint = _fingerprint(cur, params)
+        result = _reports[kind](conn, **params)
+        cur.execute(_SAVE_RESULT_SQL, (key, kind, json.dumps(params), fingerprint,
+                                       json.dumps(result, default=_encode)))
+        cur.execute(_FINISH_JOB_SQL, ('done', None, job_id))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        current_app.logger.error(f"Report job {job_id} ({kind}) failed: {e}")
+        cur.execute(_FINISH_JOB_SQL, ('failed', str(e), job_id))
+        conn.commit()
+    cur.close()
+    return job_id
+
+
+@click.command('report-worker')
+@click.option('--once', is_flag=True, help='Drain the queue and exit instead of polling.')
+def report_worker_command(once):
+    """Runs queued report jobs (start one or more next to the web workers)."""
+    conn = get_db()
+    poll = current_app.config['REPORT_POLL_SECONDS']
+    click.echo(f"Report worker started (kinds: {', '.join(sorted(_reports)) or 'none'}).")
+    while True:
+        job_id = run_next_job(conn)
+        if job_id is not None:
+            click.echo(f"Finished report job {job_id}.")
+            continue
+        if once:
+            break
+        time.sleep(poll)
@@ -0,0 +1,301 @@
+"""
+Precomputed distance matrix over known sites.
+
+Every located pickup and drop point (the coordinates geocode_queue stores on
+indents and orders) is a site, keyed by geocoding.normalize_address(). The
+dense int32 metre matrix between all of them lives under the instance
+folder as .npy files that each worker maps read-only, so route requests
+slice the rows they need out of the shared page cache instead of
+recomputing distances:
+
+    matrix.npy   int32   (sites, sites)   metres, SITE_MATRIX_METHOD (row -> column)
+    coords.npy   float64 (sites, 2)       lat, lon the row was computed from
+    sites.json   method, keys (row order) and display addresses
+
+SITE_MATRIX_DIR is a symlink to the current version (see snapshots), so
+a rebuild swaps all three files at once.
+
+update() is incremental: existing rows keep their place, new sites are
+appended and only rows that are new or moved are computed. The geocode
+worker runs it after storing coordinates (at most every
+SITE_MATRIX_REFRESH_SECONDS); ``flask site-matrix-build`` runs it by hand.
+Workers notice a rebuilt matrix within SITE_MATRIX_CHECK_SECONDS.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+import click
+import numpy as np
+from flask import current_app
+
+from database import get_db
+from distances import METHODS, coords_array, cross_matrix, is_symmetric, methods, point_distances
+from geocode_queue import on_batch, split_drops
+from geocoding import normalize_address
+from snapshots import current, new_version, publish
+from streaming import server_side_batches
+
+_INDENT_SITES_SQL = """
+    SELECT DISTINCT pickup_location, pickup_lat, pickup_lon, location, drop_lats, drop_lons
+    FROM indents
+    WHERE pickup_lat IS NOT NULL OR drop_lats IS NOT NULL
+"""
+_ORDER_SITES_SQL = """
+    SELECT DISTINCT pickup_location_latlon, pickup_lat, pickup_lon, drop_location_latlon, drop_lat, drop_lon
+    FROM orders
+    WHERE pickup_lat IS NOT NULL OR drop_lat IS NOT NULL
+"""
+
+# Rows computed per cross_matrix() call while updating.
+UPDATE_BLOCK_ROWS = 512
+
+_store = None
+_stamp = None
+_checked = None
+_last_refresh = None
+_stale = True
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('SITE_MATRIX_DIR', os.environ.get(
+        'SITE_MATRIX_DIR', os.path.join(app.instance_path, 'site_matrix')))
+    app.config.setdefault('SITE_MATRIX_METHOD', os.environ.get('SITE_MATRIX_METHOD', 'geodesic'))
+    app.config.setdefault('SITE_MATRIX_CHECK_SECONDS', float(os.environ.get('SITE_MATRIX_CHECK_SECONDS', 30)))
+    app.config.setdefault('SITE_MATRIX_REFRESH_SECONDS', float(os.environ.get('SITE_MATRIX_REFRESH_SECONDS', 600)))
+    app.cli.add_command(site_matrix_build_command)
+
+
+# -------------------------- Store --------------------------
+
+class SiteMatrix:
+    """Read-only view over the mapped matrix files."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'sites.json')) as fh:
+            meta = json.load(fh)
+        self.method = meta['method']
+        self.keys = meta['keys']
+        self.addresses = meta['addresses']
+        self.row_of = {key: row for row, key in enumerate(self.keys)}
+        self.coords = np.load(os.path.join(path, 'coords.npy'), mmap_mode='r')
+        self.matrix = np.load(os.path.join(path, 'matrix.npy'), mmap_mode='r')
+
+    def rows(self, addresses):
+        """Row per address as an intp array, -1 for addresses that are not sites."""
+        return np.array([self.row_of.get(normalize_address(a), -1) if isinstance(a, str) and a.strip() else -1
+                         for a in addresses], dtype=np.intp)
+
+
+def get_site_matrix():
+    """This worker's mapped site matrix (remapped after a rebuild), or None if none is built."""
+    global _store, _stamp, _checked
+    cfg = current_app.config
+    if _checked is not None and time.monotonic() - _checked < cfg['SITE_MATRIX_CHECK_SECONDS']:
+        return _store
+    with _lock:
+        _checked = time.monotonic()
+        version = current(cfg['SITE_MATRIX_DIR'])
+        stamp = version if version and os.path.exists(os.path.join(version, 'sites.json')) else None
+        if stamp != _stamp:
+            # Arrays already handed out stay valid: the old files live on while mapped.
+            try:
+                _store = SiteMatrix(stamp) if stamp else None
+            except (OSError, ValueError, KeyError) as e:
+                current_app.logger.warning(f"Site matrix not loaded: {e}")
+                _store, stamp = None, None
+            _stamp = stamp
+    return _store
+
+
+def matrix_method():
+    """The distance method site_distance_matrix() answers with."""
+    store = get_site_matrix()
+    return store.method if store else current_app.config['SITE_MATRIX_METHOD']
+
+
+def site_distance_matrix(addresses, coords):
+    """
+    int32 metre matrix over route nodes. Pairs of known sites are sliced out
+    of the shared matrix; rows and columns of other nodes are computed from
+    coords. Returns (matrix, valid) like distances.distance_matrix().
+    """
+    store = get_site_matrix()
+    method = matrix_method()
+    n = len(coords)
+    rows = store.rows(addresses) if store else np.full(n, -1, dtype=np.intp)
+    known = rows >= 0
+    valid = coords_array(coords)[1] | known
+
+    matrix = np.zeros((n, n), dtype=np.int32)
+    index = np.flatnonzero(known)
+    if len(index):
+        matrix[np.ix_(index, index)] = store.matrix[np.ix_(rows[index], rows[index])]
+    other = np.flatnonzero(~known)
+    if len(other):
+        block, _, _ = cross_matrix([coords[i] for i in other], coords, method=method)
+        matrix[other, :] = block
+        matrix[:, other] = block.T if is_symmetric(method) else cross_matrix(
+            coords, [coords[i] for i in other], method=method)[0]
+    np.fill_diagonal(matrix, 0)
+    return matrix, valid
+
+
+def site_arc_costs(addresses, coords, arcs):
+    """
+    int32 metres for just the given (from, to) node pairs, an (arcs, 2)
+    array; the sparse counterpart of site_distance_matrix().
+    """
+    store = get_site_matrix()
+    method = matrix_method()
+    arcs = np.asarray(arcs, dtype=np.intp).reshape(-1, 2)
+    rows = store.rows(addresses) if store else np.full(len(coords), -1, dtype=np.intp)
+    points, _ = coords_array(coords)
+    tails, heads = arcs[:, 0], arcs[:, 1]
+    costs = np.zeros(len(arcs), dtype=np.int32)
+    known = (rows[tails] >= 0) & (rows[heads] >= 0)
+    if known.any():
+        costs[known] = store.matrix[rows[tails[known]], rows[heads[known]]]
+    other = np.flatnonzero(~known)
+    if method in METHODS:
+        # The kernels are symmetric: price each unordered pair once.
+        low, high = np.minimum(tails[other], heads[other]), np.maximum(tails[other], heads[other])
+        pairs, inverse = np.unique(low.astype(np.int64) * len(points) + high, return_inverse=True)
+        meters = point_distances(points[pairs // len(points)], points[pairs % len(points)], method)
+        costs[other] = np.rint(np.nan_to_num(meters))[inverse]
+    else:
+        # Providers answer matrices: one cross_matrix() call per tail over the heads it needs.
+        other = other[np.argsort(tails[other], kind='stable')]
+        for group in np.split(other, np.flatnonzero(np.diff(tails[other])) + 1):
+            if len(group):
+                block, _, _ = cross_matrix(points[tails[group[:1]]], points[heads[group]], method=method)
+                costs[group] = block[0]
+    costs[tails == heads] = 0
+    return costs
+
+
+# -------------------------- Build --------------------------
+
+def collect_sites(conn):
+    """{address key: (address, lat, lon)} for every located indent and order address."""
+    sites = {}
+
+    def add(address, lat, lon):
+        if address and str(address).strip() and lat is not None and lon is not None:
+            sites.setdefault(normalize_address(address), (str(address).strip(), float(lat), float(lon)))
+
+    for rows in server_side_batches(conn, _INDENT_SITES_SQL):
+        for pickup, pickup_lat, pickup_lon, location, drop_lats, drop_lons in rows:
+            add(pickup, pickup_lat, pickup_lon)
+            drops = split_drops(location)
+            if drop_lats and len(drop_lats) == len(drops):
+                for drop, lat, lon in zip(drops, drop_lats, drop_lons):
+                    add(drop, lat, lon)
+    for rows in server_side_batches(conn, _ORDER_SITES_SQL):
+        for pickup, pickup_lat, pickup_lon, drop, drop_lat, drop_lon in rows:
+            add(pickup, pickup_lat, pickup_lon)
+            add(drop, drop_lat, drop_lon)
+    conn.commit()
+    return sites
+
+
+def update(out_dir, sites, method, full=False):
+    """
+    Brings the matrix files in out_dir up to date with sites. Returns
+    (sites, rows computed), or None when nothing changed.
+    """
+    old = None
+    live = current(out_dir)
+    if not full and live and os.path.exists(os.path.join(live, 'sites.json')):
+        old = SiteMatrix(live)
+        if old.method != method:
+            old = None
+
+    keys = list(old.keys) if old else []
+    addresses = list(old.addresses) if old else []
+    coords = [tuple(c) for c in old.coords.tolist()] if old else []
+    row_of = dict(old.row_of) if old else {}
+    dirty = []
+    for key, (address, lat, lon) in sites.items():
+        row = row_of.get(key)
+        if row is None:
+            row_of[key] = row = len(keys)
+            keys.append(key)
+            addresses.append(address)
+            coords.append((lat, lon))
+            dirty.append(row)
+        elif coords[row] != (lat, lon):
+            coords[row] = (lat, lon)
+            dirty.append(row)
+    if not keys or (old is not None and not dirty):
+        return None
+
+    # Write a new version next to the live one and swap, so mapped readers never see half a build.
+    n, kept = len(keys), len(old.keys) if old else 0
+    tmp_dir = new_version(out_dir)
+    matrix = np.lib.format.open_memmap(os.path.join(tmp_dir, 'matrix.npy'), mode='w+', dtype=np.int32, shape=(n, n))
+    for start in range(0, kept, UPDATE_BLOCK_ROWS):
+        stop = min(start + UPDATE_BLOCK_ROWS, kept)
+        matrix[start:stop, :kept] = old.matrix[start:stop]
+    dirty = np.array(sorted(dirty), dtype=np.intp)
+    for start in range(0, len(dirty), UPDATE_BLOCK_ROWS):
+        block = dirty[start:start + UPDATE_BLOCK_ROWS]
+        distances, _, _ = cross_matrix([coords[i] for i in block], coords, method=method)
+        matrix[block, :] = distances
+        matrix[:, block] = distances.T if is_symmetric(method) else cross_matrix(
+            coords, [coords[i] for i in block], method=method)[0]
+    matrix[dirty, dirty] = 0
+    matrix.flush()
+    del matrix
+
+    np.save(os.path.join(tmp_dir, 'coords.npy'), np.array(coords, dtype=np.float64).reshape(-1, 2))
+    with open(os.path.join(tmp_dir, 'sites.json'), 'w') as fh:
+        json.dump({'method': method, 'keys': keys, 'addresses': addresses}, fh)
+    old = None
+    publish(out_dir, tmp_dir)
+    return n, len(dirty)
+
+
+def refresh(conn, full=False):
+    """Collects the current sites and updates the matrix under an exclusive file lock."""
+    cfg = current_app.config
+    out_dir = cfg['SITE_MATRIX_DIR']
+    os.makedirs(os.path.dirname(out_dir.rstrip(os.sep)) or '.', exist_ok=True)
+    with open(out_dir.rstrip(os.sep) + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return update(out_dir, collect_sites(conn), cfg['SITE_MATRIX_METHOD'], full=full)
+
+
+def _after_geocode_batch(conn, resolved):
+    """Geocode worker hook: folds newly located sites in, at most every SITE_MATRIX_REFRESH_SECONDS."""
+    global _stale, _last_refresh
+    _stale = _stale or resolved > 0
+    if not _stale or (_last_refresh is not None and
+                      time.monotonic() - _last_refresh < current_app.config['SITE_MATRIX_REFRESH_SECONDS']):
+        return
+    _stale, _last_refresh = False, time.monotonic()
+    result = refresh(conn)
+    if result:
+        current_app.logger.info("Site matrix now covers {} sites ({} rows computed).".format(*result))
+
+
+on_batch(_after_geocode_batch)
+
+
+@click.command('site-matrix-build')
+@click.option('--full', is_flag=True, help='Recompute every row instead of only new or moved sites.')
+def site_matrix_build_command(full):
+    """Builds or incrementally updates the shared site distance matrix."""
+    method = current_app.config['SITE_MATRIX_METHOD']
+    if method not in methods():
+        raise click.ClickException(f"SITE_MATRIX_METHOD must be one of {', '.join(methods())}")
+    started = time.perf_counter()
+    result = refresh(get_db(), full=full)
+    if result is None:
+        click.echo("Site matrix is up to date.")
+        return
+    click.echo("Site matrix: {} sites, {} rows computed in {:.1f}s.".format(*result, time.perf_counter() - started))
+    click.echo("Web workers pick it up within SITE_MATRIX_CHECK_SECONDS.")
@@ -0,0 +1,64 @@
+"""
+Versioned data directories, swapped in atomically.
+
+Builders of mapped .npy stores (site matrix, road engine, gazetteer) write
+into a fresh ``<dir>.v<ns>`` directory and publish() it by pointing <dir>,
+a symlink, at it with one os.replace(), so readers find either the old or
+the new version and never a gap. Readers resolve the link once with
+current() and open every file of a version through that path. The
+previous version is kept until the next publish, so a reader that
+resolved it just before a swap can still open its files.
+"""
+import os
+import shutil
+import time
+
+
+def _base(path):
+    return os.path.abspath(path).rstrip(os.sep)
+
+
+def _stamp(base, name):
+    """Creation stamp (ns) of a version directory name, or None if it is not one."""
+    prefix = os.path.basename(base) + '.v'
+    if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+        return None
+    return int(name[len(prefix):])
+
+
+def current(path):
+    """Directory of the published version of path, or None if nothing is published."""
+    base = _base(path)
+    return os.path.realpath(base) if os.path.isdir(base) else None
+
+
+def new_version(path):
+    """Creates and returns an empty version directory to build the next version in."""
+    base = _base(path)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    version = f"{base}.v{time.time_ns()}"
+    os.makedirs(version)
+    return version
+
+
+def publish(path, version):
+    """Points path at version atomically and drops versions older than the one it replaced."""
+    base = _base(path)
+    parent = os.path.dirname(base)
+    previous = os.path.basename(os.readlink(base)) if os.path.islink(base) else None
+    if os.path.isdir(base) and previous is None:
+        # A plain directory from before versioning: move it aside once.
+        previous = f"{os.path.basename(base)}.v0"
+        os.rename(base, os.path.join(parent, previous))
+
+    link = base + '.link'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, base)
+
+    keep = _stamp(base, previous) if previous else None
+    for name in os.listdir(parent):
+        stamp = _stamp(base, name)
+        if stamp is not None and keep is not None and stamp < keep:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
@@ -0,0 +1,211 @@
+"""
+Streaming download helpers.
+
+COPY ... TO STDOUT runs in a background thread and feeds a bounded queue
+that a response generator drains, so exports start sending immediately
+and memory stays flat no matter how big the table is. Exports that need
+Python-side computation read a server-side cursor in batches instead.
+"""
+import io
+import queue
+import threading
+import uuid
+import zlib
+
+from flask import Response, stream_with_context
+from psycopg2 import extensions
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+
+# Bytes buffered before a chunk is handed to the response.
+CHUNK_BYTES = 64 * 1024
+# Chunks allowed in flight between the COPY thread and the client.
+QUEUE_CHUNKS = 16
+# Rows fetched per round trip from a server-side cursor.
+BATCH_ROWS = 20000
+
+_DONE = object()
+
+
+class ClientDisconnected(Exception):
+    """Raised inside the COPY thread once the response generator is closed."""
+
+
+class _QueueWriter:
+    """File-like sink for copy_expert that batches rows into queue-sized chunks."""
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if self.cancelled.is_set():
+            raise ClientDisconnected()
+        self.buffer += data if isinstance(data, (bytes, bytearray)) else data.encode('utf-8')
+        if len(self.buffer) >= CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.chunks.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def copy_to_chunks(conn, copy_sql):
+    """Yields the raw output of a COPY ... TO STDOUT statement in ~64 KB chunks."""
+    chunks = queue.Queue(maxsize=QUEUE_CHUNKS)
+    cancelled = threading.Event()
+
+    def run():
+        writer = _QueueWriter(chunks, cancelled)
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(copy_sql, writer)
+            cur.close()
+            writer.flush()
+            chunks.put(_DONE)
+        except BaseException as e:
+            chunks.put(e)
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        # Unblock a writer stuck on a full queue so the thread can exit.
+        while worker.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def gzip_chunks(chunks, level=6):
+    """Gzip-compresses a byte stream chunk by chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_copy_response(conn, select_sql, params, filename, compress=False):
+    """Streams SELECT results as a CSV download via COPY, optionally gzipped."""
+    cur = conn.cursor()
+    select = cur.mogrify(select_sql, params).decode(extensions.encodings[conn.encoding])
+    cur.close()
+    body = copy_to_chunks(conn, f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)")
+
+    headers = {'X-Accel-Buffering': 'no'}
+    if compress:
+        body = gzip_chunks(body)
+        headers['Content-Disposition'] = f"attachment; filename={filename}.gz"
+        mimetype = 'application/gzip'
+    else:
+        headers['Content-Disposition'] = f"attachment; filename={filename}"
+        mimetype = 'text/csv'
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+
+# -------------------------- Server-side Cursor Exports --------------------------
+
+def server_side_batches(conn, sql, params=None, batch_rows=BATCH_ROWS):
+    """Yields lists of rows from a named (server-side) cursor, batch_rows at a time."""
+    cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+    cur.itersize = batch_rows
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_rows)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def frame_csv_chunks(frames):
+    """Serializes an iterable of DataFrames as one CSV stream (header from the first)."""
+    header = True
+    for df in frames:
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=header)
+        header = False
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands whatever was written back to a generator."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+
+def frame_parquet_chunks(frames):
+    """Writes each DataFrame as a Parquet row group, yielding bytes as they are produced."""
+    sink = _ChunkSink()
+    writer = None
+    for df in frames:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table)
+        data = sink.drain()
+        if data:
+            yield data
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def frames_response(frames, filename, fmt='csv', compress=False):
+    """
+    Streams an iterable of DataFrames as a CSV (optionally gzipped) or Parquet
+    download. frames must yield at least one (possibly empty) frame.
+    """
+    headers = {'X-Accel-Buffering': 'no'}
+    if fmt == 'parquet':
+        if pq is None:
+            raise RuntimeError('Parquet export needs pyarrow installed')
+        headers['Content-Disposition'] = f"attachment; filename={filename}.parquet"
+        return Response(stream_with_context(frame_parquet_chunks(frames)),
+                        mimetype='application/vnd.apache.parquet', headers=headers)
+
+    body = frame_csv_chunks(frames)
+    if compress:
+        body = gzip_chunks(body)
+        headers['Content-Disposition'] = f"attachment; filename={filename}.csv.gz"
+        mimetype = 'application/gzip'
+    else:
+        headers['Content-Disposition'] = f"attachment; filename={filename}.csv"
+        mimetype = 'text/csv'
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
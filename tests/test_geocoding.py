@@ -0,0 +1,124 @@
+"""
+GeocodingClient against a local Nominatim-shaped mock server: single-flight,
+the shared rate limit, concurrency and keep-alive.
+"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from geocoding import NOMINATIM_HEADERS, GeocodingClient, RateLimiter, normalize_address
+
+LATENCY = 0.3
+
+
+class MockGeocoder(BaseHTTPRequestHandler):
+    """/search endpoint with fixed latency; records what it saw."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        seen = self.server.seen
+        query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+        with seen['lock']:
+            seen['hits'][query] += 1
+            seen['connections'].add(self.client_address)
+            seen['in_flight'] += 1
+            seen['max_in_flight'] = max(seen['max_in_flight'], seen['in_flight'])
+        time.sleep(LATENCY)
+        with seen['lock']:
+            seen['in_flight'] -= 1
+        seed = sum(query.encode()) % 1000
+        body = b'[]' if query.startswith('nowhere') else (
+            f'[{{"lat": "{20 + seed / 100}", "lon": "{75 + seed / 100}"}}]'.encode())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockGeocoder)
+    server.seen = {'hits': Counter(), 'connections': set(), 'in_flight': 0,
+                   'max_in_flight': 0, 'lock': threading.Lock()}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server, tmp_path, rate, concurrency=4):
+    limiter = RateLimiter(str(tmp_path / 'geocode_rate'), rate)
+    return GeocodingClient(f"http://127.0.0.1:{server.server_port}/search", NOMINATIM_HEADERS,
+                           limiter, concurrency=concurrency)
+
+
+def test_single_flight_collapses_concurrent_lookups(server, tmp_path):
+    client = make_client(server, tmp_path, rate=50.0)
+    names = [f"Depot {i}" for i in range(4)]
+    with ThreadPoolExecutor(max_workers=len(names) * 3) as pool:
+        results = list(pool.map(client.lookup, [n for n in names for _ in range(3)]))
+
+    assert server.seen['hits'] == Counter({n: 1 for n in names})
+    assert all(coords is not None and definitive for coords, definitive in results)
+    for i in range(0, len(results), 3):
+        assert results[i] == results[i + 1] == results[i + 2]
+
+
+def test_rate_limit_paces_requests(server, tmp_path):
+    rate = 5.0
+    client = make_client(server, tmp_path, rate=rate)
+    names = [f"Depot {i}" for i in range(8)]
+
+    started = time.monotonic()
+    client.lookup_many({normalize_address(n): n for n in names})
+    elapsed = time.monotonic() - started
+
+    assert sum(server.seen['hits'].values()) == len(names)
+    assert elapsed >= (len(names) - 1) / rate * 0.95
+
+
+def test_rate_limit_is_shared_through_the_state_file(server, tmp_path):
+    rate = 5.0
+    clients = [make_client(server, tmp_path, rate=rate, concurrency=1) for _ in range(2)]
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(lambda c: c.lookup_many({f"depot {i}{id(c)}": f"Depot {i}" for i in range(3)}), clients))
+    elapsed = time.monotonic() - started
+
+    assert elapsed >= 5 / rate * 0.95
+
+
+def test_lookup_many_runs_concurrently_over_kept_alive_connections(server, tmp_path):
+    concurrency = 4
+    client = make_client(server, tmp_path, rate=50.0, concurrency=concurrency)
+    names = [f"Depot {i}" for i in range(12)]
+
+    first = client.lookup_many({normalize_address(n): n for n in names})
+    client.lookup_many({normalize_address(n) + ' again': n + ' again' for n in names})
+
+    assert server.seen['max_in_flight'] >= 2
+    assert len(server.seen['connections']) <= concurrency
+    assert all(coords is not None for coords, _ in first.values())
+
+
+def test_unknown_address_is_a_definitive_miss(server, tmp_path):
+    client = make_client(server, tmp_path, rate=50.0)
+
+    assert client.lookup('nowhere at all') == (None, True)
+
+
+def test_failed_request_is_not_definitive(tmp_path):
+    limiter = RateLimiter(str(tmp_path / 'geocode_rate'), 50.0)
+    client = GeocodingClient('http://127.0.0.1:9/search', NOMINATIM_HEADERS, limiter, timeout=1)
+
+    assert client.lookup('Depot 1') == (None, False)